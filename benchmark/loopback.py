@@ -0,0 +1,304 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+
+Loopback benchmark of the transfer path. A server and a client are
+started in processes of their own on localhost, and every workload is
+sent a number of times. The throughput, files per second, time to first
+byte and peak memory of both ends are written as json, such that runs
+can be compared across changes and releases, e.g.
+
+    $ python benchmark/loopback.py --output before.json
+    $ python benchmark/loopback.py --compare before.json
+"""
+
+# Imports
+import argparse
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parents[1]))
+
+import reloc
+from reloc.__version__ import __version__
+
+MiB = 2**20
+
+# Words that compressible files are made of.
+WORDS = ("reloc transfer server client frame file folder data chunk "
+        "stream socket buffer packet header manifest signature delta "
+        "compress verify store block range offset").split()
+
+
+def _write_random(path, size, rng):
+    with open(str(path), 'wb') as f:
+        while size:
+            chunk = min(size, 4 * MiB)
+            f.write(rng.randbytes(chunk) if hasattr(rng, 'randbytes')
+                    else os.urandom(chunk))
+            size -= chunk
+
+
+def _write_text(path, size, rng):
+    """
+    Write text of random words, which compresses about as well as source
+    code or logs. Every MiB is generated anew, such that codecs don't
+    find the whole file in their window.
+    """
+    with open(str(path), 'wb') as f:
+        while size:
+            words = rng.choices(WORDS, k = MiB // 6)
+            chunk = ' '.join(words).encode('ascii')[:min(size, MiB)]
+            f.write(chunk)
+            size -= len(chunk)
+
+
+def huge(root, scale, rng):
+    _write_random(root / 'huge.bin', int(1024 * MiB * scale), rng)
+
+
+def tiny(root, scale, rng):
+    for index in range(int(20000 * scale)):
+        folder = root / 'd{}'.format(index // 1000)
+        folder.mkdir(exist_ok = True)
+        (folder / 'f{}.txt'.format(index)).write_bytes(rng.randbytes(1024)
+                if hasattr(rng, 'randbytes') else os.urandom(1024))
+
+
+def mixed(root, scale, rng):
+    """
+    A tree of files with sizes spread evenly on a log scale between
+    1 KiB and 8 MiB, i.e. most files are small but most bytes are in
+    the large files.
+    """
+    for index in range(int(2000 * scale)):
+        folder = root / 'd{}'.format(index % 20) / 's{}'.format(index % 7)
+        folder.mkdir(parents = True, exist_ok = True)
+        size = int(2**rng.uniform(10, 23))
+        _write_random(folder / 'f{}.bin'.format(index), size, rng)
+
+
+def text(root, scale, rng):
+    _write_text(root / 'text.log', int(256 * MiB * scale), rng)
+
+
+def random_(root, scale, rng):
+    _write_random(root / 'random.bin', int(256 * MiB * scale), rng)
+
+
+# Every workload is the generator of its data and the options of
+# the client that it is sent with.
+WORKLOADS = {
+    'huge': (huge, dict()),
+    'tiny': (tiny, dict()),
+    'tiny_packed': (tiny, dict(pack = True)),
+    'mixed': (mixed, dict()),
+    'compressible': (text, dict(compression = 'auto')),
+    'random': (random_, dict(compression = 'auto')),
+}
+
+
+def _max_rss():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _serve(port, def_path, events):
+    """
+    Run a server, sending every finished transfer with the peak
+    memory of the server to 'events'.
+    """
+    sys.stdout = open(os.devnull, 'w')
+
+    def hook(event, data):
+        if event == 'transfer':
+            events.send(dict(files = data['files'], bytes = data['bytes'],
+                duration = data['duration'], first_byte = data['first_byte'],
+                max_rss = _max_rss()))
+
+    server = reloc.server(port = port, def_path = def_path)
+    server.add_hook(hook)
+    events.send('ready')
+    server.receive()
+
+
+def _send(port, source, options, results):
+    sys.stdout = open(os.devnull, 'w')
+    started = time.time()
+    client = reloc.client(host = 'localhost', port = port, **options)
+    result = client.transmit(source)
+    client.disconnect()
+    results.send(dict(started = started, duration = time.time() - started,
+        bytes_sent = result.bytes_sent, ok = result.ok, max_rss = _max_rss()))
+
+
+def run(name, data, port, repeat, context):
+    """
+    Send a workload 'repeat' times, every time to an empty folder, and
+    with a new client process such that its peak memory is its own.
+
+    Returns:
+        The median of every measurement, and all runs.
+    """
+    options = WORKLOADS[name][1]
+    runs = list()
+    for _ in range(repeat):
+        target = tempfile.mkdtemp(prefix = 'reloc-bench-')
+        events, server_events = context.Pipe()
+        server = context.Process(target = _serve,
+                args = (port, target, server_events), daemon = True)
+        server.start()
+        try:
+            if not events.poll(30) or events.recv() != 'ready':
+                raise RuntimeError("Server didn't start.")
+
+            results, client_results = context.Pipe()
+            client = context.Process(target = _send,
+                    args = (port, str(data), options, client_results))
+            client.start()
+            client.join()
+            if not results.poll(0):
+                raise RuntimeError("Client failed on workload {}.".format(name))
+
+            sent = results.recv()
+            if not events.poll(30):
+                raise RuntimeError("Transfer never finished.")
+
+            received = events.recv()
+
+        finally:
+            server.terminate()
+            server.join()
+            shutil.rmtree(target, ignore_errors = True)
+
+        seconds = sent['duration']
+        runs.append({
+            'ok': sent['ok'],
+            'seconds': seconds,
+            'bytes': received['bytes'],
+            'files': received['files'],
+            'mb_per_second': received['bytes'] / MiB / seconds,
+            'files_per_second': received['files'] / seconds,
+            'time_to_first_byte': (received['first_byte'] - sent['started']
+                if received['first_byte'] else None),
+            'client_max_rss': sent['max_rss'],
+            'server_max_rss': received['max_rss'],
+        })
+
+    summary = dict()
+    for key in runs[0]:
+        values = [run[key] for run in runs if run[key] is not None]
+        if key == 'ok':
+            summary[key] = all(values)
+
+        elif values:
+            summary[key] = statistics.median(values)
+
+    summary['options'] = options
+    summary['runs'] = runs
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change of every workload against a baseline.
+
+    Returns:
+        The workloads that got slower by more than 'tolerance'.
+    """
+    slower = list()
+    for name, summary in results['workloads'].items():
+        before = baseline.get('workloads', dict()).get(name)
+        if not before:
+            continue
+
+        ratio = summary['mb_per_second'] / before['mb_per_second']
+        print("{:<14} {:>10.1f} MB/s  {:>+7.1%}  ttfb {:.4f}s".format(name,
+            summary['mb_per_second'], ratio - 1,
+            summary.get('time_to_first_byte', 0)), file = sys.stderr)
+        if ratio < 1 - tolerance:
+            slower.append(name)
+
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Loopback benchmark of reloc.")
+    parser.add_argument('--workloads', nargs = '+', choices = list(WORKLOADS),
+            default = list(WORKLOADS))
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--scale', type = float, default = 1.0,
+            help = "Scale the size of every workload, e.g. 0.1 for a quick run.")
+    parser.add_argument('--port', type = int, default = 1760)
+    parser.add_argument('--data', type = str,
+            help = "Folder to keep the generated workloads in between runs.")
+    parser.add_argument('--seed', type = int, default = 1750)
+    parser.add_argument('--output', type = str)
+    parser.add_argument('--compare', type = str,
+            help = "Earlier output to compare with, failing on regressions.")
+    parser.add_argument('--tolerance', type = float, default = 0.1)
+    args = parser.parse_args()
+
+    data_root = pathlib.Path(args.data or tempfile.mkdtemp(prefix = 'reloc-data-'))
+    context = multiprocessing.get_context('spawn')
+    results = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'time': time.time(),
+        'workloads': dict(),
+    }
+    try:
+        for name in args.workloads:
+            generate = WORKLOADS[name][0]
+            data = data_root / '{}-{}'.format(generate.__name__.strip('_'), args.scale)
+            if not data.exists():
+                temp = data.with_name(data.name + '.tmp')
+                shutil.rmtree(str(temp), ignore_errors = True)
+                temp.mkdir(parents = True)
+                generate(temp, args.scale, random.Random(args.seed))
+                temp.rename(data)
+
+            print("Running {}...".format(name), file = sys.stderr)
+            results['workloads'][name] = run(name, data, args.port,
+                    args.repeat, context)
+
+    finally:
+        if not args.data:
+            shutil.rmtree(str(data_root), ignore_errors = True)
+
+    output = json.dumps(results, indent = 2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+
+        if slower:
+            print("Slower than the baseline: {}".format(', '.join(slower)),
+                    file = sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,23 @@
 from .server import Server as server
 from .client import Client as client
+from .fanout import FanoutClient as fanout_client
 
+# The asyncio counterparts and the prefork server are imported on first
+# use, since asyncio and multiprocessing are slow to import, e.g. for the
+# command-line client.
+_LAZY = {
+    'async_server': ('aio', 'AsyncServer'),
+    'async_client': ('aio', 'AsyncClient'),
+    'prefork_server': ('prefork', 'PreforkServer'),
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module 'reloc' has no attribute {}".format(name))
+
+    import importlib
+    module, attribute = _LAZY[name]
+    value = getattr(importlib.import_module('.' + module, __name__), attribute)
+    globals()[name] = value
+    return value
@@ -0,0 +1,805 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import asyncio
+import collections
+import errno
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pathlib
+import time
+from threading import Lock
+
+# Package imports
+from .protocol import (FRAME, HEADER, ITEM, DATA, EOF, END, ERROR, MANIFEST,
+        WANT, PING, PROBE, CHECK, ACK, CHUNK_SIZE, BUFFER_SIZE, MAX_FRAME_SIZE, MANIFEST_BATCH, ProtocolError,
+        pack_frame, encode_json, decode_json, encode_header, decode_header,
+        check_header)
+from .receiver import Receiver
+from .store import STORE_NAME, BlobStore
+from .metrics import Metrics
+from .pipeline import WRITE_BUFFERS
+from . import compress, integrity
+from .util import TransferResult, build_manifest
+from .scan import collect_items
+
+
+async def read_header(reader):
+    """
+    Asyncio counterpart of 'recv_header', reading the header of
+    a single frame from a stream reader.
+
+    Returns:
+        A tuple (frame_type, length), or None if the peer closed
+        the connection cleanly between two frames.
+    """
+    try:
+        return FRAME.unpack(await reader.readexactly(FRAME.size))
+
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+
+        raise ProtocolError("Connection closed in the middle of a frame.")
+
+
+async def read_payload(reader, length, max_size = MAX_FRAME_SIZE,
+        timeout = None):
+    """
+    Read the payload of a frame. With a timeout, the payload is read part
+    by part, and the timeout applies to every read rather than to the
+    whole payload, like the timeout of a socket.
+    """
+    if length > max_size:
+        raise ProtocolError("Frame of {} bytes exceeds the limit of {} " \
+                "bytes.".format(length, max_size))
+
+    if timeout is None:
+        try:
+            return await reader.readexactly(length)
+
+        except asyncio.IncompleteReadError:
+            raise ProtocolError("Connection closed in the middle of a frame.")
+
+    payload = bytearray()
+    while len(payload) < length:
+        chunk = await asyncio.wait_for(reader.read(length - len(payload)),
+                timeout)
+        if not chunk:
+            raise ProtocolError("Connection closed in the middle of a frame.")
+
+        payload += chunk
+
+    return payload
+
+
+async def read_frame(reader, max_size = MAX_FRAME_SIZE):
+    """
+    Asyncio counterpart of 'recv_frame', reading a single
+    frame from a stream reader.
+    """
+    header = await read_header(reader)
+    if header is None:
+        return None
+
+    frame_type, length = header
+    return frame_type, await read_payload(reader, length, max_size)
+
+
+async def read_data(reader, length, buffer_size, write, timeout = None):
+    """
+    Asyncio counterpart of 'recv_data', handing the payload of a data
+    frame to the coroutine 'write' in parts of at most 'buffer_size' bytes.
+    The timeout applies to every read, see 'read_payload'.
+    """
+    while length:
+        chunk = await asyncio.wait_for(reader.read(min(length, buffer_size)),
+                timeout)
+        if not chunk:
+            raise ProtocolError("Connection closed in the middle of a frame.")
+
+        await write(chunk)
+        length -= len(chunk)
+
+
+async def _discard(chunk):
+    pass
+
+
+def _settle(future, error):
+    if not future.done():
+        if error:
+            future.set_exception(error)
+
+        else:
+            future.set_result(None)
+
+
+class HandleBehind():
+    """
+    Makes the calls of the receivers of a connection, i.e. writing,
+    hashing and fsyncing files, in order on a thread of an executor, such
+    that the event loop never waits for the disk. Calls are queued without
+    waiting for them, and the replies that they return are written to the
+    client as they are made. The event loop only waits for the calls to
+    catch up when asked to, or when more than 'limit' bytes are queued.
+    A call that fails fails the stream reader of the connection, such
+    that the connection stops at its next read.
+
+    Methods:
+        call: Coroutine that queues a call.
+
+        close: Drop the calls not yet made, and queue a last call.
+
+        _run: Private method that makes the queued calls on the executor.
+
+        _reply: Private method that writes a reply on the event loop.
+    """
+    def __init__(self, executor, reader, writer, limit):
+        self.executor = executor
+        self.reader = reader
+        self.writer = writer
+        self.limit = limit
+        self.loop = asyncio.get_event_loop()
+        self.calls = collections.deque()
+        self.lock = Lock()
+        self.running = False
+        self.closed = False
+        # Bytes of the queued calls, and the error of the call that
+        # failed, after which the calls after it are dropped.
+        self.queued = 0
+        self.error = None
+
+    async def call(self, function, *args, size = 0, wait = False):
+        """
+        Params:
+            function (callable): The call, returning a reply or None.
+
+            size (int): The bytes that the call holds on to until made.
+
+            wait (bool): Wait until the call, and those before it, are
+            made. Calls are also waited for when too many bytes are queued.
+        """
+        if self.error:
+            raise self.error
+
+        future = None
+        if wait or self.queued + size > self.limit:
+            future = self.loop.create_future()
+
+        with self.lock:
+            self.calls.append((function, args, size, future))
+            self.queued += size
+            start = not self.running
+            self.running = True
+
+        if start:
+            self.executor.submit(self._run)
+
+        if future:
+            await future
+
+        await self.writer.drain()
+
+    def close(self, function):
+        with self.lock:
+            self.calls.clear()
+            self.calls.append((function, (), 0, None))
+            self.closed = True
+            start = not self.running
+            self.running = True
+
+        if start:
+            self.executor.submit(self._run)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.calls:
+                    self.running = False
+                    return
+
+                function, args, size, future = self.calls.popleft()
+
+            # Once closed, the only call left is the last one.
+            if not self.error or self.closed:
+                try:
+                    reply = function(*args)
+                    if reply and not self.closed:
+                        self.loop.call_soon_threadsafe(self._reply, reply)
+
+                except Exception as e:
+                    if not self.closed:
+                        self.error = e
+                        self.loop.call_soon_threadsafe(
+                                self.reader.set_exception, e)
+
+            with self.lock:
+                self.queued -= size
+
+            if future:
+                self.loop.call_soon_threadsafe(_settle, future, self.error)
+
+    def _reply(self, reply):
+        if not self.writer.is_closing():
+            self.writer.write(pack_frame(*reply))
+
+
+class AsyncClient():
+    """
+    Asyncio counterpart of the Client. Every transfer uses its own
+    connection, which means that any number of transfers can run
+    concurrently on a single event loop, e.g. with asyncio.gather.
+
+    Methods:
+        transmit: Coroutine that sends a folder/file to the server
+        and returns a TransferResult when the transfer is done.
+
+        add_hook: Register a function that is called with every
+        transfer, see Metrics.add_hook.
+
+        _exchange_manifest: Private coroutine that sends the manifest
+        when syncing and returns the items the server wants.
+
+        _send_item: Private coroutine that streams a single
+        folder/file to the server.
+
+        _send_check: Private method that sends the hash of the content
+        just sent, when verifying.
+    """
+    def __init__(self, host, port, timeout = None, compression = None,
+            compression_level = None, verify = False):
+        """
+        Params:
+            host (str): Should be the same host, i.e. ip as the
+            server is connected to.
+
+            port (int): Should be the same port that the server
+            is connected to.
+
+            timeout (float): Specify how long the client will
+            try to connect to the server before it stops.
+            Specify this as None will disable the timeout.
+            Default: None.
+
+            compression (str): Compress files while streaming,
+            see Client.
+            Default: None.
+
+            compression_level (int): Compression level of the codec.
+            Default: None (i.e. the default level of the codec).
+
+            verify (bool): Hash every file while it is sent, such that the
+            server verifies it before moving it into place, see Client.
+            Default: False.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.compression = compression
+        self.compression_level = compression_level
+        self.verify = verify
+        self.codecs = list()
+        self.metrics = Metrics()
+
+        if not isinstance(self.host, str):
+            raise TypeError("Host specified on the wrong format, " \
+                    "should be a str, i.e. '127.0.0.1'.")
+
+        if not isinstance(self.port, int):
+            raise TypeError("Port specified on the wrong format, " \
+                    "should be an int, i.e. 1750.")
+
+        if not isinstance(self.timeout, (type(None), int, float)) :
+            raise TypeError("Timeout specified on the wrong format, " \
+                    "should be an int or a float, i.e. 7 or 7.7")
+
+    def add_hook(self, hook):
+        """
+        Register a function that is called as hook(event, data) with
+        every 'transfer' of the client, including the 'result'.
+        """
+        self.metrics.add_hook(hook)
+
+    async def transmit(self, item_name, sync = False, checksum = False):
+        """
+        Transmit a single file or folder. In case of folder,
+        all folders and files included in the parent folder
+        will be sent, excluding .dotfiles.
+
+        Params:
+            item_name (str): The file or folder to be sent
+            to the server.
+
+            sync (bool): Only send the files that are missing or
+            stale on the server, see Client.transmit.
+            Default: False.
+
+            checksum (bool): Compare files by content instead of by
+            size and modification time when syncing.
+            Default: False.
+
+        Returns:
+            A TransferResult with the number of bytes sent, the
+            duration and the status of every file.
+        """
+        loop = asyncio.get_event_loop()
+        parent_path = pathlib.Path(item_name).absolute()
+        transmit_data = await loop.run_in_executor(None, collect_items, parent_path)
+        if transmit_data is None:
+            raise FileNotFoundError(
+                    errno.ENOENT, os.strerror(errno.ENOENT), item_name)
+
+        result = TransferResult()
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+
+        try:
+            writer.write(pack_frame(HEADER, encode_header(
+                codecs = compress.available() if self.compression else [],
+                verify = integrity.available() if self.verify else [])))
+            await writer.drain()
+            options = check_header(await read_frame(reader))
+            self.codecs = options.get('codecs', [])
+            # The hash algorithm agreed on, or None if not verifying.
+            algorithm = options.get('verify')
+            if sync:
+                transmit_data = await self._exchange_manifest(
+                        reader, writer, transmit_data, checksum, result)
+
+            for item in transmit_data:
+                try:
+                    f = open(str(item.source), 'rb') if item.type_ == "file" else None
+
+                except OSError as e:
+                    result.files[item.to_dict()['path']] = 'failed: {}'.format(e)
+                    continue
+
+                result.bytes_sent += await self._send_item(writer, item, f,
+                        algorithm)
+                if f:
+                    result.files[item.to_dict()['path']] = 'sent'
+
+            writer.write(pack_frame(END))
+            await writer.drain()
+            # Files are acknowledged before the end of the transfer when
+            # verifying, and files failing verification are marked.
+            while True:
+                frame = await read_frame(reader)
+                if frame is None or frame[0] not in (ACK, END):
+                    raise ProtocolError("Transfer was not acknowledged by " \
+                            "the server.")
+
+                if frame[0] == END:
+                    break
+
+                path, error = decode_json(frame[1])
+                if error:
+                    result.files[path] = 'failed: {}'.format(error)
+
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+        result.duration = time.perf_counter() - start
+        statuses = list(result.files.values())
+        self.metrics.record_transfer(statuses.count('sent'), result.bytes_sent,
+                result.duration, result = result,
+                failed = sum(status.startswith('failed') for status in statuses))
+        return result
+
+    async def _exchange_manifest(self, reader, writer, transmit_data,
+            checksum, result):
+        loop = asyncio.get_event_loop()
+        files = [item for item in transmit_data if item.type_ == "file"]
+        wanted = set()
+        for start in range(0, len(files), MANIFEST_BATCH):
+            batch = files[start:start + MANIFEST_BATCH]
+            entries = await loop.run_in_executor(None, build_manifest,
+                    batch, checksum)
+            writer.write(pack_frame(MANIFEST, encode_json(entries)))
+            frame = await read_frame(reader)
+            if frame is None or frame[0] != WANT:
+                raise ProtocolError("Expected answer to manifest.")
+
+            wanted.update(id(batch[index]) for index in decode_json(frame[1]))
+
+        for item in files:
+            if id(item) not in wanted:
+                result.files[item.to_dict()['path']] = 'unchanged'
+
+        return [item for item in transmit_data
+                if item.type_ != "file" or id(item) in wanted]
+
+    async def _send_item(self, writer, item, f, algorithm = None):
+        """
+        Send the metadata of a single item followed by its content,
+        which is sent as a single data frame using the sendfile
+        support of the event loop, or compressed in chunks. The
+        content is followed by its hash when verifying.
+        Returns the number of content bytes sent.
+        """
+        hasher = integrity.new(algorithm) if f and algorithm else None
+        if f and self.compression:
+            sample = f.read(CHUNK_SIZE)
+            item.codec = compress.choose(self.compression, self.codecs,
+                    item.suffix, sample)
+            if not item.codec:
+                f.seek(0)
+
+        writer.write(pack_frame(ITEM, encode_json(item.to_dict())))
+        if not f:
+            return 0
+
+        if item.codec:
+            sent = 0
+            with f:
+                for chunk in compress.iter_compressed(f, sample, item.codec,
+                        self.compression_level, CHUNK_SIZE, hasher):
+                    writer.write(FRAME.pack(DATA, len(chunk)))
+                    writer.write(chunk)
+                    sent += len(chunk)
+                    await writer.drain()
+
+            self._send_check(writer, hasher)
+            writer.write(pack_frame(EOF))
+            return sent
+
+        loop = asyncio.get_event_loop()
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            # Hashed first, which leaves the file in the page cache
+            # that sendfile then sends it from.
+            if hasher:
+                await loop.run_in_executor(None, integrity.update_from_file,
+                        hasher, f, 0, size)
+
+            writer.write(FRAME.pack(DATA, size))
+            await writer.drain()
+            sent = await loop.sendfile(
+                    writer.transport, f, 0, size) if size else 0
+
+        if sent != size:
+            raise OSError("File {} changed size while being sent.".format(
+                item.source))
+
+        self._send_check(writer, hasher)
+        writer.write(pack_frame(EOF))
+        return sent
+
+    @staticmethod
+    def _send_check(writer, hasher):
+        if hasher:
+            writer.write(pack_frame(CHECK, hasher.hexdigest().encode('ascii')))
+
+
+class AsyncServer():
+    """
+    Asyncio counterpart of the Server, handling every connection
+    as a task on a single event loop.
+
+    Methods:
+        start: Coroutine that starts listening for connections.
+
+        serve_forever: Coroutine that starts the server, if not
+        already started, and serves until cancelled.
+
+        close: Stop listening for new connections.
+
+        wait_closed: Coroutine that waits until the server is closed.
+
+        add_hook: Register a function that is called with every
+        connection and transfer, see Metrics.add_hook.
+
+        _handle_connection: Private coroutine that handles the
+        receiving of the framed data stream from a single connection.
+
+        _receive_transfer: Private coroutine that receives a single
+        transfer on a connection.
+
+        _answer_probe: Private coroutine that answers the probes of a
+        client, see Client.ping.
+    """
+    def __init__(self, host = 'localhost', port = 1750, def_path = None,
+            max_transfers = 100, queue_size = 1000, backlog = 100,
+            max_frame_size = MAX_FRAME_SIZE, buffer_size = BUFFER_SIZE,
+            timeout = None, unpack_workers = None, store = None,
+            stats_port = None, stats_interval = None, sink = None):
+        """
+        Params:
+            host (str): The ip adress that the server will connect to.
+            Default: localhost.
+
+            port (int): The port that the server will connect to.
+            Default: 1750.
+
+            def_path (str): Specify the default path for files and folders
+            to be written to. If specified path doesn't exist, error will
+            be raised.
+            Default: None (i.e. home folder will be used).
+
+            max_transfers (int): The maximum number of transfers
+            handled concurrently.
+            Default: 100.
+
+            queue_size (int): The number of connections that can wait for
+            a free transfer slot. Connections arriving when the queue is
+            full are rejected with an error.
+            Default: 1000.
+
+            backlog (int): The number of connections the operating
+            system keeps waiting to be accepted.
+            Default: 100.
+
+            max_frame_size (int): The largest metadata frame accepted
+            from a client.
+            Default: 1 MiB.
+
+            buffer_size (int): The largest part of a data frame read
+            at once before it is written to disk.
+            Default: 256 KiB.
+
+            timeout (float): Close connections that have been idle for
+            this many seconds. Specify this as None will disable the timeout.
+            Default: None.
+
+            unpack_workers (int): Number of threads that write the small
+            files packed together by clients, shared by all connections.
+            Default: None (i.e. chosen from the number of cores).
+
+            store (str): Keep the content of received files in a content
+            addressed store in this folder, and link files with the same
+            content to the stored copy, i.e. with reflinks where the file
+            system supports it and otherwise copies. Clients enabling
+            dedup then never send content the server already holds.
+            Specify True to keep the store in a '.reloc-store' folder in
+            the default path. The store should be on the same file system
+            as the default path.
+            Default: None (i.e. no store).
+
+            stats_port (int): Serve the metrics of the server over http,
+            see Server.
+            Default: None (i.e. not served).
+
+            stats_interval (float): Print the metrics of the server every
+            this many seconds.
+            Default: None (i.e. never printed).
+
+            sink (callable): Hand received files to other objects than
+            files on disk, see Server. It is called on the threads of
+            the receivers, not on the event loop.
+            Default: None (i.e. every file is written to disk).
+        """
+        self.host = host
+        self.port = port
+        self.max_transfers = max_transfers
+        self.queue_size = queue_size
+        self.backlog = backlog
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.sink = sink
+        self.unpackers = ThreadPoolExecutor(max_workers = unpack_workers)
+        # Receivers write to disk on threads of their own, see HandleBehind.
+        self.receivers = ThreadPoolExecutor(max_workers = max_transfers)
+        self.server = None
+        self.waiting = 0
+        self.slots = None
+        self.metrics = Metrics()
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
+        self.stats = None
+
+        if not def_path:
+            self.def_path = pathlib.Path.home()
+
+        else:
+            if not isinstance(def_path, str):
+                raise TypeError("Wrong format on default path, should " \
+                        "be a str, i.e. /users/antonnormelius/documents")
+
+            if not pathlib.Path(def_path).absolute().exists():
+                raise FileNotFoundError(
+                    errno.ENOENT, os.strerror(errno.ENOENT), str(def_path))
+
+            self.def_path = pathlib.Path(def_path)
+
+        self.store = None
+        if store:
+            self.store = BlobStore(self.def_path / STORE_NAME
+                    if store is True else store)
+
+    async def start(self):
+        self.slots = asyncio.Semaphore(self.max_transfers)
+        self.server = await asyncio.start_server(self._handle_connection,
+                self.host, self.port, backlog = self.backlog)
+        print("Server connected to host: {}".format(self.host))
+        print("Server connected to port: {}".format(self.port))
+        print("Saving files to path: {}".format(self.def_path))
+        if self.stats_port and not self.stats:
+            self.stats = self.metrics.serve('localhost', self.stats_port)
+            print("Serving metrics on port: {}".format(self.stats_port))
+
+        if self.stats_interval:
+            self.metrics.dump_every(self.stats_interval)
+
+    def add_hook(self, hook):
+        """
+        Register a function that is called as hook(event, data) with
+        every 'connection' and 'transfer' event of the server.
+        """
+        self.metrics.add_hook(hook)
+
+    async def serve_forever(self):
+        if not self.server:
+            await self.start()
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        self.server.close()
+
+    async def wait_closed(self):
+        await self.server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        adr = writer.get_extra_info('peername')
+        self.metrics.add('connections')
+        if self.slots.locked() and self.waiting >= self.queue_size:
+            self.metrics.add('rejected')
+            writer.write(pack_frame(ERROR, b'Server is busy, try again later.'))
+            writer.close()
+            return
+
+        self.waiting += 1
+        self.metrics.set('queue_depth', self.waiting)
+        try:
+            await self.slots.acquire()
+
+        finally:
+            self.waiting -= 1
+            self.metrics.set('queue_depth', self.waiting)
+
+        self.metrics.change('active_connections', 1)
+        started = time.perf_counter()
+        received = 0
+        receiver = None
+        behind = None
+        try:
+            frame = await asyncio.wait_for(
+                    read_frame(reader, self.max_frame_size), self.timeout)
+            if frame is None:
+                return
+
+            if frame[0] != HEADER:
+                raise ProtocolError("Expected header frame.")
+
+            options = decode_header(frame[1])
+            verify = integrity.negotiate(options.get('verify'))
+            writer.write(pack_frame(HEADER, encode_header(
+                max_transfers = self.max_transfers,
+                max_frame_size = self.max_frame_size,
+                store = self.store is not None,
+                codecs = compress.negotiate(options.get('codecs')),
+                verify = verify,
+                probe = True)))
+            await writer.drain()
+
+            # A connection carries any number of transfers, until the
+            # client closes it between two transfers.
+            behind = HandleBehind(self.receivers, reader, writer,
+                    WRITE_BUFFERS * self.buffer_size)
+            while True:
+                receiver = Receiver(self.def_path, executor = self.unpackers,
+                        store = self.store, verify = verify, sink = self.sink)
+                if not await self._receive_transfer(reader, writer, receiver,
+                        behind):
+                    break
+
+                received += receiver.bytes
+
+        except (ProtocolError, OSError, asyncio.TimeoutError) as e:
+            print("Transfer from client {} failed: {}".format(adr[0], e))
+
+        except Exception as e:
+            print("Transfer from client {} failed unexpectedly: " \
+                    "{!r}".format(adr[0], e))
+
+        finally:
+            # The receiver is closed after the calls being made, on
+            # the thread of the connection.
+            if behind:
+                behind.close(receiver.close)
+
+            elif receiver:
+                receiver.close()
+
+            if receiver:
+                if not receiver.done:
+                    received += receiver.bytes
+
+            self.slots.release()
+            writer.close()
+            duration = time.perf_counter() - started
+            self.metrics.change('active_connections', -1)
+            if duration:
+                self.metrics.observe('connection_bytes_per_second',
+                        received / duration)
+
+            self.metrics.emit('connection', address = adr[0],
+                    bytes = received, duration = duration)
+
+    async def _receive_transfer(self, reader, writer, receiver, behind):
+        """
+        Receive a single transfer, i.e. the frames up to and including
+        the end of transfer, which the receiver acknowledges. The frames
+        are handled behind the socket, see HandleBehind, and the end of
+        the transfer is waited for.
+
+        Returns:
+            False if the client closed the connection before the
+            transfer started, otherwise True.
+        """
+        started = None
+        data_time = 0.0
+
+        async def write(chunk):
+            await behind.call(receiver.write, chunk, size = len(chunk))
+
+        while not receiver.done:
+            header = await asyncio.wait_for(read_header(reader), self.timeout)
+            if header is None:
+                if started is None:
+                    return False
+
+                raise ProtocolError("Connection closed before " \
+                        "end of transfer.")
+
+            frame_type, length = header
+            if frame_type in (PING, PROBE):
+                await self._answer_probe(reader, writer, frame_type, length)
+                continue
+
+            if started is None:
+                started = time.perf_counter()
+
+            if frame_type == DATA:
+                data_started = time.perf_counter()
+                await read_data(reader, length, self.buffer_size, write,
+                        self.timeout)
+                data_time += time.perf_counter() - data_started
+
+            else:
+                payload = await read_payload(reader, length,
+                        self.max_frame_size, self.timeout)
+                await behind.call(receiver.handle, frame_type, payload,
+                        size = len(payload), wait = frame_type == END)
+
+        # Content is written behind, so the time spent in data frames,
+        # including waiting on the event loop, counts as receiving.
+        self.metrics.record_transfer(receiver.files, receiver.bytes,
+                time.perf_counter() - started,
+                recv_seconds = data_time,
+                disk_seconds = receiver.disk_time,
+                decode_seconds = receiver.decode_time,
+                first_byte = receiver.first_byte)
+        return True
+
+    async def _answer_probe(self, reader, writer, frame_type, length):
+        if frame_type == PROBE:
+            await read_data(reader, length, self.buffer_size, _discard,
+                    self.timeout)
+
+        else:
+            await read_payload(reader, length, self.max_frame_size,
+                    self.timeout)
+
+        writer.write(pack_frame(frame_type))
+        await writer.drain()
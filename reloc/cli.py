@@ -13,6 +13,7 @@ import pathlib
 
 # Reloc imports
 from .client import Client
+from .fanout import FanoutClient
 from .server import Server
 
 def cli_transmit():
@@ -23,6 +24,28 @@ Reloc commands that can be specified:
 
 Positional:
     send [file]                 |   Send a file/folder to the server.
+        [--sync]                |   Only send files that are missing or changed.
+        [--checksum]            |   Compare files by content when syncing.
+        [--delta]               |   Only send the changed parts of large files.
+        [--compression]         |   Compress files, auto/zlib/lzma/zstd.
+        [--level]               |   Compression level of the codec.
+        [--streams]             |   Connections to stripe large files over, or auto.
+        [--resume]              |   Continue large files from an interrupted transfer.
+        [--retries]             |   Times to retry when the connection is lost.
+        [--pack]                |   Pack small files together.
+        [--dedup]               |   Don't send content the server already holds.
+        [--verify]              |   Verify files with a hash.
+        [--to]                  |   Send to many servers at once, as host:port.
+        [--fanout]              |   Servers that every server relays to.
+        [--tune]                |   Probe the link to tune the transfer.
+        [--socket_buffer]       |   Size of the socket buffers, in bytes.
+        [--chunk_size]          |   Size of compressed chunks, in bytes.
+        [--rate_limit]          |   Bytes per second to send at most.
+        [--priority]            |   Share of a rate limited server, 1 to 16.
+    watch [folder]              |   Keep a folder mirrored on the server.
+        [--debounce]            |   Seconds without changes before sending them.
+        [--interval]            |   Seconds between scans without inotify.
+    ping                        |   Measure the round trip time and bandwidth.
     start [external/internal]   |   Start a server.
 
 Optional:
@@ -36,6 +59,17 @@ Reloc start commands that can be specified:
 Positional:
         internal [--port, --host]   |   Start internal server for local network.
     or, external [host, --port]     |   Start external server for access over internet.
+
+Optional:
+    [--def_path]                    |   Folder that received files are saved in.
+    [--max_transfers]               |   Number of transfers handled concurrently.
+    [--store [path]]                |   Deduplicate files in a content addressed store.
+    [--stats_port]                  |   Serve metrics over http on localhost.
+    [--stats_interval]              |   Print metrics every this many seconds.
+    [--relay]                       |   Relay transfers to servers a client asks for.
+    [--socket_buffer]               |   Size of the socket buffers, in bytes.
+    [--rate_limit]                  |   Bytes per second to write at most.
+    [--workers]                     |   Processes sharing the port, or auto.
 """
 
     # Main parser
@@ -48,6 +82,55 @@ Positional:
     parser_send.add_argument('file')
     parser_send.add_argument('--host', type = str)
     parser_send.add_argument('--port', type = int)
+    parser_send.add_argument('--sync', action = 'store_true')
+    parser_send.add_argument('--checksum', action = 'store_true')
+    parser_send.add_argument('--delta', action = 'store_true')
+    parser_send.add_argument('--compression', type = str,
+            choices = ['auto', 'zlib', 'lzma', 'zstd'])
+    parser_send.add_argument('--level', type = int)
+    parser_send.add_argument('--streams', type = lambda value:
+            value if value == 'auto' else int(value), default = 1)
+    parser_send.add_argument('--resume', action = 'store_true')
+    parser_send.add_argument('--retries', type = int, default = 0)
+    parser_send.add_argument('--pack', action = 'store_true')
+    parser_send.add_argument('--dedup', action = 'store_true')
+    parser_send.add_argument('--verify', action = 'store_true')
+    parser_send.add_argument('--to', nargs = '+')
+    parser_send.add_argument('--fanout', type = int)
+    parser_send.add_argument('--tune', action = 'store_true')
+    parser_send.add_argument('--socket_buffer', type = int)
+    parser_send.add_argument('--chunk_size', type = int)
+    parser_send.add_argument('--rate_limit', type = int)
+    parser_send.add_argument('--priority', type = int, default = 1)
+
+    # Watch parser, taking the options of the send parser that
+    # apply to every transfer.
+    parser_watch = subparser.add_parser('watch', add_help=False)
+    parser_watch.add_argument('file')
+    parser_watch.add_argument('--host', type = str)
+    parser_watch.add_argument('--port', type = int)
+    parser_watch.add_argument('--checksum', action = 'store_true')
+    parser_watch.add_argument('--compression', type = str,
+            choices = ['auto', 'zlib', 'lzma', 'zstd'])
+    parser_watch.add_argument('--level', type = int)
+    parser_watch.add_argument('--streams', type = lambda value:
+            value if value == 'auto' else int(value), default = 1)
+    parser_watch.add_argument('--retries', type = int, default = 0)
+    parser_watch.add_argument('--pack', action = 'store_true')
+    parser_watch.add_argument('--dedup', action = 'store_true')
+    parser_watch.add_argument('--verify', action = 'store_true')
+    parser_watch.add_argument('--debounce', type = float, default = 0.2)
+    parser_watch.add_argument('--interval', type = float, default = 1.0)
+    parser_watch.add_argument('--tune', action = 'store_true')
+    parser_watch.add_argument('--socket_buffer', type = int)
+    parser_watch.add_argument('--chunk_size', type = int)
+    parser_watch.add_argument('--rate_limit', type = int)
+    parser_watch.add_argument('--priority', type = int, default = 1)
+
+    # Ping parser
+    parser_ping = subparser.add_parser('ping', add_help=False)
+    parser_ping.add_argument('--host', type = str)
+    parser_ping.add_argument('--port', type = int)
     
     # Start parser
     parser_start = subparser.add_parser('start')
@@ -60,6 +143,15 @@ Positional:
     parser_internal.add_argument('--def_path', type = str)
     parser_internal.add_argument('--is_async', type = bool, default = False)
     parser_internal.add_argument('--use_log', type = bool, default = False)
+    parser_internal.add_argument('--max_transfers', type = int, default = 4)
+    parser_internal.add_argument('--store', nargs = '?', const = True)
+    parser_internal.add_argument('--stats_port', type = int)
+    parser_internal.add_argument('--stats_interval', type = float)
+    parser_internal.add_argument('--relay', action = 'store_true')
+    parser_internal.add_argument('--socket_buffer', type = int)
+    parser_internal.add_argument('--rate_limit', type = int)
+    parser_internal.add_argument('--workers', type = lambda value:
+            value if value == 'auto' else int(value))
 
     # Start parser --> External parser
     parser_external = start_subparser.add_parser('external')
@@ -68,6 +160,15 @@ Positional:
     parser_external.add_argument('--def_path', type = str)
     parser_external.add_argument('--is_async', type = bool, default = False)
     parser_external.add_argument('--use_log', type = bool, default = False)
+    parser_external.add_argument('--max_transfers', type = int, default = 4)
+    parser_external.add_argument('--store', nargs = '?', const = True)
+    parser_external.add_argument('--stats_port', type = int)
+    parser_external.add_argument('--stats_interval', type = float)
+    parser_external.add_argument('--relay', action = 'store_true')
+    parser_external.add_argument('--socket_buffer', type = int)
+    parser_external.add_argument('--rate_limit', type = int)
+    parser_external.add_argument('--workers', type = lambda value:
+            value if value == 'auto' else int(value))
     
     args = parser.parse_args()
     
@@ -80,7 +181,23 @@ Positional:
         print(docs['start_parser'])
 
     # Handle different parsers here
-    if args.main_parser == 'send':
+    if args.main_parser == 'send' and args.to:
+        client = FanoutClient(args.to, fanout = args.fanout,
+                compression = args.compression,
+                compression_level = args.level, pack = args.pack,
+                verify = args.verify, rate_limit = args.rate_limit,
+                priority = args.priority)
+        failed = False
+        for address, result in client.transmit(args.file).items():
+            if not result.ok:
+                print("Failed to send to {}.".format(address))
+                failed = True
+
+        client.disconnect()
+        # A non-zero exit status tells scripts that the transfer failed.
+        return 1 if failed else 0
+
+    if args.main_parser in ('send', 'watch', 'ping'):
         # Try to parse host and port from reloc.ini in home directory.
         h, p = config()
         if not args.host:
@@ -97,18 +214,56 @@ Positional:
             else:
                 args.port = 1750
         
-        client = Client(host = args.host, port = args.port)
-        client.transmit(args.file)
-        return
+        if args.main_parser == 'ping':
+            link = Client(host = args.host, port = args.port).ping()
+            print("Round trip time: {:.2f} ms".format(link.rtt * 1000))
+            print("Bandwidth: {:.1f} MB/s".format(link.bandwidth / 2**20))
+            return
+
+        client = Client(host = args.host, port = args.port,
+                compression = args.compression,
+                compression_level = args.level,
+                streams = args.streams, retries = args.retries,
+                pack = args.pack, dedup = args.dedup,
+                verify = args.verify, tune = args.tune,
+                socket_buffer = args.socket_buffer,
+                chunk_size = args.chunk_size, rate_limit = args.rate_limit,
+                priority = args.priority)
+        if args.main_parser == 'watch':
+            try:
+                client.watch(args.file, debounce = args.debounce,
+                        interval = args.interval, checksum = args.checksum)
+
+            except KeyboardInterrupt:
+                pass
+
+            return
+
+        result = client.transmit(args.file, sync = args.sync,
+                checksum = args.checksum, delta = args.delta,
+                resume = args.resume)
+        return 0 if result.ok else 1
     
     if args.main_parser == 'start':
-        if args.start_parser == 'internal':
-            server = Server(mode = 'internal')
-            server.receive()
-        
-        elif args.start_parser == 'external':
-            server = Server(mode = 'external',
-                    host = args.host, port = args.port)
+        if args.start_parser in ('internal', 'external'):
+            options = dict(mode = args.start_parser,
+                    host = args.host, port = args.port,
+                    def_path = args.def_path, use_log = args.use_log,
+                    max_transfers = args.max_transfers, store = args.store,
+                    stats_port = args.stats_port,
+                    stats_interval = args.stats_interval,
+                    relay = args.relay,
+                    socket_buffer = args.socket_buffer,
+                    rate_limit = args.rate_limit)
+            if args.workers:
+                # Imported when needed, since multiprocessing is slow to import.
+                from .prefork import PreforkServer
+                server = PreforkServer(workers = None if args.workers == 'auto'
+                        else args.workers, **options)
+
+            else:
+                server = Server(**options)
+
             server.receive()
 
         return
@@ -9,45 +9,68 @@ MIT License.
 import sys
 import socket
 import pathlib
-import pickle
 import time
 import errno
 import random
-import ipify
-import requests
-import logging
 import os
-import datetime
-from threading import Thread, active_count
+import itertools
+import select
+from threading import Lock, Thread, active_count
 
 # Package imports
-from .util import Item
+from .protocol import (FRAME, HEADER, ITEM, DATA, EOF, END, ERROR, MANIFEST,
+        WANT, SIGREQ, SIGNATURE, COPY, RANGE, RESUME, PACK, HAVE, CHECK, ACK,
+        PING, PROBE, PACK_INDEX,
+        CHUNK_SIZE, MANIFEST_BATCH, ACK_INTERVAL, MAX_FRAME_SIZE, PACK_THRESHOLD,
+        DEDUP_THRESHOLD, RESUME_THRESHOLD,
+        STRIPE_SIZE, MAX_STREAMS, STRIPE_TIMEOUT, BUFFER_SIZE,
+        ProtocolError, send_frame, pack_frame, recv_frame, encode_json, decode_json,
+        encode_header, expect_header, expect_end)
+from .util import TransferResult, build_manifest
+from .scan import iter_items, stream_item
+from .metrics import Metrics
+from .pipeline import READ_AHEAD, BufferPool, ReadAhead
+from .shaping import MAX_PRIORITY, TokenBucket, ShapedSocket
+from .tuning import Link, PROBE_PINGS, PROBE_MIN, PROBE_MAX, PROBE_TIME
+from . import compress, integrity, tuning, watch as watcher
+from .delta import (DELTA_THRESHOLD, COPY as COPY_BLOCKS, decode_signature,
+        delta as iter_delta)
 
 class Client():
     """
     Methods:
-        connect_client: Connect to client by specifying
-        the host and port that the server is connected to.
-
         disconnect: Disconnects from the socket
         that the client is connected to.
 
-        ping: Serves as a transciever method for sending
-        and receiving a simple message in order to check
-        connection with the server, and the transfer of
-        data.
+        ping: Probe the link to the server, i.e. the round trip
+        time and the bandwidth, and tune the client for it.
 
         transmit: Call this method to actual send a folder/file
-        to the server.
+        to the server, or only the files that the server is missing
+        or has other versions of, with 'sync'.
+
+        watch: Keep a folder mirrored on the server, sending every
+        file as soon as it changes.
+
+        add_hook: Register a function that is called with every
+        transfer, see Metrics.add_hook.
+
+        _transmit_file: Private method that is used to handle
+        file transmission, retrying it on a new connection
+        when the connection is lost.
+
+        _transmit_locked: Private method that sends the items of
+        a single attempt of a transfer, batch by batch.
 
-        __transmit_file: Private method that is used to handle
-        file transmission. Can both be made on the main thread
-        or not, based on if the user is running the client
-        on the main thread or not, which is specified by the
-        'is_async' param in the connect_client method.
+        _send_item: Private method that streams a single
+        folder/file to the server.
     """
     def __init__(self, host, port, is_async = False,
-            timeout = None):
+            timeout = None, compression = None, compression_level = None,
+            streams = 1, keep_alive = False, retries = 0, pack = False,
+            dedup = False, verify = False, tune = False, socket_buffer = None,
+            chunk_size = None, read_ahead = READ_AHEAD, rate_limit = None,
+            priority = 1):
         """
         Initiate connectiong with the socket.
         Params:
@@ -69,11 +92,153 @@ class Client():
             Specify this as None will disable the timeout.
             Default: None.
 
+            compression (str): Compress files while streaming. Specify
+            'auto' to use the best codec available on both sides, i.e. zstd
+            if the zstandard package is installed, else zlib. Or specify the
+            codec, 'zlib', 'lzma' or 'zstd'. Files with suffixes of already
+            compressed formats, e.g. .jpg or .zip, and files that a sample
+            shows doesn't compress are always sent as is.
+            Default: None (i.e. no compression).
+
+            compression_level (int): Compression level of the codec.
+            Default: None (i.e. the default level of the codec).
+
+            streams (int): Split large files into byte ranges sent over
+            this many parallel connections, which helps filling links
+            with high latency. Specify 'auto' to choose from the size
+            of the file. Striped files are never compressed, and the
+            number of streams is limited by the concurrent transfers
+            that the server allows.
+            Default: 1 (i.e. no striping).
+
+            keep_alive (bool): Keep the connection open between transfers,
+            i.e. one connection carries many transfers, which avoids a new
+            handshake for every transmit. Every transfer ends with a marker
+            that the server acknowledges once all files are written. Call
+            disconnect, or use the client as a context manager, to close
+            the connection.
+            Default: False.
+
+            retries (int): Number of times a transfer is retried on a new
+            connection when the connection is lost, waiting a little longer
+            before every retry. Large files continue from where the server
+            stopped writing them instead of starting over. Content from
+            iterators or unseekable files can only be sent once, so such
+            transfers aren't retried once it has been read.
+            Default: 0.
+
+            pack (bool): Pack small files together into large frames,
+            instead of sending every file on its own. The server writes
+            the packed files in parallel, which makes transfers of folders
+            with many small files, e.g. source trees, much faster.
+            Default: False.
+
+            dedup (bool): Ask the server if it already holds the content
+            of every file by its hash, before the file is sent. Files the
+            server holds are linked on the server instead, such that
+            duplicated content is never sent. Requires a server with a
+            blob store, and costs reading every file an extra time.
+            Default: False.
+
+            verify (bool): Hash every file while it is sent, with xxh3 if
+            the xxhash package is installed on both sides, else blake2b.
+            The server verifies every file against the hash before it is
+            moved into place, and acknowledges every file. Files failing
+            verification are marked as failed in the result. Hashing costs
+            throughput on fast links, on loopback a 256 MiB file went from
+            834 MB/s to 503 MB/s with xxh3 and 169 MB/s with blake2b.
+            Default: False.
+
+            tune (bool): Probe the link to the server once, before the
+            first transfer, and tune the socket buffer, the chunk size and
+            the number of streams chosen by 'auto' for it, see 'ping'.
+            Settings given explicitly are kept. The probe takes a few
+            round trips and bursts of up to 64 MiB, which only pays off
+            for large transfers, and costs on metered links.
+            Default: False.
+
+            socket_buffer (int): Size of the send and receive buffers of
+            the sockets, in bytes.
+            Default: None (i.e. tuned, or left to the operating system).
+
+            chunk_size (int): Size of the chunks that compressed content is
+            sent in, in bytes.
+            Default: None (i.e. tuned, else 64 KiB).
+
+            read_ahead (int): Read the content of upcoming files into
+            buffers of this many bytes in total on a thread of its own,
+            while the files before them are sent, such that reading and
+            sending overlap. Files larger than this are sent with sendfile
+            instead, and compressed files are read as they are compressed.
+            Specify 0 to read every file as it is sent.
+            Default: 4 MiB.
+
+            rate_limit (int): Limit the bytes per second sent by the
+            client, over all its transfers and connections. A TokenBucket
+            can be given instead, which is shared by every client given
+            it, e.g. to limit all transfers over the same uplink.
+            Default: None (i.e. unlimited).
+
+            priority (int): Share of the server's bandwidth that the
+            transfers of the client get, relative to those of other
+            clients, when the server limits it. From 1 to 16.
+            Default: 1.
         """
         self.is_async = is_async
         self.timeout = timeout
         self.host = host
         self.port = port
+        self.server_options = None
+        self.streams = streams
+        self.compression = compression
+        self.compression_level = compression_level
+        self.keep_alive = keep_alive
+        self.retries = retries
+        self.pack = pack
+        self.dedup = dedup
+        self.verify = verify
+        self.tune = tune
+        self.socket_buffer = socket_buffer
+        self.chunk_size = chunk_size
+        # The probed link to the server, and the settings in use, i.e.
+        # the ones given or the ones tuned for the link.
+        self.link = None
+        self.buffer = socket_buffer
+        self.send_chunk = chunk_size or CHUNK_SIZE
+        self.stream_limit = MAX_STREAMS
+        self.read_ahead = read_ahead
+        self.priority = priority
+        # Buckets that the transfer in progress takes from, i.e. the
+        # bucket of the client and the bucket of the transfer.
+        self.bucket = (TokenBucket(rate_limit)
+                if isinstance(rate_limit, (int, float)) else rate_limit)
+        self.buckets = list()
+        # Buffers that files are read ahead into, allocated when needed.
+        self.pool = None
+        # Hash algorithm negotiated with the server, or None.
+        self.algorithm = None
+        # Result of the transfer in progress, which acknowledgements
+        # of the server are recorded in.
+        self.result = None
+        # Counters and histograms of all transfers, and the seconds
+        # spent in the stages of the transfer in progress.
+        self.metrics = Metrics()
+        self.timings = dict()
+        # Process pool hashing files when syncing by checksum.
+        self.hashers = None
+        # Transfers on the same connection are sent one at a time.
+        self.lock = Lock()
+        # Codecs negotiated with the server for the last transfer.
+        self.codecs = list()
+
+        if self.compression not in (None, 'auto', 'zlib', 'lzma', 'zstd'):
+            raise ValueError("Compression specified on the wrong format, " \
+                    "should be 'auto', 'zlib', 'lzma' or 'zstd'.")
+
+        if self.streams != 'auto' and (not isinstance(self.streams, int)
+                or self.streams < 1):
+            raise ValueError("Streams specified on the wrong format, " \
+                    "should be 'auto' or a positive int.")
 
         if not isinstance(self.host, str):
             raise TypeError("Host specified on the wrong format, " \
@@ -87,6 +252,25 @@ class Client():
             raise TypeError("Timeout specified on the wrong format, " \
                     "should be an int or a float, i.e. 7 or 7.7")
 
+        if not isinstance(self.read_ahead, int) or self.read_ahead < 0:
+            raise ValueError("Read ahead specified on the wrong format, " \
+                    "should be an int of at least 0.")
+
+        if not isinstance(self.bucket, (type(None), TokenBucket)):
+            raise TypeError("Rate limit specified on the wrong format, " \
+                    "should be bytes per second or a TokenBucket.")
+
+        if (not isinstance(self.priority, int)
+                or not 1 <= self.priority <= MAX_PRIORITY):
+            raise ValueError("Priority specified on the wrong format, " \
+                    "should be an int from 1 to {}.".format(MAX_PRIORITY))
+
+        for name in ('socket_buffer', 'chunk_size'):
+            value = getattr(self, name)
+            if value is not None and (not isinstance(value, int) or value < 1):
+                raise ValueError("{} specified on the wrong format, " \
+                        "should be a positive int.".format(name))
+
         # Connect to the socket
         self._connect()
 
@@ -94,121 +278,1107 @@ class Client():
         self.sock = socket.socket(
             socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(self.timeout)
+        if self.buffer:
+            tuning.set_buffers(self.sock, self.buffer)
+
         self.sock.connect((self.host, self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server_options = None
 
     def _disconnect(self):
         """
         Disconnects the socket in the client.
         """
-        self.sock.close()
+        if self.sock:
+            self.sock.close()
+
         self.sock = None
+        self.server_options = None
+
+    def disconnect(self):
+        """
+        Close the connection to the server. A new connection
+        is made on the next transfer.
+        """
+        with self.lock:
+            self._disconnect()
+            if self.hashers:
+                self.hashers.shutdown()
+                self.hashers = None
+
+    def __enter__(self):
+        return self
 
-    def ping(self):
+    def __exit__(self, *exc_info):
+        self.disconnect()
+
+    def add_hook(self, hook):
+        """
+        Register a function that is called as hook(event, data) with
+        every 'transfer' of the client, including the 'result'.
         """
-        TODO
+        self.metrics.add_hook(hook)
+
+    def ping(self, count = PROBE_PINGS, max_burst = PROBE_MAX):
         """
-        raise NotImplementedError
+        Probe the link to the server. A number of round trips are timed,
+        and bursts of growing size are sent until a burst takes long
+        enough for its bandwidth to be measured. Unless 'tune' is False,
+        the client is tuned for the link, see '_apply_link'.
+
+        Params:
+            count (int): Number of round trips to time.
+            Default: 5.
+
+            max_burst (int): The largest burst to send, which limits
+            the bytes that a probe costs.
+            Default: 64 MiB.
+
+        Returns:
+            A Link with the shortest round trip time in seconds, and
+            the bandwidth in bytes per second.
+        """
+        with self.lock:
+            try:
+                if not self.sock:
+                    self._connect()
+
+                if self.server_options is None:
+                    self._handshake()
 
-    def transmit(self, item_name):
+                if not self.server_options.get('probe'):
+                    raise ProtocolError("Server doesn't answer probes.")
+
+                self.link = self._probe(count, max_burst)
+
+            except BaseException:
+                self._disconnect()
+                raise
+
+            if self.tune:
+                self._apply_link()
+
+            if not self.keep_alive:
+                self._disconnect()
+
+            return self.link
+
+    def transmit(self, item_name, sync = False, checksum = False,
+            delta = False, resume = False, rate_limit = None,
+            remote_path = None):
         """
         Transmit a single file or folder. In case of folder,
         all folders and files included in the parent folder
         will be sent, excluding .dotfiles.
 
+        Content in memory is sent as a file on 'remote_path' instead,
+        streamed as it is read without a temporary file: bytes and
+        memoryviews as they are, readable binary file objects chunk by
+        chunk, or with sendfile when they are regular files, and
+        iterators of chunks one data frame per chunk.
+
         Params:
             item_name (str): The file or folder to be sent
-            to the server.
+            to the server, or the content to send, i.e. bytes, a
+            memoryview, a binary file object or an iterator of bytes.
+
+            sync (bool): Only send the files that are missing or
+            stale on the server. A manifest of all files is sent first,
+            and the server answers with the files it needs, which means
+            that re-sending a folder where few files changed is fast.
+            Default: False.
+
+            checksum (bool): When syncing, compare files by content
+            instead of by size and modification time. Slower, since
+            both sides need to read every file.
+            Default: False.
+
+            delta (bool): Send large files as a delta against the copy
+            the server already has, i.e. only the changed parts of the
+            file are sent. Useful together with sync for large files that
+            change slightly, e.g. databases.
+            Default: False.
+
+            resume (bool): Continue large files from where an earlier,
+            interrupted transfer of them stopped. The server keeps
+            the partial files together with a record of the progress.
+            Default: False.
+
+            rate_limit (int): Limit the bytes per second of this transfer,
+            within the limit of the client.
+            Default: None (i.e. unlimited).
+
+            remote_path (str): Where content sent from memory is saved,
+            relative to the default path of the server, e.g.
+            'reports/today.csv'. Content that can't be rewound, i.e.
+            iterators and unseekable files, isn't retried.
+            Default: None.
+
+        Returns:
+            A TransferResult with the number of bytes sent, the duration
+            and the status of every file. None if 'is_async' is used.
         """
-        parent_path = pathlib.Path(item_name).absolute()
+        if not isinstance(item_name, (str, os.PathLike)):
+            if not remote_path:
+                raise ValueError("Specify the remote path to send the " \
+                        "content to.")
 
-        transmit_data = list()
+            if sync or delta or resume:
+                raise ValueError("Content sent from memory can't be " \
+                        "synced, sent as a delta or resumed.")
 
-        # Need to create new socket for each sendall,
-        # otherwise connection won't close server side.
-        if not self.sock:
-            self._connect()
+            remote_path = pathlib.PurePath(remote_path).as_posix()
+            if remote_path.startswith('/') or '..' in remote_path.split('/'):
+                raise ValueError("Remote path should be relative to the " \
+                        "default path of the server.")
 
-        # Handle single file transfer.
-        if parent_path.is_file() and str(parent_path.stem)[0] != '.':
-            item = Item()
-            item.mtime = parent_path.stat().st_mtime
-            item.path = parent_path.name
-            item.type_ = "file"
-            item.size = parent_path.stat().st_size
-            item.suffix = parent_path.suffix
-            with open(str(parent_path), 'rb') as f:
-                item.content = f.read()
-
-            transmit_data.append(item)
-
-
-        # Handle folder with it's contents.
-        elif parent_path.is_dir():
-
-            # Add parent folder first:
-            item = Item()
-            item.path = parent_path.stem
-            item.type_ = "folder"
-            transmit_data.append(item)
-
-            # Iterate over all subfolders- and files
-            for sub_item in parent_path.rglob("*"):
-                item = Item()
-                child_path = parent_path.stem / sub_item.relative_to(parent_path)
-                item.path = child_path
-                # If folder
-                if sub_item.is_dir():
-                    item.type_ = "folder"
-                    transmit_data.append(item)
-
-                # If file
-                elif sub_item.is_file() and str(sub_item.stem)[0] != '.':
-                    item.type_ = "file"
-                    item.name = child_path.name
-                    item.size = child_path.stat().st_size
-                    with open(str(sub_item), 'rb') as f:
-                        item.content = f.read()
-
-                    transmit_data.append(item)
+            parent_path = None
+            transmit_data = iter([stream_item(item_name, remote_path)])
 
         else:
-            raise FileNotFoundError(
-                    errno.ENOENT, os.strerror(errno.ENOENT), item_name)
+            parent_path = pathlib.Path(item_name).absolute()
+
+            # The folder is scanned while it is sent.
+            transmit_data = iter_items(parent_path)
+            if transmit_data is None:
+                raise FileNotFoundError(
+                        errno.ENOENT, os.strerror(errno.ENOENT), item_name)
 
         # Data can be sent in a separate thread in order to avoid
         # blocking the main thread. This is optional.
         if self.is_async:
             client_thread = Thread(target = self._transmit_file, args =
-            (transmit_data, parent_path))
+            (transmit_data, parent_path, sync, checksum, delta, resume,
+                rate_limit))
             client_thread.start()
 
         else:
-            self._transmit_file(transmit_data, parent_path)
+            return self._transmit_file(transmit_data, parent_path,
+                    sync, checksum, delta, resume, rate_limit)
+
+    def watch(self, item_name, debounce = watcher.DEBOUNCE,
+            max_delay = watcher.MAX_DELAY, interval = watcher.POLL_INTERVAL,
+            checksum = False, callback = None, stop = None):
+        """
+        Keep a folder mirrored on the server. The folder is synced once,
+        and every file that is written or moved into the folder after
+        that is sent, over a single connection kept alive between the
+        transfers. Files removed from the folder are kept on the server.
+
+        Changes are detected with inotify where available, so an idle
+        folder costs nothing, otherwise the folder is scanned every
+        'interval' seconds. Changes arriving close together are
+        coalesced into a single transfer.
 
+        Params:
+            item_name (str): The folder to watch.
+
+            debounce (float): Seconds without changes before the
+            changes so far are sent.
+            Default: 0.2.
+
+            max_delay (float): The longest a change waits to be sent
+            while changes keep arriving.
+            Default: 2.0.
 
+            interval (float): Seconds between scans, when inotify isn't
+            available.
+            Default: 1.0.
+
+            checksum (bool): Compare files by content in the first sync.
+            Default: False.
 
-    def _transmit_file(self, transmit_data, parent_path):
+            callback (callable): Called with the TransferResult of every
+            transfer, including the first sync.
+            Default: None.
+
+            stop (Event): Stop watching once set.
+            Default: None (i.e. watch until interrupted).
+        """
+        parent_path = pathlib.Path(item_name).absolute()
+        if not parent_path.is_dir():
+            raise NotADirectoryError(
+                    errno.ENOTDIR, os.strerror(errno.ENOTDIR), item_name)
+
+        # The connection is kept alive while watching only.
+        keep_alive = self.keep_alive
+        self.keep_alive = True
+        changes = None
+        try:
+            # Watching starts before the first sync, such that files
+            # changed while syncing are sent afterwards.
+            changes = watcher.open_watcher(parent_path, interval)
+            result = self.transmit(item_name, sync = True, checksum = checksum)
+            if callback:
+                callback(result)
+
+            # Changed paths not yet sent, and whether events were lost,
+            # in which case the whole folder is synced instead.
+            pending = set()
+            rescan = False
+            while not (stop and stop.is_set()):
+                changed = watcher.collect(changes, debounce, max_delay)
+                if changed is watcher.RESCAN:
+                    rescan = True
+
+                else:
+                    pending |= changed
+
+                if not pending and not rescan:
+                    continue
+
+                if rescan:
+                    transmit_data = iter_items(parent_path) or iter(())
+
+                else:
+                    transmit_data = iter(watcher.changed_items(parent_path,
+                        pending))
+
+                try:
+                    result = self._transmit_file(transmit_data, parent_path,
+                            sync = rescan)
+
+                except (OSError, ProtocolError) as e:
+                    # E.g. the server restarting, the files are sent
+                    # with the next changes.
+                    print("Failed to send changes: {}".format(e))
+                    time.sleep(interval)
+                    continue
+
+                pending = set()
+                rescan = False
+                if callback:
+                    callback(result)
+
+        finally:
+            if changes:
+                changes.close()
+
+            self.keep_alive = keep_alive
+            self.disconnect()
+
+    def _transmit_file(self, transmit_data, parent_path, sync = False,
+            checksum = False, delta = False, resume = False, rate_limit = None):
         """
         This method works on a separate thread, meaning
         the transmission of data doesn't occupy the main
         thread, making this non-blocking. As soon as the
         items has been sent, current thread will be closed.
         Params:
-            transmit_data (list): The list with objects
+            transmit_data (iterator): The items to send,
             coming from method 'transmit'.
 
             parent_path (Path): A path to the folder/file
             that were sent. Used purely for visual purposes
             so we can print that the folder/files has been sent.
+            None when sending from memory.
+
+            sync (bool): Exchange a manifest first and only send
+            the files that the server wants.
+
+            checksum (bool): Include hashes in the manifest.
+
+            delta (bool): Send large files as deltas.
+
+            resume (bool): Continue large files from where an
+            interrupted transfer stopped.
+
+            rate_limit (int): Bytes per second of the transfer.
+        """
+        with self.lock:
+            result = TransferResult()
+            start = time.perf_counter()
+            # A kept alive connection might have been closed by the
+            # server while idle, in which case the transfer is retried
+            # at once on a new connection.
+            reused = self.server_options is not None
+            attempt = 0
+            # Items generated so far, which a retry starts over with.
+            seen = list()
+            # Seconds spent exchanging manifests and hashes with the
+            # server, sending content, and waiting for the server to
+            # finish writing at the end.
+            self.timings = dict(exchange_seconds = 0.0, send_seconds = 0.0,
+                    wait_seconds = 0.0)
+            self.buckets = [bucket for bucket in (self.bucket,
+                TokenBucket(rate_limit) if rate_limit else None) if bucket]
+            while True:
+                try:
+                    self._transmit_locked(self._replay(transmit_data, seen),
+                            sync, checksum, delta, resume, result)
+                    if isinstance(self.sock, ShapedSocket):
+                        self.sock = self.sock.sock
+
+                    break
+
+                except ConnectionRefusedError:
+                    self._disconnect()
+                    raise
+
+                except (OSError, ProtocolError):
+                    self._disconnect()
+                    # Content from memory that was already read, e.g. from
+                    # an iterator or a pipe, can't be sent again, in which
+                    # case the transfer fails with the original error.
+                    if not all(item.stream is None
+                            or item.stream.replayable() for item in seen):
+                        raise
+
+                    if reused:
+                        reused = False
+
+                    elif attempt < self.retries:
+                        attempt += 1
+                        self.metrics.add('retries')
+                        time.sleep(min(2**attempt, 30))
+
+                    else:
+                        raise
+
+                    # Large files continue from what the server has written.
+                    resume = True
+
+                except BaseException:
+                    # The state of the connection is unknown after a failure.
+                    self._disconnect()
+                    raise
+
+            result.duration = time.perf_counter() - start
+            statuses = list(result.files.values())
+            self.metrics.record_transfer(statuses.count('sent'),
+                    result.bytes_sent, result.duration, result = result,
+                    failed = sum(status.startswith('failed')
+                        for status in statuses),
+                    retries = attempt, **self.timings)
+
+            if not result.ok:
+                failed = [(path, status) for path, status
+                        in result.files.items() if status.startswith('failed')]
+                print("Failed to send {} of {} files:".format(len(failed),
+                    len(result.files)))
+                for path, status in failed:
+                    print("  {}: {}".format(path, status[len('failed: '):]))
+
+            elif parent_path is None:
+                print("Successfully sent stream: {}".format(
+                    ', '.join(result.files)))
+
+            elif parent_path.is_dir():
+                print("Successfully sent folder: {}".format(parent_path.name))
+
+            elif parent_path.is_file():
+                print("Successfully sent file: {}".format(parent_path.name))
+
+            if not self.keep_alive:
+                self._disconnect()
+
+            return result
+
+    def _transmit_locked(self, transmit_data, sync, checksum, delta, resume,
+            result):
+        """
+        Send a single transfer on the connection, making a
+        new connection and handshake first if needed.
+        """
+        # A new connection is made unless the previous one is kept
+        # alive, and the handshake is only done once per connection.
+        if not self.sock:
+            self._connect()
+
+        if self.server_options is None:
+            self._handshake()
+
+        if self.tune and not self.link and self.server_options.get('probe'):
+            self.link = self._probe(PROBE_PINGS, PROBE_MAX)
+            self._apply_link()
+
+        # Content is paced by the buckets, while the handshake and probe
+        # before it aren't.
+        if self.buckets:
+            self.sock = ShapedSocket(self.sock, self.buckets)
+
+        self.result = result
+        sent = 0
+
+        # Small files collected into the next pack, and its size.
+        pack = list()
+        pack_size = PACK_INDEX.size + 1
+        limit = self.server_options.get('max_frame_size', MAX_FRAME_SIZE)
+
+        # Items are sent in batches as they are scanned, and each
+        # batch is synced with the server before it is sent.
+        batches = iter(lambda: list(itertools.islice(transmit_data,
+            MANIFEST_BATCH)), [])
+        for batch in batches:
+            started = time.perf_counter()
+            if sync:
+                batch = self._exchange_manifest(batch, checksum, result)
+
+            if self.dedup and self.server_options.get('store'):
+                batch = self._exchange_hashes(batch, result)
+
+            if resume:
+                self._query_offsets(batch)
+
+            sending = time.perf_counter()
+            self.timings['exchange_seconds'] += sending - started
+            reader = self._reader(batch, delta)
+            try:
+                for item, state in reader.items():
+                    # Acknowledgements are read now and then, such that the
+                    # server never blocks on sending them.
+                    sent += 1
+                    if self.algorithm and sent % ACK_INTERVAL == 0:
+                        self._read_acks()
+
+                    if item.stream:
+                        result.bytes_sent += self._send_stream(item)
+                        result.files[item.to_dict()['path']] = 'sent'
+                        continue
+
+                    try:
+                        if isinstance(state, OSError):
+                            raise state
+
+                        f = (open(str(item.source), 'rb')
+                                if item.type_ == "file" and not state else None)
+
+                    except OSError as e:
+                        # Files that can't be read are skipped, the rest of
+                        # the transfer continues.
+                        result.files[item.to_dict()['path']] = 'failed: {}'.format(e)
+                        continue
+
+                    # Left over from an earlier attempt of the transfer.
+                    item.delta = item.stripes = None
+
+                    if ((f or state) and self.pack and item.size < PACK_THRESHOLD
+                            and not item.offset):
+                        if state:
+                            data, digest = self._take(reader)
+                            if reader.error:
+                                result.files[item.to_dict()['path']] = \
+                                        'failed: {}'.format(reader.error)
+                                continue
+
+                        else:
+                            with f:
+                                data = f.read()
+
+                            digest = None
+                            if self.algorithm:
+                                checker = integrity.new(self.algorithm)
+                                checker.update(data)
+                                digest = checker.hexdigest()
+
+                        if len(data) >= PACK_THRESHOLD:
+                            raise OSError("File {} changed size while being " \
+                                    "sent.".format(item.source))
+
+                        path = item.to_dict()['path']
+                        entry = encode_json([path, len(data), item.mtime, digest])
+                        if pack and pack_size + len(entry) + 1 + len(data) > limit:
+                            self._send_pack(pack)
+                            pack = list()
+                            pack_size = PACK_INDEX.size + 1
+
+                        pack.append((entry, data))
+                        pack_size += len(entry) + 1 + len(data)
+                        result.bytes_sent += len(data)
+                        result.files[path] = 'sent'
+                        continue
+
+                    streams = self._stream_count(item.size) if f else 1
+                    if state:
+                        sent_bytes = self._send_read_ahead(item, reader)
+                        if sent_bytes is None:
+                            # Changed while being read, the rest of the
+                            # transfer continues.
+                            result.files[item.to_dict()['path']] = \
+                                    'failed: {}'.format(reader.error)
+                            continue
+
+                        result.bytes_sent += sent_bytes
+
+                    elif f and item.offset:
+                        result.bytes_sent += self._send_item(item, f)
+
+                    elif f and delta and item.size >= DELTA_THRESHOLD:
+                        result.bytes_sent += self._send_delta(item, f)
+
+                    elif streams > 1:
+                        result.bytes_sent += self._send_striped(item, f, streams)
+
+                    else:
+                        result.bytes_sent += self._send_item(item, f)
+
+                    if f or state:
+                        result.files[item.to_dict()['path']] = 'sent'
+
+            finally:
+                reader.close()
+
+            self.timings['send_seconds'] += time.perf_counter() - sending
+
+        started = time.perf_counter()
+        if pack:
+            self._send_pack(pack)
+
+        send_frame(self.sock, END)
+        summary = self._recv_reply(END)
+        self.timings['wait_seconds'] += time.perf_counter() - started
+        for path, error in summary.get('failed', []):
+            result.files[path] = 'failed: {}'.format(error)
+
+    def _handshake(self):
+        """
+        Offer the codecs and hash algorithms of the client, and
+        keep the options that the server answers with.
+        """
+        send_frame(self.sock, HEADER, encode_header(
+            codecs = compress.available() if self.compression else [],
+            verify = integrity.available() if self.verify else [],
+            priority = self.priority))
+        self.server_options = expect_header(self.sock)
+        self.codecs = self.server_options.get('codecs', [])
+        self.algorithm = self.server_options.get('verify')
+
+    def _probe(self, count, max_burst):
+        """
+        Time 'count' round trips, and bursts of growing size until a
+        burst takes long enough to measure, see 'ping'.
+        """
+        rtts = list()
+        for _ in range(count):
+            started = time.perf_counter()
+            send_frame(self.sock, PING)
+            self._recv_reply(PING)
+            rtts.append(time.perf_counter() - started)
+
+        rtt = min(rtts)
+        zeros = memoryview(bytes(PROBE_MIN))
+        burst = PROBE_MIN
+        while True:
+            started = time.perf_counter()
+            self.sock.sendall(FRAME.pack(PROBE, burst))
+            for _ in range(burst // PROBE_MIN):
+                self.sock.sendall(zeros)
+
+            self._recv_reply(PROBE)
+            elapsed = time.perf_counter() - started
+            if elapsed >= max(PROBE_TIME, 4 * rtt) or burst * 4 > max_burst:
+                break
+
+            burst *= 4
+
+        # A burst takes a round trip more than sending it takes.
+        link = Link(rtt, burst / max(elapsed - rtt, elapsed / 2))
+        self.metrics.set('rtt_seconds', link.rtt)
+        self.metrics.set('bandwidth', link.bandwidth)
+        self.metrics.emit('probe', **link.to_dict())
+        return link
+
+    def _apply_link(self):
+        """
+        Tune the client for the probed link, except for the settings given
+        explicitly. The socket buffer is set to hold twice the bandwidth-
+        delay product where the kernel doesn't grow it that far by itself,
+        compressed content is sent in larger chunks on faster links, and
+        'auto' stripes files over as many streams as it takes to fill
+        the link with the buffer that every stream has.
+        """
+        if not self.socket_buffer:
+            self.buffer = self.link.socket_buffer()
+            if self.buffer:
+                tuning.set_buffers(self.sock, self.buffer)
+
+        if not self.chunk_size:
+            self.send_chunk = self.link.chunk_size()
+
+        capacity = None if self.buffer else tuning.autotune_limit('wmem')
+        self.stream_limit = self.link.streams(capacity or self.sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF))
+
+    def _reader(self, batch, delta):
+        """
+        Start the reader stage for a batch of items, see ReadAhead. Small
+        and medium files are read ahead, while large files, and files
+        that are compressed, resumed, sent as deltas or striped, are
+        read as they are sent.
+        """
+        def eligible(item):
+            return (item.type_ == "file" and not item.stream
+                    and item.size <= self.read_ahead
+                    and not item.offset
+                    and (not self.compression or (self.pack
+                        and item.size < PACK_THRESHOLD))
+                    and not (delta and item.size >= DELTA_THRESHOLD)
+                    and self._stream_count(item.size) == 1)
+
+        if self.read_ahead and not self.pool:
+            self.pool = BufferPool(self.read_ahead // BUFFER_SIZE, BUFFER_SIZE)
+
+        return ReadAhead(batch, self.pool, eligible if self.read_ahead
+                else lambda item: False, self.algorithm)
+
+    def _take(self, reader):
+        """
+        Take the content of a small file that was read ahead.
+
+        Returns:
+            The content and its hash.
+        """
+        parts = list()
+        for buffer, length in reader.chunks():
+            parts.append(bytes(buffer[:length]))
+            self.pool.put(buffer)
+
+        return b''.join(parts), reader.digest
+
+    def _send_read_ahead(self, item, reader):
+        """
+        Send a file that the reader stage read ahead, chunk by chunk as
+        the reader fills the buffers, followed by the hash that the
+        reader computed. Small chunks are sent together with the frames
+        around them, such that a small file costs a single send.
+
+        Returns:
+            The number of content bytes sent, or None if the file changed
+            while being read, see ReadAhead.
+        """
+        parts = [pack_frame(ITEM, encode_json(item.to_dict())),
+                FRAME.pack(DATA, item.size)]
+        sent = 0
+        # Whether the item frame has been sent, i.e. the file has to be
+        # discarded by the server if it fails.
+        started = False
+        for buffer, length in reader.chunks():
+            try:
+                if length < CHUNK_SIZE:
+                    parts.append(bytes(buffer[:length]))
+
+                else:
+                    self.sock.sendall(b''.join(parts))
+                    parts = list()
+                    started = True
+                    with memoryview(buffer) as view:
+                        self.sock.sendall(view[:length])
+
+            finally:
+                self.pool.put(buffer)
+
+            sent += length
+
+        if reader.error:
+            if started:
+                # The data frame is completed, and the server told to
+                # discard the file, such that the connection goes on.
+                self.sock.sendall(bytes(item.size - sent))
+                send_frame(self.sock, ERROR, str(reader.error).encode('utf-8'))
+
+            return None
+
+        if reader.digest:
+            parts.append(pack_frame(CHECK, reader.digest.encode('ascii')))
+
+        parts.append(pack_frame(EOF))
+        self.sock.sendall(b''.join(parts))
+        return sent
+
+    def _recv_reply(self, expected, max_size = MAX_FRAME_SIZE):
+        """
+        Receive the reply of the server to a request, recording the
+        acknowledgements of files that arrive before it.
+
+        Returns:
+            The payload of the reply, decoded unless it is a signature.
+        """
+        while True:
+            frame = recv_frame(self.sock, max_size)
+            if frame is None:
+                raise ProtocolError("Connection closed by the server.")
+
+            if frame[0] == ACK:
+                self._acknowledge(frame[1])
+
+            elif frame[0] != expected:
+                raise ProtocolError("Unexpected frame type {} from the " \
+                        "server.".format(frame[0]))
+
+            elif expected == SIGNATURE:
+                return frame[1]
+
+            else:
+                return decode_json(frame[1]) if frame[1] else dict()
+
+    def _read_acks(self):
+        """
+        Read the acknowledgements that the server has sent so far,
+        without blocking.
+        """
+        while select.select([self.sock], [], [], 0)[0]:
+            frame = recv_frame(self.sock)
+            if frame is None or frame[0] != ACK:
+                raise ProtocolError("Expected acknowledgement.")
+
+            self._acknowledge(frame[1])
+
+    def _acknowledge(self, payload):
+        path, error = decode_json(payload)
+        if error:
+            self.result.files[path] = 'failed: {}'.format(error)
+
+    @staticmethod
+    def _send_check(sock, hasher):
+        """
+        Send the hash of the content just sent, when verifying.
+        """
+        if hasher:
+            send_frame(sock, CHECK, hasher.hexdigest().encode('ascii'))
+
+    @staticmethod
+    def _replay(items, seen):
+        """
+        Generate the items that an earlier attempt of the transfer already
+        generated, followed by the rest of 'items', adding those to 'seen'.
+        """
+        for item in list(seen):
+            yield item
+
+        for item in items:
+            seen.append(item)
+            yield item
+
+    def _send_pack(self, pack):
+        """
+        Send small files packed together as a single frame, i.e. the
+        index of the files followed by their content.
+
+        Params:
+            pack (list): The encoded index entry and the content
+            of every file.
+        """
+        index = b'[' + b','.join(entry for entry, _ in pack) + b']'
+        send_frame(self.sock, PACK, b''.join([PACK_INDEX.pack(len(index)), index]
+            + [data for _, data in pack]))
+
+    def _query_offsets(self, transmit_data):
         """
-        self.sock.sendall(pickle.dumps(transmit_data))
+        Ask the server how much of every large file it holds from an
+        interrupted transfer, such that those files continue from there.
+        """
+        files = [item for item in transmit_data if item.type_ == "file"
+                and not item.stream and item.size >= RESUME_THRESHOLD]
+        for start in range(0, len(files), MANIFEST_BATCH):
+            batch = files[start:start + MANIFEST_BATCH]
+            send_frame(self.sock, RESUME, encode_json([[item.to_dict()['path'],
+                item.size, item.mtime] for item in batch]))
+            offsets = self._recv_reply(RESUME)
+            for item, offset in zip(batch, offsets):
+                item.offset = offset
+
+    def _exchange_manifest(self, transmit_data, checksum, result):
+        """
+        Send the manifest of all files in batches, and collect the
+        files that the server answers that it is missing or holds stale.
+        Files that are up to date are marked as unchanged in the result.
+
+        Returns:
+            The items to send, i.e. all folders and the wanted files.
+        """
+        files = [item for item in transmit_data if item.type_ == "file"]
+        wanted = set()
+        for start in range(0, len(files), MANIFEST_BATCH):
+            batch = files[start:start + MANIFEST_BATCH]
+            entries = build_manifest(batch, checksum,
+                    self._hashers() if checksum else None)
+            for item, entry in zip(batch, entries):
+                item.digest = entry[3]
+
+            send_frame(self.sock, MANIFEST, encode_json(entries))
+            wanted.update(id(batch[index]) for index in self._recv_reply(WANT))
+
+        for item in files:
+            if id(item) not in wanted:
+                result.files[item.to_dict()['path']] = 'unchanged'
+
+        return [item for item in transmit_data
+                if item.type_ != "file" or id(item) in wanted]
+
+    def _exchange_hashes(self, transmit_data, result):
+        """
+        Send the hashes of the large files, and collect the files that
+        the server linked to content it already holds. Those files are
+        marked as deduplicated in the result.
+
+        Returns:
+            The items to send, i.e. all items but the linked files.
+        """
+        files = [item for item in transmit_data if item.type_ == "file"
+                and not item.stream and item.size >= DEDUP_THRESHOLD]
+        missing = [item for item in files if item.digest is None]
+        for item, entry in zip(missing, build_manifest(missing, True,
+                self._hashers())):
+            item.digest = entry[3]
+
+        # Hashes are long, so fewer entries are sent in every frame.
+        linked = set()
+        step = MANIFEST_BATCH // 4
+        for start in range(0, len(files), step):
+            batch = files[start:start + step]
+            send_frame(self.sock, HAVE, encode_json([[item.to_dict()['path'],
+                item.size, item.mtime, item.digest] for item in batch]))
+            linked.update(id(batch[index]) for index in self._recv_reply(HAVE))
+
+        for item in files:
+            if id(item) in linked:
+                result.files[item.to_dict()['path']] = 'deduplicated'
+
+        return [item for item in transmit_data if id(item) not in linked]
+
+    def _hashers(self):
+        """
+        The process pool that hashes large files, started when needed.
+        """
+        if not self.hashers:
+            # Imported when needed, since it is slow to import.
+            from concurrent.futures import ProcessPoolExecutor
+            self.hashers = ProcessPoolExecutor()
+
+        return self.hashers
+
+    def _send_delta(self, item, f):
+        """
+        Send a file as a delta against the copy that the server already
+        has. The server answers with the block signature of its copy,
+        and the file is sent as literal data and references to the
+        blocks that the server has. Files that the server doesn't have
+        are sent in full. Returns the number of content bytes sent.
+        """
+        send_frame(self.sock, SIGREQ, encode_json(item.to_dict()['path']))
+        block_size, blocks = decode_signature(self._recv_reply(SIGNATURE, 2**27))
+        if not blocks:
+            return self._send_item(item, f)
+
+        item.delta = block_size
+        send_frame(self.sock, ITEM, encode_json(item.to_dict()))
+        sent = 0
+        hasher = integrity.new(self.algorithm) if self.algorithm else None
+        with f:
+            if hasher:
+                integrity.update_from_file(hasher, f, 0,
+                        os.fstat(f.fileno()).st_size)
+
+            for op in iter_delta(item.source, item.size, block_size, blocks):
+                if op[0] == 'data':
+                    length = op[2] - op[1]
+                    self.sock.sendall(FRAME.pack(DATA, length))
+                    if self.sock.sendfile(f, op[1], length) != length:
+                        raise OSError("File {} changed size while being " \
+                                "sent.".format(item.source))
+
+                    sent += length
+
+                else:
+                    send_frame(self.sock, COPY, COPY_BLOCKS.pack(op[1], op[2]))
+
+        self._send_check(self.sock, hasher)
+        send_frame(self.sock, EOF)
+        return sent
+
+    def _send_stream(self, item):
+        """
+        Send an item whose content is read from memory, see Stream. Content
+        of a known size is sent as a single data frame, with sendfile when
+        it is a regular file, while content of an unknown size is sent as
+        a data frame per chunk. Returns the number of content bytes sent.
+        """
+        stream = item.stream
+        hasher = integrity.new(self.algorithm) if self.algorithm else None
+        send_frame(self.sock, ITEM, encode_json(item.to_dict()))
+        if stream.size is not None:
+            self.sock.sendall(FRAME.pack(DATA, stream.size))
+
+        f = stream.regular_file()
+        if f:
+            sent = integrity.send_hashed(self.sock, f, hasher, stream.start,
+                    stream.size)
+
+        else:
+            sent = 0
+            for chunk in stream.chunks(BUFFER_SIZE):
+                if stream.size is None:
+                    self.sock.sendall(FRAME.pack(DATA, len(chunk)))
+
+                elif sent + len(chunk) > stream.size:
+                    break
+
+                if hasher:
+                    hasher.update(chunk)
+
+                self.sock.sendall(chunk)
+                sent += len(chunk)
+
+        if stream.size is not None and sent != stream.size:
+            raise OSError("Stream {} changed size while being sent.".format(
+                item.path))
+
+        self._send_check(self.sock, hasher)
+        send_frame(self.sock, EOF)
+        return sent
+
+    def _stream_count(self, size):
+        """
+        Number of connections to stripe a file of 'size' bytes over.
+        """
+        if self.streams == 'auto':
+            streams = min(self.stream_limit, size // STRIPE_SIZE)
+
+        else:
+            streams = min(self.streams, max(1, size // STRIPE_SIZE))
+
+        # Leave at least one of the server's workers for other clients.
+        max_transfers = self.server_options.get('max_transfers', 1)
+        return max(1, min(streams, max_transfers - 1))
+
+    def _send_striped(self, item, f, streams):
+        """
+        Send a large file as byte ranges over parallel connections. The
+        first range is sent over the main connection while the others
+        are sent over extra connections, each on its own thread. Ranges
+        that can't be sent over an extra connection, e.g. since the server
+        is busy, are sent over the main connection afterwards.
+        Returns the number of content bytes sent.
+        """
+        item.stripes = streams
+        send_frame(self.sock, ITEM, encode_json(item.to_dict()))
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            step = -(-size // streams)
+            ranges = [(offset, min(step, size - offset))
+                    for offset in range(0, size, step)]
+
+            failed = list()
+            threads = [Thread(target = self._send_stripe,
+                args = (item, size, offset, length, failed))
+                for offset, length in ranges[1:]]
+            for thread in threads:
+                thread.start()
+
+            for offset, length in ranges[:1]:
+                self._send_range(self.sock, item, f, size, offset, length,
+                        self.algorithm)
+
+            for thread in threads:
+                thread.join()
+
+            for offset, length in failed:
+                self._send_range(self.sock, item, f, size, offset, length,
+                        self.algorithm)
+
+        send_frame(self.sock, EOF)
+        return size
+
+    def _send_stripe(self, item, size, offset, length, failed):
+        """
+        Send a single byte range over an extra connection. The range
+        is added to 'failed' if it couldn't be sent.
+        """
+        try:
+            sock = socket.create_connection((self.host, self.port),
+                    timeout = STRIPE_TIMEOUT)
+            if self.buffer:
+                tuning.set_buffers(sock, self.buffer)
+
+        except OSError:
+            failed.append((offset, length))
+            return
+
+        try:
+            with sock, open(str(item.source), 'rb') as f:
+                send_frame(sock, HEADER, encode_header(stripe = True,
+                    verify = integrity.available() if self.verify else [],
+                    priority = self.priority))
+                options = expect_header(sock)
+                sock.settimeout(self.timeout)
+                self._send_range(ShapedSocket(sock, self.buckets)
+                        if self.buckets else sock, item, f, size, offset,
+                        length, options.get('verify'))
+                send_frame(sock, END)
+                expect_end(sock)
+
+        except (OSError, ProtocolError):
+            failed.append((offset, length))
+
+    def _send_range(self, sock, item, f, size, offset, length, algorithm):
+        """
+        Send a single byte range of a striped file, followed by its
+        hash when 'algorithm' is negotiated.
+        """
+        send_frame(sock, RANGE, encode_json({'path': item.to_dict()['path'],
+            'size': size, 'offset': offset, 'length': length}))
+        hasher = integrity.new(algorithm) if algorithm else None
+        sock.sendall(FRAME.pack(DATA, length))
+        if integrity.send_hashed(sock, f, hasher, offset, length) != length:
+            raise OSError("File {} changed size while being sent.".format(
+                item.source))
+
+        self._send_check(sock, hasher)
+
+    def _send_item(self, item, f):
+        """
+        Send the metadata of a single item followed by its content.
+        The content is sent as a single data frame using sendfile, such
+        that the file is copied to the socket by the kernel without
+        passing through user space. Compressed content is instead
+        sent in chunks as it is compressed. When verifying, the content
+        is hashed as it is sent, and the hash follows the content.
+        Returns the number of content bytes sent.
+        """
+        hasher = None
+        if f and self.algorithm:
+            # A resumed file is verified as a whole, so the part that
+            # the server already holds is hashed first.
+            hasher = integrity.new(self.algorithm)
+            integrity.update_from_file(hasher, f, 0, item.offset)
+
+        if f and item.offset:
+            f.seek(item.offset)
+
+        if f and self.compression:
+            # The codec is chosen from the suffix and a sample,
+            # which is the first chunk of the file.
+            sample = f.read(CHUNK_SIZE)
+            item.codec = compress.choose(self.compression, self.codecs,
+                    item.suffix, sample)
+            if not item.codec:
+                f.seek(item.offset)
+
+        send_frame(self.sock, ITEM, encode_json(item.to_dict()))
+        if not f:
+            return 0
+
+        if item.codec:
+            sent = 0
+            with f:
+                for chunk in compress.iter_compressed(f, sample, item.codec,
+                        self.compression_level, self.send_chunk, hasher):
+                    send_frame(self.sock, DATA, chunk)
+                    sent += len(chunk)
+
+            self._send_check(self.sock, hasher)
+            send_frame(self.sock, EOF)
+            return sent
 
-        if parent_path.is_dir():
-            print("Successfully sent folder: {}".format(parent_path.name))
+        with f:
+            size = max(os.fstat(f.fileno()).st_size - item.offset, 0)
+            self.sock.sendall(FRAME.pack(DATA, size))
+            sent = integrity.send_hashed(self.sock, f, hasher, item.offset, size)
 
-        elif parent_path.is_file():
-            print("Successfully sent file: {}".format(parent_path.name))
+        if sent != size:
+            raise OSError("File {} changed size while being sent.".format(
+                item.source))
 
-        # Disconnect from server when data has been sent.
-        # Needed in order to save the files server side.
-        self._disconnect()
+        self._send_check(self.sock, hasher)
+        send_frame(self.sock, EOF)
+        return sent
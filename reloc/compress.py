@@ -0,0 +1,200 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import lzma
+import zlib
+
+# Suffixes of formats that already are compressed, these
+# are never compressed again.
+INCOMPRESSIBLE = {
+    '.7z', '.aac', '.apk', '.avi', '.br', '.bz2', '.docx', '.flac',
+    '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg', '.lz4', '.m4a',
+    '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.png', '.pptx', '.rar',
+    '.tgz', '.webm', '.webp', '.whl', '.xlsx', '.xz', '.zip', '.zst',
+}
+
+# Codecs in order of preference when the codec is chosen automatically.
+PREFERENCE = ('zstd', 'zlib')
+
+# Default compression level of each codec.
+LEVELS = {'zstd': 3, 'zlib': 6, 'lzma': 6}
+
+# Content is only compressed if a sample shrinks to at most this ratio.
+MAX_RATIO = 0.9
+
+# The largest piece of output produced when decompressing at once,
+# which protects the receiving side against decompression bombs.
+MAX_OUTPUT = 2**18
+
+
+def _zstd():
+    """
+    Zstandard is optional, it is used when the zstandard package is installed.
+    """
+    try:
+        import zstandard
+        return zstandard
+
+    except ImportError:
+        return None
+
+
+def available():
+    """
+    Returns:
+        The codecs available on this side of the connection.
+    """
+    codecs = ['zlib', 'lzma']
+    if _zstd():
+        codecs.insert(0, 'zstd')
+
+    return codecs
+
+
+def negotiate(offered):
+    """
+    Returns:
+        The codecs that are available on both sides, given the
+        codecs offered by the peer.
+    """
+    return [codec for codec in available() if codec in (offered or ())]
+
+
+def choose(requested, codecs, suffix, sample):
+    """
+    Choose the codec for a single file.
+
+    Params:
+        requested (str): The codec requested by the user, or 'auto'.
+
+        codecs (list): The codecs negotiated with the server.
+
+        suffix (str): The suffix of the file.
+
+        sample (bytes): The first chunk of the file.
+
+    Returns:
+        The codec to use, or None if the file is sent uncompressed.
+    """
+    if not requested or not sample:
+        return None
+
+    if suffix and suffix.lower() in INCOMPRESSIBLE:
+        return None
+
+    if requested == 'auto':
+        requested = next((codec for codec in PREFERENCE if codec in codecs), None)
+
+    if requested not in codecs:
+        return None
+
+    # Compressing the sample with the fastest setting is a cheap
+    # way to detect content that doesn't compress, e.g. random data.
+    if len(zlib.compress(sample, 1)) > MAX_RATIO * len(sample):
+        return None
+
+    return requested
+
+
+class Encoder():
+    """
+    Streaming compression of the content of a single file.
+    """
+    def __init__(self, codec, level = None):
+        if level is None:
+            level = LEVELS[codec]
+
+        if codec == 'zlib':
+            self.obj = zlib.compressobj(level)
+
+        elif codec == 'lzma':
+            self.obj = lzma.LZMACompressor(preset = level)
+
+        elif codec == 'zstd':
+            self.obj = _zstd().ZstdCompressor(level = level).compressobj()
+
+        else:
+            raise ValueError("Unknown compression codec {}.".format(codec))
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class Decoder():
+    """
+    Streaming decompression of the content of a single file. Output
+    is produced in pieces of bounded size where the codec supports it.
+    """
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == 'zlib':
+            self.obj = zlib.decompressobj()
+
+        elif codec == 'lzma':
+            self.obj = lzma.LZMADecompressor()
+
+        elif codec == 'zstd':
+            zstandard = _zstd()
+            if not zstandard:
+                raise ValueError("Codec zstd is not available.")
+
+            self.obj = zstandard.ZstdDecompressor().decompressobj()
+
+        else:
+            raise ValueError("Unknown compression codec {}.".format(codec))
+
+    def decompress(self, data):
+        """
+        Generates the decompressed pieces of a chunk of compressed data.
+        """
+        if self.codec == 'zlib':
+            out = self.obj.decompress(data, MAX_OUTPUT)
+            yield out
+            while self.obj.unconsumed_tail:
+                yield self.obj.decompress(self.obj.unconsumed_tail, MAX_OUTPUT)
+
+        elif self.codec == 'lzma':
+            yield self.obj.decompress(bytes(data), MAX_OUTPUT)
+            while not self.obj.needs_input and not self.obj.eof:
+                yield self.obj.decompress(b'', MAX_OUTPUT)
+
+        else:
+            yield self.obj.decompress(bytes(data))
+
+    def flush(self):
+        if self.codec == 'zlib':
+            return self.obj.flush()
+
+        return b''
+
+
+def iter_compressed(f, sample, codec, level = None, chunk_size = 2**16,
+        hasher = None):
+    """
+    Read the rest of an opened file in chunks and generate the
+    compressed content, starting with the already read sample.
+    The uncompressed content is hashed with 'hasher', if given.
+    """
+    encoder = Encoder(codec, level)
+    chunk = sample
+    while chunk:
+        if hasher:
+            hasher.update(chunk)
+
+        out = encoder.compress(chunk)
+        if out:
+            yield out
+
+        chunk = f.read(chunk_size)
+
+    out = encoder.flush()
+    if out:
+        yield out
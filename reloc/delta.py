@@ -0,0 +1,229 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import hashlib
+import mmap
+import struct
+import zlib
+
+# Files smaller than this are always sent in full.
+DELTA_THRESHOLD = 2**20
+
+# Number of offsets the rolling checksum is computed for at once.
+SEGMENT = 2**20
+
+# Modulus of the adler-32 checksum.
+ADLER_MOD = 65521
+
+# Size of the table used to quickly filter out offsets that can't match.
+FILTER_BITS = 20
+
+SIGNATURE = struct.Struct('!II')
+COPY = struct.Struct('!QQ')
+
+
+def _numpy():
+    """
+    Numpy is optional and only imported when needed, since importing
+    it is slow. Without numpy, only blocks at aligned offsets are
+    matched, which handles files modified in place but not insertions.
+    """
+    try:
+        import numpy
+        return numpy
+
+    except ImportError:
+        return None
+
+
+def block_size_for(size):
+    """
+    Choose the block size for a file, such that there are
+    at most around 16k blocks.
+    """
+    block_size = 2**12
+    while block_size < 2**20 and size // block_size > 2**14:
+        block_size *= 2
+
+    return block_size
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size = 16).digest()
+
+
+def signature(path, size):
+    """
+    Compute the block signature of a file, i.e. the adler-32 and a
+    strong hash of every full block. Both are computed in C for a
+    whole block at a time.
+
+    Returns:
+        The signature encoded as [block_size][count][weak...][strong...].
+    """
+    block_size = block_size_for(size)
+    weak = list()
+    strong = list()
+    with open(str(path), 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                break
+
+            weak.append(zlib.adler32(block))
+            strong.append(strong_hash(block))
+
+    return (SIGNATURE.pack(block_size, len(weak))
+            + struct.pack('!{}I'.format(len(weak)), *weak) + b''.join(strong))
+
+
+def decode_signature(payload):
+    """
+    Returns:
+        The block size and a dict mapping every weak checksum to a list
+        of (strong hash, block index) for the blocks having it.
+    """
+    block_size, count = SIGNATURE.unpack_from(payload)
+    offset = SIGNATURE.size
+    weak = struct.unpack_from('!{}I'.format(count), payload, offset)
+    offset += 4 * count
+    blocks = dict()
+    for index, checksum in enumerate(weak):
+        strong = bytes(payload[offset + 16 * index:offset + 16 * (index + 1)])
+        blocks.setdefault(checksum, list()).append((strong, index))
+
+    return block_size, blocks
+
+
+def _rolling_candidates(np, data, start, stop, block_size, weak):
+    """
+    Vectorized rolling adler-32 of every block starting at an offset
+    in [start, stop), computed from prefix sums instead of a loop
+    over the bytes.
+
+    Params:
+        weak (tuple): The sorted weak checksums of the server's blocks,
+        and a table with the filter keys of the checksums set.
+
+    Returns:
+        The offsets whose checksum is one of the weak checksums.
+    """
+    count = stop - start
+    x = np.frombuffer(data, dtype = np.uint8, count = count + block_size - 1,
+            offset = start).astype(np.int64)
+    prefix = np.zeros(len(x) + 1, dtype = np.int64)
+    np.cumsum(x, out = prefix[1:])
+    x *= np.arange(len(x), dtype = np.int64)
+    weighted = np.zeros(len(x) + 1, dtype = np.int64)
+    np.cumsum(x, out = weighted[1:])
+
+    total = prefix[block_size:block_size + count] - prefix[:count]
+    b = np.arange(block_size, block_size + count, dtype = np.int64)
+    b *= total
+    b -= weighted[block_size:block_size + count] - weighted[:count]
+    b += block_size
+    b %= ADLER_MOD
+    total += 1
+    total %= ADLER_MOD
+
+    # Look up every offset in the filter table first, and only search
+    # the sorted checksums for the few offsets passing the filter.
+    weak, table = weak
+    offsets = np.nonzero(table[_filter_key(b, total)])[0]
+    checksums = (b[offsets] << 16) | total[offsets]
+    found = np.minimum(np.searchsorted(weak, checksums), len(weak) - 1)
+    return (offsets[weak[found] == checksums] + start).tolist()
+
+
+def _filter_key(b, a):
+    return (a + b * 31) & ((1 << FILTER_BITS) - 1)
+
+
+def _candidates(data, size, block_size, blocks):
+    """
+    Generate the offsets that might start a matching block, in order.
+    """
+    np = _numpy()
+    last = size - block_size + 1
+    if np is None:
+        for offset in range(0, last, block_size):
+            yield offset
+
+        return
+
+    weak = np.sort(np.fromiter(blocks.keys(), dtype = np.int64, count = len(blocks)))
+    table = np.zeros(1 << FILTER_BITS, dtype = bool)
+    table[_filter_key(weak >> 16, weak & 0xffff)] = True
+    weak = (weak, table)
+    for start in range(0, last, SEGMENT):
+        for offset in _rolling_candidates(np, data, start,
+                min(start + SEGMENT, last), block_size, weak):
+            yield offset
+
+
+def delta(path, size, block_size, blocks):
+    """
+    Compare a file with the signature of the server's copy.
+
+    Generates:
+        ('data', start, stop) for literal data that must be sent, and
+        ('copy', index, count) for blocks the server already has.
+    """
+    if size < block_size or not blocks:
+        if size:
+            yield ('data', 0, size)
+
+        return
+
+    with open(str(path), 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        size = len(data)
+        try:
+            pos = 0
+            copy = None
+            for offset in _candidates(data, size, block_size, blocks):
+                if offset < pos:
+                    continue
+
+                block = data[offset:offset + block_size]
+                matches = blocks.get(zlib.adler32(block))
+                if not matches:
+                    continue
+
+                digest = strong_hash(block)
+                index = next((i for strong, i in matches if strong == digest), None)
+                if index is None:
+                    continue
+
+                if offset > pos:
+                    if copy:
+                        yield ('copy',) + copy
+                        copy = None
+
+                    yield ('data', pos, offset)
+
+                # Merge references to consecutive blocks.
+                if copy and copy[0] + copy[1] == index:
+                    copy = (copy[0], copy[1] + 1)
+
+                else:
+                    if copy:
+                        yield ('copy',) + copy
+
+                    copy = (index, 1)
+
+                pos = offset + block_size
+
+            if copy:
+                yield ('copy',) + copy
+
+            if pos < size:
+                yield ('data', pos, size)
+
+        finally:
+            data.close()
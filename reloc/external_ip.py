@@ -0,0 +1,120 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import http.client
+import json
+import os
+import pathlib
+import time
+import urllib.request
+from threading import Thread
+
+# Services answering with the external ipv4 and ipv6 of the caller.
+SERVICES = {
+    'ipv4': 'https://api.ipify.org',
+    'ipv6': 'https://api6.ipify.org',
+}
+
+# Seconds that a looked up ip is reused for, and the timeout of a lookup.
+CACHE_TTL = 3600
+LOOKUP_TIMEOUT = 5
+
+
+def cache_path():
+    """
+    Returns:
+        The file that the last looked up ips are kept in.
+    """
+    root = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(root) / 'reloc' / 'external_ip.json'
+
+
+def _read_cache(ttl):
+    try:
+        with open(str(cache_path())) as f:
+            cached = json.load(f)
+
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(cached, dict) or time.time() - cached.get('time', 0) > ttl:
+        return None
+
+    return cached.get('ips')
+
+
+def _write_cache(ips):
+    path = cache_path()
+    temp = path.with_name(path.name + '.tmp')
+    try:
+        os.makedirs(str(path.parent), exist_ok = True)
+        with open(str(temp), 'w') as f:
+            json.dump({'time': time.time(), 'ips': ips}, f)
+
+        os.replace(str(temp), str(path))
+
+    except OSError:
+        # The cache only saves a lookup, a failure to write it is fine.
+        pass
+
+
+def _fetch(url, timeout):
+    try:
+        with urllib.request.urlopen(url, timeout = timeout) as response:
+            return response.read().decode().strip()
+
+    except (OSError, ValueError, http.client.HTTPException):
+        # E.g. no connection, a timeout or an error status, all of
+        # which are URLError, i.e. OSError.
+        return None
+
+
+def lookup(ttl = CACHE_TTL, timeout = LOOKUP_TIMEOUT):
+    """
+    Look up the external ipv4 and ipv6, both at once. The ips are read
+    from the cache if looked up less than 'ttl' seconds ago.
+
+    Returns:
+        A dict with the 'ipv4' and 'ipv6', either of which is None
+        if it couldn't be looked up.
+    """
+    ips = _read_cache(ttl)
+    if ips:
+        return ips
+
+    ips = dict.fromkeys(SERVICES)
+
+    def fetch(version):
+        ips[version] = _fetch(SERVICES[version], timeout)
+
+    threads = [Thread(target = fetch, args = (version,), daemon = True)
+            for version in SERVICES]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if any(ips.values()):
+        _write_cache(ips)
+
+    return ips
+
+
+def lookup_async(callback, ttl = CACHE_TTL, timeout = LOOKUP_TIMEOUT):
+    """
+    Look up the external ips on a background thread, and call
+    'callback' with them once known, see 'lookup'.
+
+    Returns:
+        The background thread.
+    """
+    thread = Thread(target = lambda: callback(lookup(ttl, timeout)),
+            daemon = True)
+    thread.start()
+    return thread
@@ -0,0 +1,514 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import queue
+import socket
+from threading import Thread
+
+# Package imports
+from .protocol import (HEADER, END, ACK, BUFFER_SIZE, MAX_FRAME_SIZE,
+        ProtocolError, pack_frame, recv_frame, encode_json, decode_json,
+        encode_header, check_header)
+from .util import TransferResult
+from .client import Client
+from . import compress, integrity
+
+# Number of chunks queued for every peer. A slow peer holds back the
+# others once this many chunks are waiting for it. The chunks are shared
+# by all peers, so the memory used doesn't grow with the number of peers.
+QUEUE_SIZE = 64
+
+# Size of the chunks that files are read in, once for all peers.
+READ_SIZE = BUFFER_SIZE
+
+
+def parse_target(target):
+    """
+    Returns:
+        The (host, port) of a target given as 'host:port' or as a tuple.
+    """
+    if isinstance(target, str):
+        host, _, port = target.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError("Target specified on the wrong format, " \
+                    "should be 'host:port', i.e. '192.168.1.7:1750'.")
+
+        return host, int(port)
+
+    host, port = target
+    return host, port
+
+
+def build_tree(targets, fanout = None):
+    """
+    Arrange the targets in a relay tree, where the client sends to the
+    first 'fanout' targets and every target relays to 'fanout' more,
+    in the order given. A fanout of 1 is a pipeline.
+
+    Returns:
+        The nodes that the client sends to, each a dict with the 'host',
+        'port' and the nodes it relays to as 'relay'.
+    """
+    nodes = [{'host': host, 'port': port, 'relay': []}
+            for host, port in map(parse_target, targets)]
+    if not fanout:
+        return nodes
+
+    for index in range(fanout, len(nodes)):
+        nodes[index // fanout - 1]['relay'].append(nodes[index])
+
+    return nodes[:fanout]
+
+
+def combine(answers, codecs, verify, max_frame_size):
+    """
+    Combine the options that every peer answered the header with, such
+    that a single stream suits all of them, i.e. the codecs they all have
+    and the smallest frame size. Hashes are sent if any peer verifies.
+    """
+    for options in answers:
+        codecs = [codec for codec in codecs if codec in options.get('codecs', [])]
+        verify = verify or options.get('verify')
+        max_frame_size = min(max_frame_size,
+                options.get('max_frame_size', MAX_FRAME_SIZE))
+
+    return codecs, verify, max_frame_size
+
+
+class Peer():
+    """
+    Connection to a single server that a stream is copied to. Everything
+    sent is queued and sent on a thread of its own, such that all peers
+    are sent to concurrently, and the replies are read on another thread,
+    such that the server never blocks on acknowledging files.
+
+    Methods:
+        handshake: Send the header and wait for the answer.
+
+        put: Queue data to be sent.
+
+        end: Wait for the end of a transfer to be acknowledged.
+
+        fail: Mark the peer as failed, such that it is skipped.
+
+        close: Close the connection.
+
+        _send: Private method sending the queued data.
+
+        _receive: Private method reading the replies.
+
+        _reply: Private method to wait for the next reply.
+    """
+    def __init__(self, host, port, timeout = None):
+        self.address = '{}:{}'.format(host, port)
+        self.sock = socket.create_connection((host, port), timeout = timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.options = None
+        # The first error of the connection, after which the peer is
+        # skipped, and the [path, reason] of files that failed.
+        self.error = None
+        self.failed = list()
+        self.queue = queue.Queue(maxsize = QUEUE_SIZE)
+        self.replies = queue.Queue()
+        self.sender = Thread(target = self._send, daemon = True)
+        self.sender.start()
+        Thread(target = self._receive, daemon = True).start()
+
+    def fail(self, error):
+        if not self.error:
+            self.error = error
+            # Wakes up the reader, which can't get a reply anymore.
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+
+            except OSError:
+                pass
+
+    def _send(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+
+            # The queue is drained after a failure, such that
+            # the data put for other peers never blocks.
+            if self.error:
+                continue
+
+            try:
+                self.sock.sendall(data)
+
+            except OSError as e:
+                self.fail(e)
+
+    def _receive(self):
+        try:
+            while True:
+                frame = recv_frame(self.sock)
+                if frame is None:
+                    raise ProtocolError("Connection closed by {}.".format(
+                        self.address))
+
+                if frame[0] == ACK and self.options is not None:
+                    path, error = decode_json(frame[1])
+                    if error:
+                        self.failed.append([path, error])
+
+                else:
+                    self.replies.put(frame)
+
+        except (OSError, ProtocolError) as e:
+            self.fail(e)
+            self.replies.put(None)
+
+    def _reply(self):
+        # Replies that arrived before a failure are still returned.
+        try:
+            frame = self.replies.get(block = self.error is None)
+
+        except queue.Empty:
+            frame = None
+
+        if frame is None:
+            raise self.error
+
+        return frame
+
+    def put(self, data):
+        if not self.error:
+            self.queue.put(data)
+
+    def handshake(self, **options):
+        """
+        Returns:
+            The options that the server answered the header with.
+        """
+        self.put(pack_frame(HEADER, encode_header(**options)))
+        frame = self._reply()
+
+        self.options = check_header(frame)
+        return self.options
+
+    def end(self):
+        """
+        Wait for the server to acknowledge the end of a transfer.
+
+        Returns:
+            The summary of the transfer, with the files that failed
+            verification added to its 'failed'.
+        """
+        frame = self._reply()
+        if frame[0] != END:
+            raise ProtocolError("Unexpected frame type {} from {}.".format(
+                frame[0], self.address))
+
+        summary = decode_json(frame[1]) if frame[1] else dict()
+        # Every acknowledgement is read before the end of the transfer.
+        summary['failed'] = summary.get('failed', []) + self.failed
+        self.failed = list()
+        return summary
+
+    def close(self):
+        self.fail(ConnectionAbortedError("Connection closed."))
+        self.queue.put(None)
+        self.sender.join()
+        self.sock.close()
+
+
+class Tee():
+    """
+    Socket-like object that copies everything sent to many peers. Files
+    are read once, in chunks that are shared by the queues of all peers,
+    instead of being sent with sendfile once per peer. Peers that fail
+    are skipped, the others continue.
+
+    Methods:
+        sendall: Send data to every peer.
+
+        sendfile: Send a range of a file to every peer.
+
+        settimeout: Does nothing, the timeout is set on every peer.
+
+        close: Close every peer.
+    """
+    def __init__(self, peers):
+        self.peers = peers
+
+    def sendall(self, data):
+        # The data might be a view of a buffer that is reused.
+        data = bytes(data)
+        for peer in self.peers:
+            peer.put(data)
+
+    def sendfile(self, file, offset = 0, count = None):
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            chunk = file.read(READ_SIZE if count is None
+                    else min(READ_SIZE, count - sent))
+            if not chunk:
+                break
+
+            self.sendall(chunk)
+            sent += len(chunk)
+
+        return sent
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        for peer in self.peers:
+            peer.close()
+
+
+class Relay():
+    """
+    Forwards the transfers of a connection to downstream servers as they
+    arrive, see the 'relay' param of Server. The downstream servers are
+    given by the client as nodes of a relay tree, see 'build_tree', and
+    each of them relays on to its own part of the tree.
+
+    Methods:
+        negotiate: Combine the options of the server with those of the
+        downstream servers.
+
+        send: Forward a frame, or a part of one.
+
+        finish: Add the summaries of the downstream servers to the
+        end of a transfer.
+
+        close: Close the connections to the downstream servers.
+    """
+    def __init__(self, nodes, options, timeout = None):
+        self.peers = list()
+        # Maps the address of every node that couldn't be reached to
+        # the reason, which is reported to the client.
+        self.unreached = dict()
+        for node in nodes:
+            address = '{}:{}'.format(node['host'], node['port'])
+            try:
+                peer = Peer(node['host'], node['port'], timeout)
+
+            except OSError as e:
+                self.unreached[address] = {'error': str(e)}
+                continue
+
+            try:
+                peer.handshake(codecs = options.get('codecs'),
+                        verify = options.get('verify'),
+                        relay = node.get('relay', []))
+
+            except (OSError, ProtocolError) as e:
+                peer.close()
+                self.unreached[address] = {'error': str(e)}
+                continue
+
+            self.peers.append(peer)
+
+        self.tee = Tee(self.peers)
+
+    def negotiate(self, codecs, verify, max_frame_size):
+        return combine([peer.options for peer in self.peers], codecs,
+                verify, max_frame_size)
+
+    def send(self, data):
+        self.tee.sendall(data)
+
+    def finish(self, reply):
+        """
+        Wait for the downstream servers to finish the transfer, and add
+        their summaries to the summary of this server as 'relayed'.
+        """
+        frame_type, payload = reply
+        summary = decode_json(payload)
+        relayed = dict(self.unreached)
+        for peer in self.peers:
+            try:
+                relayed[peer.address] = peer.end()
+
+            except (OSError, ProtocolError) as e:
+                relayed[peer.address] = {'error': str(e)}
+
+        summary['relayed'] = relayed
+        return frame_type, encode_json(summary)
+
+    def close(self):
+        self.tee.close()
+
+
+class FanoutClient(Client):
+    """
+    Client sending the same files to many servers at once. Every file is
+    read once and streamed to all servers concurrently, and servers can
+    relay the stream on to other servers as it arrives, such that the
+    time to reach a fleet grows with the depth of the relay tree rather
+    than with the number of servers.
+
+    Files are sent as a single stream, so the options that need a
+    reply from every server, i.e. sync, delta, resume, dedup and
+    striping, aren't available.
+
+    Methods:
+        transmit: Send a folder/file to every server.
+
+        _connect: Private method to connect to the servers that the
+        client sends to, i.e. the top of the relay tree.
+
+        _handshake: Private method to send the header to every server
+        and combine their answers.
+
+        _recv_reply: Private method to wait for every server to
+        acknowledge the end of a transfer.
+
+        _read_acks: Private method that does nothing, every peer
+        reads its acknowledgements on its own thread.
+
+        _results: Private method to split the result per server.
+    """
+    def __init__(self, targets, fanout = None, timeout = None,
+            compression = None, compression_level = None, keep_alive = False,
+            pack = False, verify = False, rate_limit = None, priority = 1):
+        """
+        Params:
+            targets (list): The servers to send to, as 'host:port'
+            or as (host, port).
+
+            fanout (int): Send to this many servers, and let every server
+            relay to this many more, i.e. a tree of relays. Specify 1 to
+            relay through the servers as a pipeline. The servers must be
+            started with relaying enabled. Servers that can't be reached
+            are reported as failed, together with the servers below them.
+            Default: None (i.e. send to every server directly).
+
+            timeout, compression, compression_level, keep_alive, pack,
+            verify, rate_limit, priority: See Client. The codecs used are those that every server
+            has. When verifying, the first hash algorithm available here
+            is offered, and servers without it don't verify.
+        """
+        if fanout is not None and (not isinstance(fanout, int) or fanout < 1):
+            raise ValueError("Fanout specified on the wrong format, " \
+                    "should be a positive int.")
+
+        if not targets:
+            raise ValueError("Specify at least one target.")
+
+        self.tree = build_tree(targets, fanout)
+        self.targets = ['{}:{}'.format(*parse_target(target))
+                for target in targets]
+
+        self.peers = list()
+        # Maps the address of every server to its summary of the last
+        # transfer, or to the reason it failed.
+        self.summaries = dict()
+        self.errors = dict()
+        super().__init__(self.tree[0]['host'], self.tree[0]['port'],
+                timeout = timeout, compression = compression,
+                compression_level = compression_level,
+                keep_alive = keep_alive, pack = pack, verify = verify,
+                tune = False, rate_limit = rate_limit, priority = priority)
+
+    def _connect(self):
+        self.peers = list()
+        self.errors = dict()
+        for node in self.tree:
+            try:
+                self.peers.append((Peer(node['host'], node['port'],
+                    self.timeout), node))
+
+            except OSError as e:
+                self.errors['{}:{}'.format(node['host'], node['port'])] = str(e)
+
+        if not self.peers:
+            raise ConnectionRefusedError("No server could be reached: {}".format(
+                '; '.join(self.errors.values())))
+
+        self.sock = Tee([peer for peer, _ in self.peers])
+        self.server_options = None
+
+    def _handshake(self):
+        answers = list()
+        for peer, node in self.peers:
+            try:
+                answers.append(peer.handshake(
+                    codecs = compress.available() if self.compression else [],
+                    verify = integrity.available()[:1] if self.verify else [],
+                    relay = node['relay'], priority = self.priority))
+
+            except (OSError, ProtocolError) as e:
+                peer.fail(e)
+
+        if not answers:
+            raise ConnectionRefusedError("No server accepted the connection.")
+
+        self.codecs, self.algorithm, max_frame_size = combine(answers,
+                compress.available() if self.compression else [], None,
+                MAX_FRAME_SIZE)
+        self.server_options = {'max_transfers': 1, 'store': False,
+                'max_frame_size': max_frame_size, 'codecs': self.codecs,
+                'verify': self.algorithm}
+
+    def _recv_reply(self, expected, max_size = MAX_FRAME_SIZE):
+        self.summaries = dict()
+        for peer, _ in self.peers:
+            try:
+                self.summaries[peer.address] = peer.end()
+
+            except (OSError, ProtocolError) as e:
+                self.errors[peer.address] = str(e)
+
+        if not self.summaries:
+            raise ConnectionResetError("Every server failed: {}".format(
+                '; '.join(self.errors.values())))
+
+        return dict()
+
+    def _read_acks(self):
+        pass
+
+    def transmit(self, item_name, rate_limit = None, remote_path = None):
+        """
+        Transmit a single file or folder, or content in memory, to every
+        server, see Client.transmit. The rate limit applies to the content
+        sent to each server.
+
+        Returns:
+            A dict mapping the 'host:port' of every server to its
+            TransferResult, i.e. the status of every file on that server.
+        """
+        return self._results(super().transmit(item_name,
+            rate_limit = rate_limit, remote_path = remote_path))
+
+    def _results(self, result):
+        summaries = dict()
+        pending = list(self.summaries.items())
+        while pending:
+            address, summary = pending.pop()
+            summaries[address] = summary
+            pending.extend(summary.get('relayed', dict()).items())
+
+        results = dict()
+        for address in self.targets:
+            summary = summaries.get(address, dict())
+            error = summary.get('error', self.errors.get(address))
+            if not summary and not error:
+                error = "Not reached, relaying might be disabled upstream."
+
+            target = TransferResult()
+            target.bytes_sent = result.bytes_sent
+            target.duration = result.duration
+            for path, status in result.files.items():
+                target.files[path] = ('failed: {}'.format(error)
+                        if error and status == 'sent' else status)
+
+            for path, reason in summary.get('failed', []):
+                target.files[path] = 'failed: {}'.format(reason)
+
+            results[address] = target
+
+        return results
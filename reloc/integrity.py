@@ -0,0 +1,114 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import hashlib
+import mmap
+
+# Hash algorithms in order of preference. xxh3 is an order of magnitude
+# faster than blake2b, which is used when xxhash isn't installed.
+PREFERENCE = ('xxh3_128', 'blake2b')
+
+# Size of the pieces that a file is hashed and sent in.
+HASH_CHUNK = 2**22
+
+
+def _xxhash():
+    """
+    Xxhash is optional, it is used when the xxhash package is installed.
+    """
+    try:
+        import xxhash
+        return xxhash
+
+    except ImportError:
+        return None
+
+
+def available():
+    """
+    Returns:
+        The hash algorithms available on this side of the connection.
+    """
+    if _xxhash():
+        return list(PREFERENCE)
+
+    return ['blake2b']
+
+
+def negotiate(offered):
+    """
+    Returns:
+        The preferred hash algorithm of those offered by the peer that
+        is available on this side, or None.
+    """
+    return next((name for name in available() if name in (offered or ())), None)
+
+
+def new(algorithm):
+    """
+    Returns:
+        A new hash object of the algorithm.
+    """
+    if algorithm == 'xxh3_128':
+        return _xxhash().xxh3_128()
+
+    elif algorithm == 'blake2b':
+        return hashlib.blake2b()
+
+    raise ValueError("Unknown hash algorithm {}.".format(algorithm))
+
+
+def update_from_file(hasher, f, start, stop):
+    """
+    Hash a range of an opened file. The file is mapped, such that the
+    content is hashed straight from the page cache without being copied.
+    """
+    if stop <= start:
+        return
+
+    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            for offset in range(start, stop, HASH_CHUNK):
+                hasher.update(view[offset:min(offset + HASH_CHUNK, stop)])
+
+        finally:
+            view.release()
+
+
+def send_hashed(sock, f, hasher, offset, length):
+    """
+    Send a range of an opened file with sendfile, while hashing it. Every
+    piece is hashed from the mapped file right before it is sent, while
+    it is in the page cache, so the file is only read from disk once.
+
+    Returns:
+        The number of bytes sent.
+    """
+    if not hasher or not length:
+        return sock.sendfile(f, offset, length) if length else 0
+
+    sent = 0
+    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            while sent < length:
+                with view[offset + sent:offset + min(sent + HASH_CHUNK,
+                        length)] as piece:
+                    size = len(piece)
+                    hasher.update(piece)
+
+                count = sock.sendfile(f, offset + sent, size) if size else 0
+                sent += count
+                if not size or count < size:
+                    break
+
+        finally:
+            view.release()
+
+    return sent
@@ -0,0 +1,135 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import atexit
+import datetime
+import logging
+import os
+import pathlib
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+
+# Folder that the logs are written to, one file per day.
+LOG_FOLDER = 'logs'
+
+# Size of the buffer of the open log file. Records are flushed in
+# batches, whenever the queue of records runs empty.
+LOG_BUFFER = 2**16
+
+FORMAT = '%(asctime)s : %(levelname)s: %(name)s : %(message)s'
+
+_lock = Lock()
+_listener = None
+_handler = None
+
+
+class DailyFileHandler(logging.StreamHandler):
+    """
+    Writes records to a file named by the date of the record, e.g.
+    logs/2020-06-01.log, and moves on to a new file when the date
+    changes. Records are written without flushing, the listener
+    flushes them in batches.
+    """
+    def __init__(self, folder = LOG_FOLDER):
+        super().__init__()
+        self.folder = pathlib.Path(folder)
+        self.date = None
+        self.stream = None
+
+    def emit(self, record):
+        try:
+            date = datetime.date.fromtimestamp(record.created)
+            if date != self.date:
+                self._open(date)
+
+            self.stream.write(self.format(record) + self.terminator)
+
+        except Exception:
+            self.handleError(record)
+
+    def _open(self, date):
+        if self.stream:
+            self.stream.close()
+
+        os.makedirs(self.folder, exist_ok = True)
+        self.stream = open(self.folder / '{}.log'.format(date), 'a',
+                buffering = LOG_BUFFER, encoding = 'utf-8')
+        self.date = date
+
+    def close(self):
+        with self.lock:
+            try:
+                if self.stream:
+                    self.stream.close()
+
+            finally:
+                self.stream = None
+                logging.Handler.close(self)
+
+
+class _QueueHandler(QueueHandler):
+    """
+    Only merges the message with its arguments before a record is queued,
+    the rest of the formatting is left to the listener.
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # The traceback can only be formatted while it is alive.
+            record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+class _BatchListener(QueueListener):
+    """
+    Flushes the handlers whenever the queue runs empty, such that a burst
+    of records is written with a single flush.
+    """
+    def dequeue(self, block):
+        try:
+            return self.queue.get(block = False)
+
+        except queue.Empty:
+            if not block:
+                raise
+
+        for handler in self.handlers:
+            handler.flush()
+
+        return self.queue.get(block = True)
+
+
+def get_logger(name = 'reloc.server', folder = LOG_FOLDER):
+    """
+    Get a logger whose records are only queued by the calling thread, and
+    written to the daily log files by a background thread. The background
+    thread is started once per process and stopped at exit.
+    """
+    global _listener, _handler
+    logger = logging.getLogger(name)
+    with _lock:
+        if not _listener:
+            records = queue.SimpleQueue()
+            handler = DailyFileHandler(folder)
+            handler.setFormatter(logging.Formatter(FORMAT))
+            _listener = _BatchListener(records, handler)
+            _listener.start()
+            atexit.register(_listener.stop)
+            _handler = _QueueHandler(records)
+
+        if _handler not in logger.handlers:
+            logger.setLevel(logging.INFO)
+            logger.addHandler(_handler)
+            logger.propagate = False
+
+    return logger
@@ -0,0 +1,341 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import json
+import math
+import sys
+import time
+from threading import Event, Lock, Thread
+
+
+class Histogram():
+    """
+    Distribution of observed values, counted in buckets that grow by
+    powers of two. Observing a value is cheap and the memory used is
+    bounded, at the cost of quantiles only being approximate.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        # Maps the exponent of a bucket, i.e. values up to 2**exponent,
+        # to the number of values in it.
+        self.buckets = dict()
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        exponent = math.frexp(value)[1] if value > 0 else 0
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def merge(self, other):
+        """
+        Add the values of another histogram to this one.
+        """
+        self.count += other.count
+        self.total += other.total
+        for name, pick in (('min', min), ('max', max)):
+            value = getattr(other, name)
+            if value is not None:
+                mine = getattr(self, name)
+                setattr(self, name, value if mine is None else pick(mine, value))
+
+        for exponent, count in other.buckets.items():
+            self.buckets[exponent] = self.buckets.get(exponent, 0) + count
+
+    def quantile(self, q):
+        """
+        Returns:
+            The upper bound of the bucket holding the quantile 'q',
+            capped by the largest value observed.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                return min(math.ldexp(1, exponent), self.max)
+
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+def _max_rss():
+    """
+    Returns:
+        The memory high-water mark of the process in bytes, or None
+        where it isn't available.
+    """
+    try:
+        import resource
+
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in KiB on Linux, but in bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Metrics():
+    """
+    Counters, gauges and histograms of a server or a client, safe to
+    update from any thread. Hooks registered with 'add_hook' are called
+    with every event, e.g. a finished transfer, which is the way to
+    feed the metrics into other monitoring.
+
+    Methods:
+        add: Add to a counter.
+
+        change: Change a gauge, e.g. the number of active connections.
+
+        set: Set a gauge, e.g. the depth of a queue.
+
+        observe: Add a value to a histogram.
+
+        record_transfer: Record the counters and histograms of a
+        finished transfer, and emit it to the hooks.
+
+        add_hook: Register a function called with every event.
+
+        emit: Call the hooks with an event.
+
+        snapshot: All metrics as a dict.
+
+        format: All metrics as text, one metric per line.
+
+        serve: Serve the metrics over http on a background thread.
+
+        dump_every: Print the metrics periodically on a background thread.
+
+        export: A copy of the raw metrics, e.g. to send to another process.
+
+        load: Replace the metrics with the sum of exported metrics.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.counters = dict()
+        self.gauges = dict()
+        # Highest value that every gauge has had.
+        self.peaks = dict()
+        self.histograms = dict()
+        self.hooks = list()
+
+    def add(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def change(self, name, delta):
+        with self.lock:
+            self._set(name, self.gauges.get(name, 0) + delta)
+
+    def set(self, name, value):
+        with self.lock:
+            self._set(name, value)
+
+    def _set(self, name, value):
+        self.gauges[name] = value
+        self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+
+            self.histograms[name].observe(value)
+
+    def record_transfer(self, files, bytes_, duration, **data):
+        """
+        Record a finished transfer, i.e. its counters and rates. The
+        time spent in the different stages is given as keyword arguments
+        ending in '_seconds', e.g. recv_seconds and disk_seconds, which
+        are added to counters with the same names. All arguments are
+        emitted to the hooks as a 'transfer' event.
+        """
+        with self.lock:
+            self.counters['transfers'] = self.counters.get('transfers', 0) + 1
+            self.counters['files'] = self.counters.get('files', 0) + files
+            self.counters['bytes'] = self.counters.get('bytes', 0) + bytes_
+            for name, value in data.items():
+                if name.endswith('_seconds'):
+                    self.counters[name] = self.counters.get(name, 0.0) + value
+
+            for name, value in (('transfer_seconds', duration),
+                    ('transfer_bytes_per_second', bytes_ / duration if duration else None),
+                    ('transfer_files_per_second', files / duration if duration else None)):
+                if value is not None:
+                    self.histograms.setdefault(name, Histogram()).observe(value)
+
+        self.emit('transfer', files = files, bytes = bytes_,
+                duration = duration, **data)
+
+    def add_hook(self, hook):
+        """
+        Params:
+            hook (callable): Called as hook(event, data) with the name of
+            every event, e.g. 'connection' or 'transfer', and a dict with
+            its details. Hooks are called on the thread that the event
+            happens on, so they should return quickly.
+        """
+        with self.lock:
+            self.hooks.append(hook)
+
+    def emit(self, event, **data):
+        for hook in list(self.hooks):
+            try:
+                hook(event, data)
+
+            except Exception as e:
+                # A broken hook must never fail a transfer.
+                print("Metrics hook {} failed: {}".format(hook, e))
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            return {
+                'uptime': uptime,
+                'max_rss': _max_rss(),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'peaks': dict(self.peaks),
+                'histograms': {name: histogram.to_dict()
+                    for name, histogram in self.histograms.items()},
+            }
+
+    def export(self):
+        """
+        Returns:
+            A picklable copy of the counters, gauges, peaks and
+            histograms, which 'load' combines.
+        """
+        with self.lock:
+            histograms = dict()
+            for name, histogram in self.histograms.items():
+                histograms[name] = Histogram()
+                histograms[name].merge(histogram)
+
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                    'peaks': dict(self.peaks), 'histograms': histograms}
+
+    def load(self, parts):
+        """
+        Replace the metrics with the sum of 'parts', each returned by
+        'export', e.g. of the worker processes of a server. Counters,
+        gauges and peaks are added, and histograms are merged.
+        """
+        counters, gauges, peaks, histograms = dict(), dict(), dict(), dict()
+        for part in parts:
+            for total, values in ((counters, part['counters']),
+                    (gauges, part['gauges']), (peaks, part['peaks'])):
+                for name, value in values.items():
+                    total[name] = total.get(name, 0) + value
+
+            for name, histogram in part['histograms'].items():
+                histograms.setdefault(name, Histogram()).merge(histogram)
+
+        with self.lock:
+            self.counters = counters
+            self.gauges = gauges
+            self.peaks = peaks
+            self.histograms = histograms
+
+    def format(self):
+        snapshot = self.snapshot()
+        lines = ['uptime {:.1f}'.format(snapshot['uptime'])]
+        if snapshot['max_rss'] is not None:
+            lines.append('max_rss {}'.format(snapshot['max_rss']))
+
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('{} {}'.format(name, _number(value)))
+
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('{} {} (peak {})'.format(name, _number(value),
+                _number(snapshot['peaks'][name])))
+
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            lines.append('{} {}'.format(name, ' '.join('{}={}'.format(key,
+                _number(value)) for key, value in histogram.items())))
+
+        return '\n'.join(lines)
+
+    def serve(self, host = 'localhost', port = 1751):
+        """
+        Serve the metrics over http on a background thread, as text on
+        any path and as json on /json. Only bind to a public host if
+        the metrics may be seen by anyone who can reach it.
+
+        Returns:
+            The http server, which is stopped with 'shutdown'.
+        """
+        # Imported when needed, since it is slow to import.
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') == '/json':
+                    body = json.dumps(metrics.snapshot()).encode('utf-8')
+                    content_type = 'application/json'
+
+                else:
+                    body = (metrics.format() + '\n').encode('utf-8')
+                    content_type = 'text/plain; charset=utf-8'
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        Thread(target = server.serve_forever, daemon = True).start()
+        return server
+
+    def dump_every(self, interval, write = print):
+        """
+        Write the metrics every 'interval' seconds on a background thread.
+
+        Returns:
+            An event, which stops the dumps when set.
+        """
+        stop = Event()
+
+        def dump():
+            while not stop.wait(interval):
+                write(self.format())
+
+        Thread(target = dump, daemon = True).start()
+        return stop
+
+
+def _number(value):
+    if isinstance(value, float):
+        return '{:.6g}'.format(value)
+
+    return str(value)
@@ -0,0 +1,309 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import queue
+import time
+from threading import Thread
+
+# Package imports
+from .protocol import ProtocolError
+from . import integrity
+
+# Bytes of upcoming files that the client reads ahead by default, and
+# number of buffers that a connection of the server receives into.
+READ_AHEAD = 2**22
+WRITE_BUFFERS = 8
+
+
+class BufferPool():
+    """
+    A fixed number of buffers that are reused, which bounds the memory
+    of a pipeline. Taking a buffer blocks until one is put back.
+
+    Methods:
+        get: Take a buffer, waiting for one to be free.
+
+        put: Put a buffer back.
+    """
+    def __init__(self, count, size):
+        self.size = size
+        # The buffer put back last is taken first, i.e. the one
+        # most likely to still be in the cpu cache.
+        self.free = queue.LifoQueue()
+        for _ in range(max(count, 1)):
+            self.free.put(bytearray(size))
+
+    def get(self):
+        return self.free.get()
+
+    def put(self, buffer):
+        self.free.put(buffer)
+
+
+class ReadAhead():
+    """
+    Reader stage of the client. The content of upcoming files is read
+    into the buffers of a pool on a thread of its own, and hashed when
+    verifying, while the network stage sends the files before them.
+    Files that aren't read ahead, e.g. since they are sent with sendfile,
+    pass through in order, such that the reader goes on with the files
+    after them.
+
+    Methods:
+        items: Generate every item, and whether it was read ahead.
+
+        chunks: Generate the content of the item just generated.
+
+        close: Stop reading, and put every buffer back to the pool.
+
+        _read: Private method run by the reader thread.
+    """
+    def __init__(self, items, pool, eligible, algorithm = None):
+        """
+        Params:
+            items (list): The items to send.
+
+            pool (BufferPool): The buffers to read into.
+
+            eligible (callable): Called with every item, whether
+            it should be read ahead.
+
+            algorithm (str): Hash the content with this algorithm.
+        """
+        self.pool = pool
+        # Every item is followed by its chunks and its end, or the
+        # error that ended it, and the items are followed by None.
+        self.queue = queue.Queue()
+        self.stopped = False
+        # Hash of the content of the last item read, or the error
+        # that it failed with, e.g. since it changed size.
+        self.digest = None
+        self.error = None
+        self.thread = Thread(target = self._read,
+                args = (items, eligible, algorithm), daemon = True)
+        self.thread.start()
+
+    def _read(self, items, eligible, algorithm):
+        try:
+            for item in items:
+                if self.stopped:
+                    return
+
+                if not eligible(item):
+                    self.queue.put(('item', item, None))
+                    continue
+
+                try:
+                    f = open(str(item.source), 'rb')
+
+                except OSError as e:
+                    self.queue.put(('item', item, e))
+                    continue
+
+                self.queue.put(('item', item, True))
+                hasher = integrity.new(algorithm) if algorithm else None
+                with f:
+                    remaining = item.size
+                    while remaining and not self.stopped:
+                        buffer = self.pool.get()
+                        with memoryview(buffer) as view:
+                            length = f.readinto(view[:min(remaining, len(buffer))])
+                            if length and hasher:
+                                hasher.update(view[:length])
+
+                        if not length:
+                            self.pool.put(buffer)
+                            break
+
+                        self.queue.put(('data', buffer, length))
+                        remaining -= length
+
+                if remaining:
+                    # Only this file fails, the items after it go on.
+                    self.queue.put(('failed', OSError("File {} changed " \
+                        "size while being sent.".format(item.source)), None))
+                    continue
+
+                self.queue.put(('end', hasher.hexdigest() if hasher else None,
+                    None))
+
+        except Exception as e:
+            self.queue.put(('error', e, None))
+
+        finally:
+            self.queue.put(None)
+
+    def items(self):
+        """
+        Generate every item with True if it was read ahead, in which case
+        its content is taken with 'chunks' before the next item, None if
+        it wasn't, or the OSError that opening the file failed with.
+        """
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+
+            kind, item, state = entry
+            if kind == 'error':
+                raise item
+
+            yield item, state
+
+    def chunks(self):
+        """
+        Generate the (buffer, length) of every chunk of the item just
+        generated. Every buffer must be put back to the pool once sent.
+        The hash of the content is in 'digest' afterwards, or the error
+        in 'error' if the file failed after the chunks generated so far.
+        """
+        self.error = None
+        while True:
+            kind, first, second = self.queue.get()
+            if kind == 'data':
+                yield first, second
+
+            elif kind == 'end':
+                self.digest = first
+                return
+
+            elif kind == 'failed':
+                self.digest = None
+                self.error = first
+                return
+
+            else:
+                raise first
+
+    def close(self):
+        self.stopped = True
+        while self.thread.is_alive() or not self.queue.empty():
+            try:
+                entry = self.queue.get(timeout = 0.01)
+
+            except queue.Empty:
+                continue
+
+            if entry and entry[0] == 'data':
+                self.pool.put(entry[1])
+
+
+class WriteBehind():
+    """
+    Writer stage of the server. Content received into the buffers of a
+    pool is written by a thread of its own, while the socket stage goes
+    on receiving the content after it. Other frames are handled by the
+    socket stage once the content before them is written, since they e.g.
+    end the file being written, see 'drain'.
+
+    Methods:
+        receive: Receive the payload of a data frame.
+
+        drain: Wait until all content handed to the writer is written.
+
+        close: Stop the writer thread.
+
+        _write: Private method run by the writer thread.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.queue = queue.Queue()
+        # The error that the last write failed with, and the seconds that
+        # the socket stage spent on content without receiving, i.e. waiting
+        # for a free buffer or writing small payloads itself.
+        self.error = None
+        self.stall_time = 0.0
+        self.thread = Thread(target = self._write, daemon = True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+
+            write, buffer, length = entry
+            try:
+                if not self.error:
+                    with memoryview(buffer) as view:
+                        write(view[:length])
+
+            except Exception as e:
+                self.error = e
+
+            finally:
+                self.pool.put(buffer)
+                self.queue.task_done()
+
+    def receive(self, sock, length, write, forward = None):
+        """
+        Receive the payload of a data frame into buffers of the pool. Every
+        filled buffer is handed to the writer, which calls 'write' with it.
+        Payloads that fit a single buffer are written at once instead,
+        when the writer is idle, since there is nothing to overlap.
+
+        Params:
+            sock (socket): The socket to receive from.
+
+            length (int): The length of the payload.
+
+            write (callable): Called with a memoryview of every part.
+
+            forward (callable): Called with every part before it is
+            written, e.g. to relay it.
+        """
+        while length:
+            waited = time.perf_counter()
+            buffer = self.pool.get()
+            self.stall_time += time.perf_counter() - waited
+            try:
+                size = min(length, len(buffer))
+                with memoryview(buffer) as view:
+                    filled = 0
+                    while filled < size:
+                        received = sock.recv_into(view[filled:size], size - filled)
+                        if not received:
+                            raise ProtocolError("Connection closed in the " \
+                                    "middle of a frame.")
+
+                        filled += received
+
+                    if forward:
+                        forward(view[:size])
+
+                    inline = size == length and not self.queue.unfinished_tasks
+                    if inline:
+                        written = time.perf_counter()
+                        write(view[:size])
+                        self.stall_time += time.perf_counter() - written
+
+            except BaseException:
+                self.pool.put(buffer)
+                raise
+
+            if inline:
+                self.pool.put(buffer)
+
+            else:
+                self.queue.put((write, buffer, size))
+
+            length -= size
+
+    def drain(self):
+        """
+        Wait for the writes handed to the writer, raising the
+        error that a write failed with.
+        """
+        self.queue.join()
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,257 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
+from threading import Thread
+
+# Package imports
+from .server import Server
+from .metrics import Metrics
+
+# Seconds between the metrics that every worker reports.
+STATS_EVERY = 1.0
+
+# Seconds before a failed worker is restarted. A worker that fails within
+# MIN_UPTIME seconds of starting waits twice as long as the last time,
+# up to MAX_RESTART_DELAY, such that a broken worker doesn't spin.
+RESTART_DELAY = 0.1
+MAX_RESTART_DELAY = 30.0
+MIN_UPTIME = 1.0
+
+
+def _run_worker(options, conn, interval):
+    """
+    Run a single worker process, i.e. a server listening on the shared
+    port, which reports its metrics to the supervisor every 'interval'
+    seconds. The worker exits once the supervisor is gone.
+    """
+    # Interrupts are handled by the supervisor, which stops the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = Server(reuse_port = True, **options)
+    conn.send(('ready', None))
+
+    def report():
+        while True:
+            time.sleep(interval)
+            try:
+                conn.send(('metrics', server.metrics.export()))
+
+            except OSError:
+                os._exit(1)
+
+    Thread(target = report, daemon = True).start()
+    server.receive()
+
+
+class Worker():
+    """
+    A worker process, and the pipe that it reports on.
+    """
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.started = time.monotonic()
+
+
+class PreforkServer():
+    """
+    Runs a number of servers as worker processes, which all listen on the
+    same port with SO_REUSEPORT, such that the kernel spreads connections
+    between them and every core receives, hashes and decompresses on its
+    own. The supervisor restarts workers that fail, and adds their metrics
+    up, which it serves and prints like a single server does.
+
+    Methods:
+        receive: Start the workers, and supervise them on the main thread
+        or on a separate thread, depending on whether is_async is true.
+
+        close: Stop the workers.
+
+        _start_worker: Private method to start a single worker.
+
+        _supervise: Private method that collects the metrics of the
+        workers and restarts those that fail.
+
+        _aggregate: Private method to add up the metrics of the workers.
+    """
+    def __init__(self, workers = None, is_async = False, stats_port = None,
+            stats_interval = None, stats_every = STATS_EVERY, **options):
+        """
+        Params:
+            workers (int): Number of worker processes.
+            Default: None (i.e. one per core).
+
+            is_async (bool): Supervise on a separate thread, see Server.
+            Default: False.
+
+            stats_port, stats_interval: Serve and print the metrics of
+            all workers added up, see Server.
+
+            stats_every (float): Seconds between the metrics that every
+            worker reports to the supervisor.
+            Default: 1.0.
+
+            options: The params of the server run by every worker,
+            see Server.
+        """
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError("Worker processes need SO_REUSEPORT, which isn't " \
+                    "available on this platform.")
+
+        self.workers = workers or os.cpu_count() or 1
+        if not isinstance(self.workers, int) or self.workers < 1:
+            raise ValueError("Workers specified on the wrong format, " \
+                    "should be a positive int.")
+
+        self.is_async = is_async
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
+        self.stats_every = stats_every
+        self.options = options
+        # Workers are forked, which is fast and keeps the params as is.
+        self.context = multiprocessing.get_context('fork')
+        self.running = dict()
+        self.stopped = False
+
+        # The metrics of all workers, the last metrics of every running
+        # worker, those of stopped workers added up, and the metrics
+        # of the supervisor itself, e.g. the number of restarts.
+        self.metrics = Metrics()
+        self.reports = dict()
+        self.retired = Metrics()
+        self.own = Metrics()
+
+    def _start_worker(self):
+        """
+        Start a worker and wait until it listens.
+
+        Returns:
+            The Worker, or None if it failed to start.
+        """
+        conn, child = self.context.Pipe(duplex = False)
+        process = self.context.Process(target = _run_worker,
+                args = (self.options, child, self.stats_every), daemon = True)
+        process.start()
+        child.close()
+        try:
+            conn.recv()
+
+        except EOFError:
+            process.join()
+            conn.close()
+            return None
+
+        worker = Worker(process, conn)
+        self.running[process.pid] = worker
+        self.own.set('workers', len(self.running))
+        return worker
+
+    def receive(self):
+        for _ in range(self.workers):
+            if not self._start_worker():
+                self.close()
+                raise RuntimeError("A worker failed to start, see its " \
+                        "error above.")
+
+        print("Started {} workers.".format(self.workers))
+        self._aggregate()
+        if self.stats_port:
+            self.stats = self.metrics.serve('localhost', self.stats_port)
+            print("Serving metrics on port: {}".format(self.stats_port))
+
+        if self.stats_interval:
+            self.metrics.dump_every(self.stats_interval)
+
+        if self.is_async:
+            self.supervisor_thread = Thread(target = self._supervise,
+                    daemon = True)
+            self.supervisor_thread.start()
+
+        else:
+            try:
+                self._supervise()
+
+            except KeyboardInterrupt:
+                self.close()
+
+    def _supervise(self):
+        # The times that failed workers are due to restart, and the
+        # number of workers in a row that failed quickly.
+        restarts = list()
+        failures = 0
+        while not self.stopped:
+            timeout = (max(0.0, min(restarts) - time.monotonic())
+                    if restarts else None)
+            ready = wait([worker.conn for worker in self.running.values()]
+                    + [worker.process.sentinel
+                        for worker in self.running.values()], timeout)
+            if self.stopped:
+                return
+
+            for pid, worker in list(self.running.items()):
+                if worker.conn in ready:
+                    try:
+                        kind, report = worker.conn.recv()
+                        if kind == 'metrics':
+                            self.reports[pid] = report
+
+                    except (EOFError, OSError):
+                        pass
+
+                if worker.process.sentinel not in ready:
+                    continue
+
+                # The counters of a failed worker are kept, while its
+                # gauges, e.g. its active connections, are gone.
+                worker.process.join()
+                worker.conn.close()
+                del self.running[pid]
+                report = self.reports.pop(pid, None)
+                if report:
+                    report['gauges'] = dict()
+                    self.retired.load([self.retired.export(), report])
+
+                print("Worker {} exited with code {}, restarting it.".format(
+                    pid, worker.process.exitcode))
+                failures = (failures + 1
+                        if time.monotonic() - worker.started < MIN_UPTIME else 0)
+                restarts.append(time.monotonic() + min(MAX_RESTART_DELAY,
+                    RESTART_DELAY * 2**failures))
+                self.own.add('restarts')
+                self.own.set('workers', len(self.running))
+
+            now = time.monotonic()
+            for due in [due for due in restarts if due <= now]:
+                restarts.remove(due)
+                if not self._start_worker():
+                    failures += 1
+                    restarts.append(now + min(MAX_RESTART_DELAY,
+                        RESTART_DELAY * 2**failures))
+
+            self._aggregate()
+
+    def _aggregate(self):
+        self.metrics.load([self.own.export(), self.retired.export()]
+                + list(self.reports.values()))
+
+    def close(self):
+        self.stopped = True
+        for worker in list(self.running.values()):
+            worker.process.terminate()
+
+        for worker in list(self.running.values()):
+            worker.process.join()
+            worker.conn.close()
+
+        self.running = dict()
+        self.own.set('workers', 0)
@@ -0,0 +1,288 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import json
+import struct
+
+# Version of the wire protocol. Sent in the header frame such that
+# client and server can detect an incompatible peer.
+VERSION = 1
+MAGIC = b'RLOC'
+
+# Frame types.
+HEADER = 1
+ITEM = 2
+DATA = 3
+EOF = 4
+END = 5
+ERROR = 6
+MANIFEST = 7
+WANT = 8
+SIGREQ = 9
+SIGNATURE = 10
+COPY = 11
+RANGE = 12
+RESUME = 13
+PACK = 14
+HAVE = 15
+CHECK = 16
+ACK = 17
+PING = 18
+PROBE = 19
+
+# Every frame starts with the frame type followed by the length
+# of the payload, i.e. a frame is laid out as [type][length][payload].
+FRAME = struct.Struct('!BQ')
+
+# A pack frame holds many small files, laid out as [index length][index]
+# followed by the content of the files, where the index is a json list
+# of the [path, size, mtime] of every file.
+PACK_INDEX = struct.Struct('!I')
+
+# Size of the chunks that file contents are read and sent in.
+CHUNK_SIZE = 2**16
+
+# Files at least this large are striped over multiple connections,
+# when enabled, with at least this many bytes per connection.
+STRIPE_SIZE = 2**26
+
+# Upper limit on the number of connections a file is striped over.
+MAX_STREAMS = 16
+
+# Seconds to wait for the server to accept an extra connection for
+# a stripe, before the stripe is sent over the main connection instead.
+STRIPE_TIMEOUT = 5
+
+# Files at least this large are written under a temporary name
+# together with a record of the progress, such that the transfer
+# can be resumed if the connection is lost.
+RESUME_THRESHOLD = 2**24
+
+# The progress of a resumable file is recorded every this many bytes.
+RESUME_INTERVAL = 2**26
+
+# Files smaller than this are packed together, when packing is enabled.
+PACK_THRESHOLD = 2**16
+
+# Files at least this large are deduplicated by their hash, when enabled.
+DEDUP_THRESHOLD = 2**16
+
+# Size of the buffer that the receiving side reads data frames into.
+BUFFER_SIZE = 2**18
+
+# Number of entries sent in each manifest frame when syncing.
+MANIFEST_BATCH = 4096
+
+# Number of files sent between reading the acknowledgements of the
+# server, when verifying.
+ACK_INTERVAL = 256
+
+# Largest frame accepted by default. Bounds the memory that a single
+# connection can make the receiving side allocate.
+MAX_FRAME_SIZE = 2**20
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer sends data that doesn't follow the protocol.
+    """
+
+
+def pack_frame(frame_type, payload = b''):
+    """
+    Pack a single frame, i.e. the frame header and the payload.
+    """
+    return FRAME.pack(frame_type, len(payload)) + payload
+
+
+def send_frame(sock, frame_type, payload = b''):
+    """
+    Send a single frame over the socket. Large payloads are sent
+    separately from the frame header in order to avoid copying them.
+    """
+    if len(payload) > CHUNK_SIZE // 16:
+        sock.sendall(FRAME.pack(frame_type, len(payload)))
+        sock.sendall(payload)
+
+    else:
+        sock.sendall(pack_frame(frame_type, payload))
+
+
+def recv_exact(sock, size):
+    """
+    Receive exactly 'size' bytes from the socket. Raises ProtocolError
+    if the connection is closed before all bytes has been received.
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        received = sock.recv_into(view[pos:], size - pos)
+        if not received:
+            raise ProtocolError("Connection closed in the middle of a frame.")
+
+        pos += received
+
+    return buf
+
+
+def recv_header(sock):
+    """
+    Receive the header of a single frame from the socket.
+
+    Returns:
+        A tuple (frame_type, length), or None if the peer closed
+        the connection cleanly between two frames.
+    """
+    first = sock.recv(FRAME.size)
+    if not first:
+        return None
+
+    if len(first) < FRAME.size:
+        first += recv_exact(sock, FRAME.size - len(first))
+
+    return FRAME.unpack(first)
+
+
+def recv_payload(sock, length, max_size = MAX_FRAME_SIZE):
+    """
+    Receive the payload of a frame. Frames larger than 'max_size'
+    are rejected before the payload is received.
+    """
+    if length > max_size:
+        raise ProtocolError("Frame of {} bytes exceeds the limit of {} " \
+                "bytes.".format(length, max_size))
+
+    return recv_exact(sock, length)
+
+
+def recv_frame(sock, max_size = MAX_FRAME_SIZE):
+    """
+    Receive a single frame from the socket. Frames larger than
+    'max_size' are rejected before the payload is received.
+
+    Returns:
+        A tuple (frame_type, payload), or None if the peer closed
+        the connection cleanly between two frames.
+    """
+    header = recv_header(sock)
+    if header is None:
+        return None
+
+    frame_type, length = header
+    return frame_type, recv_payload(sock, length, max_size)
+
+
+def recv_data(sock, length, view, write):
+    """
+    Receive the payload of a data frame into a preallocated buffer,
+    handing every filled part of the buffer to 'write'. Data frames
+    can be arbitrarily large since they never are held in memory as
+    a whole.
+
+    Params:
+        sock (socket): The socket to receive from.
+
+        length (int): The length of the payload.
+
+        view (memoryview): The reusable buffer to receive into.
+
+        write (callable): Called with a memoryview of each received part.
+    """
+    size = len(view)
+    while length:
+        received = sock.recv_into(view, min(length, size))
+        if not received:
+            raise ProtocolError("Connection closed in the middle of a frame.")
+
+        write(view[:received])
+        length -= received
+
+
+def encode_json(obj):
+    """
+    Encode metadata, e.g. an item, as a compact json payload.
+    """
+    return json.dumps(obj, separators = (',', ':')).encode('utf-8')
+
+
+def decode_json(payload):
+    try:
+        return json.loads(bytes(payload).decode('utf-8'))
+
+    except ValueError as e:
+        raise ProtocolError("Malformed metadata frame: {}".format(e))
+
+
+def encode_header(**options):
+    """
+    Encode the payload of the header frame, which is the first frame
+    sent on every connection.
+    """
+    options['version'] = VERSION
+    return MAGIC + encode_json(options)
+
+
+def expect_header(sock):
+    """
+    Receive the header frame the server answers with. The server
+    answers with an error frame instead if the connection is rejected,
+    e.g. when it is busy, in which case ConnectionRefusedError is raised.
+    """
+    return check_header(recv_frame(sock))
+
+
+def check_header(frame):
+    """
+    Check the frame the server answers the header frame with.
+    """
+    if frame is None:
+        raise ConnectionResetError("Server closed the connection.")
+
+    frame_type, payload = frame
+    if frame_type == ERROR:
+        raise ConnectionRefusedError(bytes(payload).decode('utf-8', 'replace'))
+
+    if frame_type != HEADER:
+        raise ProtocolError("Expected header frame.")
+
+    return decode_header(payload)
+
+
+def expect_end(sock):
+    """
+    Receive the end frame that the server acknowledges the end of
+    a transfer with, once everything has been written.
+
+    Returns:
+        The summary of the transfer, i.e. the number of files and
+        content bytes the server has written.
+    """
+    frame = recv_frame(sock)
+    if frame is None or frame[0] != END:
+        raise ProtocolError("Transfer was not acknowledged by the server.")
+
+    return decode_json(frame[1]) if frame[1] else dict()
+
+
+def decode_header(payload):
+    """
+    Decode and validate the payload of a header frame.
+    """
+    if bytes(payload[:len(MAGIC)]) != MAGIC:
+        raise ProtocolError("Peer is not speaking the reloc protocol.")
+
+    options = decode_json(payload[len(MAGIC):])
+    if not isinstance(options, dict):
+        raise ProtocolError("Malformed header frame.")
+
+    if options.get('version') != VERSION:
+        raise ProtocolError("Unsupported protocol version {}, " \
+                "expected {}.".format(options.get('version'), VERSION))
+
+    return options
@@ -0,0 +1,1182 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import errno
+import hashlib
+import lzma
+import os
+import pathlib
+import tempfile
+import time
+import zlib
+
+# Package imports
+from .protocol import (ITEM, DATA, EOF, END, ERROR, MANIFEST, WANT, SIGREQ,
+        SIGNATURE, COPY, RANGE, RESUME, PACK, HAVE, CHECK, ACK, PACK_INDEX,
+        RESUME_THRESHOLD, RESUME_INTERVAL, ProtocolError, encode_json, decode_json)
+from . import compress, delta, integrity
+from .util import Item, is_current
+
+# Number of packed files written by each task of the executor.
+PACK_TASK = 64
+
+# Upper limit on the number of write tasks of a transfer waiting for the
+# executor, which bounds the memory held by packs not yet written.
+MAX_PENDING = 256
+
+# Types of the metadata of an item, any of which can also be None.
+ITEM_TYPES = {'name': str, 'path': str, 'type_': str, 'size': int,
+        'mtime': (int, float), 'suffix': str, 'delta': int, 'codec': str,
+        'stripes': int, 'offset': int, 'digest': str}
+
+# Types of the metadata of a range of a striped file.
+RANGE_TYPES = {'path': str, 'size': int, 'offset': int, 'length': int}
+
+
+def _decode_item(payload):
+    """
+    Decode the metadata of an item frame, checking its shape.
+    """
+    data = decode_json(payload)
+    if (not isinstance(data, dict) or not isinstance(data.get('path'), str)
+            or not all(data.get(key) is None or isinstance(data[key], types)
+                for key, types in ITEM_TYPES.items())):
+        raise ProtocolError("Malformed item frame.")
+
+    return Item.from_dict(data)
+
+
+def _decode_range(payload):
+    """
+    Decode the metadata of a range frame, checking its shape.
+    """
+    data = decode_json(payload)
+    if not isinstance(data, dict) or not all(isinstance(data.get(key), types)
+            for key, types in RANGE_TYPES.items()):
+        raise ProtocolError("Malformed range frame.")
+
+    return data
+
+
+def _decode_entries(payload, lengths):
+    """
+    Decode the entries of a manifest, or of a similar frame, checking that
+    every entry is a list of one of 'lengths' values, starting with the
+    path, size and mtime of a file.
+    """
+    entries = decode_json(payload)
+    if not isinstance(entries, list) or not all(isinstance(entry, list)
+            and len(entry) in lengths and isinstance(entry[0], str)
+            and isinstance(entry[1], int) and isinstance(entry[2], (int, float))
+            for entry in entries):
+        raise ProtocolError("Malformed manifest frame.")
+
+    return entries
+
+
+def _write_packed(files, store = None, verify = None):
+    """
+    Write packed files, i.e. a list of (name, path, content, mtime, hash).
+    Files are verified against their hash before they are written.
+
+    Returns:
+        The [name, reason] of every file that failed verification.
+    """
+    failed = list()
+    for name, path, data, mtime, digest in files:
+        if verify and digest:
+            checker = integrity.new(verify)
+            checker.update(data)
+            if checker.hexdigest() != digest:
+                failed.append([name, 'checksum mismatch'])
+                continue
+
+        if store:
+            store.detach(path)
+
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+    return failed
+
+
+def _open_striped(path, size):
+    """
+    Open a striped file for writing and give it its final size. The
+    file is never truncated to zero, since ranges of it might already
+    have been written over other connections.
+    """
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, size)
+        # Reserve the blocks up front where supported, such that
+        # the ranges don't fragment the file.
+        if hasattr(os, 'posix_fallocate') and size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+
+            except OSError:
+                pass
+
+    return fd
+
+
+def _open_temp(path, suffix):
+    """
+    Open a temporary file next to 'path', with a name of its own, such
+    that concurrent transfers to the same path never share it.
+
+    Returns:
+        The path of the temporary file, and the file opened for writing.
+    """
+    fd, name = tempfile.mkstemp(dir = str(path.parent),
+            prefix = '.{}.'.format(path.name), suffix = suffix)
+    # Given the mode of the other files written, instead of owner only.
+    os.fchmod(fd, 0o644)
+    return pathlib.Path(name), open(fd, 'wb', buffering = 0)
+
+
+def _sink_failure(error):
+    """
+    Returns:
+        The reason that a file given to the sink failed, when the
+        sink, or the object that it returned, raised 'error'.
+    """
+    return 'sink failed: {}: {}'.format(type(error).__name__, error)
+
+
+def _abort(output):
+    """
+    Tell the object of a sink that its file won't be complete. The
+    object is given up on either way, so what it raises is ignored.
+    """
+    if hasattr(output, 'abort'):
+        try:
+            output.abort()
+
+        except Exception:
+            pass
+
+
+def _striped_path(path):
+    """
+    Returns:
+        The path that the ranges of a striped file are written to until
+        it is complete, which every connection of the transfer shares.
+    """
+    return path.with_name('.{}.reloc-stripes'.format(path.name))
+
+
+def _record_path(path):
+    """
+    Returns:
+        The path of the record of the progress of a resumable file.
+    """
+    return path.with_name('.{}.reloc-part.json'.format(path.name))
+
+
+def _read_record(record):
+    """
+    Returns:
+        The progress of a resumable file, i.e. its size and mtime, the
+        offset written so far and the path of the partial file that it's
+        written to, or None if there is no valid record.
+    """
+    try:
+        with open(str(record), 'rb') as f:
+            progress = decode_json(f.read())
+
+    except (OSError, ProtocolError):
+        return None
+
+    name = progress.get('part') if isinstance(progress, dict) else None
+    # The partial file is always next to the record.
+    if not isinstance(name, str) or not name or os.path.basename(name) != name:
+        return None
+
+    progress['part'] = record.with_name(name)
+    return progress
+
+
+def _committed_offset(progress, size, mtime):
+    """
+    Returns:
+        The offset that a partial file can be resumed from, which is
+        0 unless the record shows that it is a partial copy of the
+        same version of the file, i.e. the same size and mtime.
+    """
+    if not progress or progress.get('size') != size \
+            or progress.get('mtime') != mtime:
+        return 0
+
+    try:
+        written = os.stat(str(progress['part'])).st_size
+
+    except OSError:
+        return 0
+
+    return min(progress.get('offset', 0), written, size)
+
+
+def _lock(f):
+    """
+    Lock a partial file for the transfer writing it, such that no other
+    transfer resumes it at the same time. The lock is held until the file
+    is closed.
+
+    Returns:
+        False if another transfer holds the lock, otherwise True.
+    """
+    try:
+        import fcntl
+
+    except ImportError:
+        # Partial files aren't locked where fcntl isn't available.
+        return True
+
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    except OSError:
+        return False
+
+    return True
+
+
+def _discard_part(part):
+    """
+    Remove the partial file of an earlier transfer, unless another
+    transfer is still writing it.
+    """
+    try:
+        with open(str(part), 'rb') as f:
+            if _lock(f):
+                os.remove(str(part))
+
+    except OSError:
+        pass
+
+
+def _release_record(record, part):
+    """
+    Remove the record of a resumable file, unless it has been taken over
+    by another transfer of the same path, i.e. names another partial file.
+    """
+    progress = _read_record(record)
+    if progress and progress['part'] == part:
+        try:
+            os.remove(str(record))
+
+        except OSError:
+            pass
+
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+class Receiver():
+    """
+    Handles the frames of a single transfer and writes the received
+    folders and files to disk as the frames arrive. The receiver doesn't
+    do any networking by itself, which means that it can be driven by
+    both the blocking server and the asyncio server.
+
+    Methods:
+        handle: Handle a single frame received from the client. Returns
+        a frame (frame_type, payload) to answer the client with, or None.
+
+        write: Write a chunk of file content to the currently open file.
+
+        close: Close any file that is still open, e.g. when the
+        connection is lost in the middle of a transfer.
+
+        _resolve: Private method to resolve a path sent by the client
+        to a path under the default path.
+
+        _check_manifest: Private method to find the files in a manifest
+        that are missing or stale under the default path.
+
+        _signature: Private method to compute the block signature of
+        the copy of a file under the default path.
+
+        _copy_blocks: Private method to copy blocks from the old copy of
+        a file when it is reconstructed from a delta.
+
+        _begin_range: Private method to start receiving a byte range of
+        a file striped over multiple connections.
+
+        _end_range: Private method to finish the hash of a byte range.
+
+        _check: Private method to verify the content just received
+        against the hash sent by the client.
+
+        _open_file: Private method to open the file that the content of
+        an item is written to.
+
+        _end_file: Private method to verify and move a received file
+        into place, returning its acknowledgement.
+
+        _fail_file: Private method to discard a file and report it
+        as failed.
+
+        _abandon_file: Private method to discard a file that the client
+        failed to send.
+
+        _commit: Private method to record the progress of a resumable
+        file, once the content written so far is on disk.
+
+        _resume_offsets: Private method to find the offsets that
+        interrupted transfers of files can be resumed from.
+
+        _unpack: Private method to write the files of a pack.
+
+        _sink_packed: Private method to hand packed files to the sink.
+
+        _drain: Private method to wait for packed files being written.
+
+        _makedirs: Private method to create a folder, once per transfer.
+
+        _link_stored: Private method to link files to content that
+        the blob store already holds.
+    """
+    def __init__(self, def_path, log = None, executor = None, store = None,
+            verify = None, sink = None):
+        """
+        Params:
+            def_path (Path): The folder that received items are saved in.
+
+            log (callable): Optional function taking a log type and a
+            message, i.e. the '_update_log' method of the server.
+            Default: None.
+
+            executor (Executor): Optional executor that packed files are
+            written on in parallel. The transfer is only acknowledged
+            once all of them are written.
+            Default: None (i.e. packed files are written as they arrive).
+
+            store (BlobStore): Optional content addressed store, that files
+            with known hashes are added to and linked from.
+            Default: None.
+
+            verify (str): The hash algorithm negotiated with the client.
+            Files are then verified against the hash sent by the client
+            before they are moved into place, and every file is
+            acknowledged with the outcome.
+            Default: None (i.e. files aren't verified).
+
+            sink (callable): Called with the path and metadata of every
+            file, which returns an object that the content is written to
+            instead of the disk, or None, see the 'sink' param of Server.
+            Default: None.
+        """
+        self.def_path = pathlib.Path(def_path).resolve()
+        self.root = str(self.def_path)
+        self.log = log
+        self.executor = executor
+        self.store = store
+        # Hash of the content of the open file, computed as it is written
+        # when the file is added to the store.
+        self.hasher = None
+        self.verify = verify
+        # Hash of the open file or range computed as it is written, the
+        # hash the client sent for the file, and the hash of the last
+        # range written, which the client sends the hash of next.
+        self.checker = None
+        self.expected = None
+        self.range_checker = None
+        self.range_digest = None
+        # The [path, reason] of packed files that failed verification.
+        self.failed = list()
+        # Write tasks of packed files not yet finished, and the
+        # folders created during the transfer.
+        self.pending = list()
+        self.folders = set()
+        self.sink = sink
+        self.item = None
+        self.path = None
+        self.file = None
+        # Object from the sink that the open file is written to.
+        self.output = None
+        # Why the open file can't be written, in which case its
+        # content is discarded and the file reported as failed.
+        self.failure = None
+        self.basis = None
+        self.temp = None
+        self.decoder = None
+        # Open byte range of a striped file, [fd, offset, remaining].
+        self.range = None
+        # Partial and record paths of a resumable file, and the number of
+        # bytes of the open file that are written and recorded as written.
+        self.partial = None
+        self.offset = 0
+        self.committed = 0
+        # Number of files and content bytes written in the transfer, and
+        # the seconds spent writing content to disk and decompressing it.
+        self.files = 0
+        self.bytes = 0
+        self.disk_time = 0.0
+        self.decode_time = 0.0
+        # Wall clock time that the first content of the transfer
+        # arrived at, i.e. the time to first byte.
+        self.first_byte = None
+        self.done = False
+
+    def handle(self, frame_type, payload):
+        """
+        Handle a single frame received from the client.
+        """
+        if frame_type == MANIFEST:
+            return WANT, encode_json(self._check_manifest(
+                _decode_entries(payload, (4,))))
+
+        elif frame_type == PACK:
+            if self.first_byte is None:
+                self.first_byte = time.time()
+
+            self._unpack(payload)
+
+        elif frame_type == HAVE:
+            return HAVE, encode_json(self._link_stored(
+                _decode_entries(payload, (4,))))
+
+        elif frame_type == RESUME:
+            return RESUME, encode_json(self._resume_offsets(
+                _decode_entries(payload, (3,))))
+
+        elif frame_type == SIGREQ:
+            path = decode_json(payload)
+            if not isinstance(path, str):
+                raise ProtocolError("Malformed signature request.")
+
+            return SIGNATURE, self._signature(path)
+
+        elif frame_type == COPY:
+            self._copy_blocks(*delta.COPY.unpack(payload))
+
+        elif frame_type == ITEM:
+            self._begin_item(_decode_item(payload))
+
+        elif frame_type == RANGE:
+            self._begin_range(_decode_range(payload))
+
+        elif frame_type == DATA:
+            self.write(payload)
+
+        elif frame_type == CHECK:
+            self._check(payload.decode('ascii', 'replace'))
+
+        elif frame_type == EOF:
+            return self._end_file()
+
+        elif frame_type == ERROR:
+            return self._abandon_file(payload.decode('utf-8', 'replace'))
+
+        elif frame_type == END:
+            if self.item or self.range:
+                raise ProtocolError("End of transfer before end of file.")
+
+            self._drain(0)
+
+            # The end of the transfer is acknowledged, which tells
+            # the client that everything has been written.
+            self.done = True
+            return END, encode_json({'files': self.files, 'bytes': self.bytes,
+                'failed': self.failed})
+
+        else:
+            raise ProtocolError("Unexpected frame type {}.".format(frame_type))
+
+    def write(self, data):
+        """
+        Write a chunk of file content. The file is unbuffered, meaning
+        that the chunk is written straight from the receive buffer.
+        Compressed content is decompressed first.
+        """
+        if self.first_byte is None:
+            self.first_byte = time.time()
+
+        if self.range:
+            self._write_range(data)
+            return
+
+        if self.failure:
+            return
+
+        if not self.file and self.output is None:
+            raise ProtocolError("Received data without an open file.")
+
+        if self.decoder:
+            # Time spent decompressing is the time of the whole chunk,
+            # less the time spent writing the pieces.
+            started = time.perf_counter()
+            disk_time = self.disk_time
+            try:
+                for piece in self.decoder.decompress(data):
+                    self._write(piece)
+
+            except (zlib.error, lzma.LZMAError) as e:
+                raise ProtocolError("Corrupt compressed data: {}".format(e))
+
+            self.decode_time += (time.perf_counter() - started
+                    - (self.disk_time - disk_time))
+
+        else:
+            self._write(data)
+
+    def _write(self, data):
+        view = memoryview(data)
+        self.bytes += len(view)
+        self.offset += len(view)
+        if self.checker:
+            self.checker.update(view)
+
+        if self.hasher and self.hasher is not self.checker:
+            self.hasher.update(view)
+
+        started = time.perf_counter()
+        if self.output is not None:
+            # The sink is user code, so what it raises fails the file
+            # rather than the connection.
+            try:
+                self.output.write(view)
+
+            except Exception as e:
+                output, self.output = self.output, None
+                _abort(output)
+                self.failure = _sink_failure(e)
+
+        while self.file and view:
+            view = view[self.file.write(view):]
+
+        self.disk_time += time.perf_counter() - started
+        if self.partial and self.offset - self.committed >= RESUME_INTERVAL:
+            self._commit()
+
+    def _write_range(self, data):
+        """
+        Write data of a striped file at its position in the file.
+        """
+        fd, offset, remaining = self.range
+        view = memoryview(data)
+        self.bytes += len(view)
+        if len(view) > remaining:
+            raise ProtocolError("More data than the length of the range.")
+
+        if self.range_checker:
+            self.range_checker.update(view)
+
+        started = time.perf_counter()
+        while view:
+            written = _pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+            remaining -= written
+
+        self.disk_time += time.perf_counter() - started
+
+        if remaining:
+            self.range = [fd, offset, remaining]
+
+        else:
+            os.close(fd)
+            self.range = None
+            self._end_range()
+
+    def close(self):
+        # Packed files still being written are finished first.
+        for task in self.pending:
+            task.exception()
+
+        self.pending = list()
+
+        if self.file:
+            # An interrupted resumable file is kept together with the
+            # progress, such that the client can continue it later.
+            if self.partial:
+                try:
+                    self._commit()
+
+                except OSError:
+                    pass
+
+                self.partial = None
+
+            self.file.close()
+            self.file = None
+
+        if self.range:
+            os.close(self.range[0])
+            self.range = None
+
+        # The sink is told that the file it was given won't be complete.
+        if self.output is not None:
+            output, self.output = self.output, None
+            _abort(output)
+
+        self.decoder = None
+        self.hasher = None
+        self.checker = None
+        self.expected = None
+        self.range_checker = None
+        self.failure = None
+
+        if self.basis:
+            self.basis.close()
+            self.basis = None
+
+        # A file reconstructed from a delta is only written over
+        # the old copy once complete.
+        if self.temp:
+            if self.temp.exists():
+                os.remove(str(self.temp))
+
+            self.temp = None
+
+    def _resolve(self, path):
+        """
+        Resolve the path of an item relative to the default path.
+        Absolute paths and paths escaping the default path are rejected.
+        The check is made on the path itself, without touching the disk,
+        since it runs for every entry of a manifest.
+        """
+        parts = str(path).split('/')
+        if not parts[0] or '..' in parts or '\\' in str(path):
+            raise ProtocolError("Path {} is outside of the default " \
+                    "path.".format(path))
+
+        path = os.path.join(self.root, *parts)
+        if self.store and self.store.contains(path):
+            raise ProtocolError("Path {} is inside the store.".format(path))
+
+        return pathlib.Path(path)
+
+    def _begin_item(self, item):
+        if self.item or self.range:
+            raise ProtocolError("New item before end of file.")
+
+        path = self._resolve(item.path)
+        if item.type_ == "folder":
+            if not path.exists():
+                os.makedirs(path)
+                if self.log:
+                    self.log('info', 'Created folder on path {}.'.format(path))
+
+            self.folders.add(str(path))
+
+        elif item.type_ == "file":
+            # Striped, resumed and delta files are always written to disk.
+            if self.sink and not (item.stripes or item.delta or item.offset):
+                try:
+                    self.output = self.sink(item.path, item.to_dict())
+
+                except Exception as e:
+                    self.failure = _sink_failure(e)
+
+            self.item = item
+            self.path = path
+            if item.codec:
+                try:
+                    self.decoder = compress.Decoder(item.codec)
+
+                except ValueError as e:
+                    raise ProtocolError(str(e))
+
+            # Striped files are verified range by range instead.
+            if self.verify and not item.stripes:
+                self.checker = integrity.new(self.verify)
+
+            if self.output is not None or self.failure:
+                return
+
+            # A file that can't be written is reported as failed, and
+            # its content is discarded, while the transfer goes on.
+            try:
+                self._makedirs(str(path.parent))
+                self._open_file(item, path)
+
+            except OSError as e:
+                self.failure = 'not written: {}'.format(e.strerror or e)
+
+        else:
+            raise ProtocolError("Unknown item type {}.".format(item.type_))
+
+    def _open_file(self, item, path):
+        """
+        Open the file that the content of an item is written to.
+        """
+        if self.store:
+            # Files sharing an inode with other paths are never
+            # written in place.
+            self.store.detach(str(path))
+            if item.digest and not (item.stripes or item.delta
+                    or item.offset):
+                # The hash is shared when it is the one of the store.
+                self.hasher = (self.checker if self.verify == 'blake2b'
+                        else hashlib.blake2b())
+
+        if item.stripes:
+            # The content arrives as byte ranges, possibly over
+            # other connections, written in place in a temporary
+            # file that is moved into place once complete.
+            self.temp = _striped_path(path)
+            os.close(_open_striped(self.temp, item.size))
+
+        elif item.delta:
+            # The file is reconstructed next to the old copy, from
+            # literal data and blocks copied from the old copy.
+            self.basis = open(str(path), 'rb')
+            self.temp, self.file = _open_temp(path, '.reloc-delta')
+
+        elif item.size >= RESUME_THRESHOLD:
+            # Large files are written to a partial file of their own,
+            # and only moved into place once complete. The record of the
+            # progress names it, such that an interrupted transfer can
+            # be continued later.
+            record = _record_path(path)
+            progress = _read_record(record)
+            offset = item.offset or 0
+            if offset:
+                if offset != _committed_offset(progress, item.size,
+                        item.mtime):
+                    raise ProtocolError("Transfer of {} can't be resumed " \
+                            "at offset {}.".format(item.path, offset))
+
+                part = progress['part']
+                self.file = open(str(part), 'r+b', buffering = 0)
+                if not _lock(self.file):
+                    self.file.close()
+                    self.file = None
+                    raise OSError(errno.EBUSY, "Resumed by another transfer")
+
+                self.file.truncate(offset)
+                self.file.seek(offset)
+
+            else:
+                part, self.file = _open_temp(path, '.reloc-part')
+                _lock(self.file)
+                if progress:
+                    _discard_part(progress['part'])
+
+            self.partial = (part, record)
+            self.offset = self.committed = offset
+            self._commit()
+            # The hash covers the part written before resuming too.
+            if self.checker:
+                integrity.update_from_file(self.checker, self.file, 0, offset)
+
+        elif self.verify:
+            # Only moved into place once verified.
+            self.temp, self.file = _open_temp(path, '.reloc-tmp')
+
+        else:
+            self.file = open(path, 'wb', buffering = 0)
+
+    def _end_file(self):
+        """
+        Finish the open file. A verified file is moved into place, while a
+        file failing verification, or failing to be moved into place, is
+        discarded and reported as failed.
+
+        Returns:
+            The acknowledgement of the file when verifying, otherwise None.
+        """
+        if not self.item or self.range:
+            raise ProtocolError("End of file without an open file.")
+
+        if self.decoder:
+            self._write(self.decoder.flush())
+            self.decoder = None
+
+        # A partial file is kept open, i.e. locked, until it has been
+        # moved into place, such that no other transfer resumes it.
+        if self.file and not self.partial:
+            self.file.close()
+            self.file = None
+
+        item = self.item
+        error = self.failure
+        if self.checker and not error:
+            if self.expected is None:
+                error = 'missing checksum'
+
+            elif self.checker.hexdigest() != self.expected:
+                error = 'checksum mismatch'
+
+        if not error:
+            try:
+                if self.temp:
+                    os.replace(str(self.temp), str(self.path))
+                    self.temp = None
+
+                if self.partial:
+                    part, record = self.partial
+                    os.replace(str(part), str(self.path))
+                    self.partial = None
+                    _release_record(record, part)
+
+            except OSError as e:
+                error = 'not moved into place: {}'.format(e.strerror or e)
+
+        if self.file and not self.partial:
+            self.file.close()
+            self.file = None
+
+        if error:
+            return self._fail_file(item, error)
+
+        # A file given to the sink is complete once verified.
+        output, self.output = self.output, None
+        if output is not None and hasattr(output, 'close'):
+            try:
+                output.close()
+
+            except Exception as e:
+                self.output = output
+                return self._fail_file(item, _sink_failure(e))
+
+        digest = self.hasher.hexdigest() if self.hasher else None
+        self.close()
+        self.files += 1
+
+        # Keep the modification time of the client, which is what
+        # a later sync compares against.
+        if item.mtime and output is None:
+            os.utime(str(self.path), (item.mtime, item.mtime))
+
+        # Content is only stored under the hash it was checked to have.
+        if digest and digest == item.digest:
+            self.store.add(str(self.path), digest)
+
+        if self.log:
+            self.log('info', 'Saved file "{}" on path {}.'.format(
+                item.name, self.path))
+
+        self.item = None
+        self.path = None
+        if self.verify:
+            return ACK, encode_json([item.path, None])
+
+    def _fail_file(self, item, error):
+        """
+        Discard the open file, and report it as failed.
+
+        Returns:
+            The acknowledgement of the file when verifying, otherwise None,
+            in which case the file is reported at the end of the transfer.
+        """
+        # A partial file is discarded too, since it can't be resumed.
+        if self.partial:
+            part, record = self.partial
+            if os.path.exists(str(part)):
+                os.remove(str(part))
+
+            _release_record(record, part)
+
+        self.partial = None
+        self.close()
+        if self.log:
+            self.log('exception', 'File on path {} failed: ' \
+                    '{}.'.format(self.path, error))
+
+        self.item = None
+        self.path = None
+        if not self.verify:
+            self.failed.append([item.path, error])
+            return None
+
+        return ACK, encode_json([item.path, error])
+
+    def _abandon_file(self, error):
+        """
+        Discard the open file, which the client failed to send after part
+        of its content, e.g. since it changed while being read.
+
+        Returns:
+            The acknowledgement of the file when verifying, otherwise None.
+        """
+        if not self.item or self.range or self.item.stripes:
+            raise ProtocolError("Error without an open file.")
+
+        # A file written in place only holds part of the content.
+        if self.file and not (self.temp or self.partial):
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(str(self.path))
+
+            except OSError:
+                pass
+
+        return self._fail_file(self.item, error)
+
+    def _signature(self, path):
+        """
+        Returns:
+            The block signature of the file on 'path', which is empty
+            if there is no such file.
+        """
+        path = self._resolve(path)
+        try:
+            size = os.stat(str(path)).st_size
+
+        except OSError:
+            return delta.SIGNATURE.pack(0, 0)
+
+        return delta.signature(path, size)
+
+    def _copy_blocks(self, index, count):
+        if self.failure:
+            return
+
+        if not self.basis:
+            raise ProtocolError("Received block reference without an old copy.")
+
+        block_size = self.item.delta
+        self.basis.seek(index * block_size)
+        remaining = count * block_size
+        while remaining:
+            chunk = self.basis.read(min(remaining, 2**20))
+            if not chunk:
+                raise ProtocolError("Block reference outside of the old copy.")
+
+            self._write(chunk)
+            remaining -= len(chunk)
+
+    def _begin_range(self, data):
+        """
+        Params:
+            data (dict): The path, size of the whole file, and the
+            offset and length of the range.
+        """
+        if self.range or (self.item and not self.item.stripes):
+            raise ProtocolError("New range before end of file.")
+
+        path = self._resolve(data['path'])
+        self._makedirs(str(path.parent))
+        if self.verify:
+            self.range_checker = integrity.new(self.verify)
+
+        fd = _open_striped(_striped_path(path), data['size'])
+        if data['length']:
+            self.range = [fd, data['offset'], data['length']]
+
+        else:
+            os.close(fd)
+            self._end_range()
+
+    def _end_range(self):
+        if self.range_checker:
+            self.range_digest = self.range_checker.hexdigest()
+            self.range_checker = None
+
+    def _check(self, digest):
+        """
+        Verify the range just written against its hash, or keep the
+        hash of the open file, which is verified at the end of the file.
+        """
+        if self.range_digest:
+            expected, self.range_digest = self.range_digest, None
+            if digest != expected:
+                raise ProtocolError("Range failed verification.")
+
+        elif self.item and self.checker:
+            self.expected = digest
+
+        elif self.item and not self.verify:
+            # Hashes sent for other servers, e.g. ones that this
+            # server relays to, are ignored when not verifying.
+            pass
+
+        else:
+            raise ProtocolError("Hash without content to verify.")
+
+    def _commit(self):
+        """
+        Record the progress of the open resumable file. The content is
+        flushed to disk first, such that the record never claims more
+        than what survives e.g. a power loss.
+        """
+        part, record = self.partial
+        os.fsync(self.file.fileno())
+        with open(str(record), 'wb') as f:
+            f.write(encode_json({'size': self.item.size,
+                'mtime': self.item.mtime, 'offset': self.offset,
+                'part': part.name}))
+
+        self.committed = self.offset
+
+    def _unpack(self, payload):
+        """
+        Write the files of a pack. The folders of the files are created
+        first, and the files are then written in parallel on the executor.
+        """
+        length, = PACK_INDEX.unpack_from(payload)
+        start = PACK_INDEX.size + length
+        entries = _decode_entries(payload[PACK_INDEX.size:start], (3, 4))
+        view = memoryview(payload)[start:]
+        files = list()
+        offset = 0
+        for entry in entries:
+            name, size, mtime = entry[:3]
+            path = str(self._resolve(name))
+            if size < 0 or offset + size > len(view):
+                raise ProtocolError("Packed files don't match the index.")
+
+            digest = entry[3] if len(entry) > 3 else None
+            files.append((name, path, view[offset:offset + size], mtime, digest))
+            offset += size
+
+        if offset != len(view):
+            raise ProtocolError("Packed files don't match the index.")
+
+        self.files += len(files)
+        self.bytes += offset
+        if self.sink:
+            files = self._sink_packed(files)
+
+        for folder in {os.path.dirname(file[1]) for file in files}:
+            self._makedirs(folder)
+
+        if self.executor:
+            self._drain(MAX_PENDING)
+            for index in range(0, len(files), PACK_TASK):
+                self.pending.append(self.executor.submit(_write_packed,
+                    files[index:index + PACK_TASK], self.store, self.verify))
+
+        else:
+            self.failed.extend(_write_packed(files, self.store, self.verify))
+
+        if self.log:
+            self.log('info', 'Saved {} packed files.'.format(len(files)))
+
+    def _sink_packed(self, files):
+        """
+        Hand packed files to the sink, verifying them first.
+
+        Returns:
+            The files that the sink left to be written to disk.
+        """
+        declined = list()
+        for name, path, data, mtime, digest in files:
+            item = Item.from_dict({'name': os.path.basename(path),
+                'path': name, 'type_': 'file', 'size': len(data),
+                'mtime': mtime, 'digest': digest})
+            try:
+                output = self.sink(name, item.to_dict())
+
+            except Exception as e:
+                self.failed.append([name, _sink_failure(e)])
+                continue
+
+            if output is None:
+                declined.append((name, path, data, mtime, digest))
+                continue
+
+            if self.verify and digest:
+                checker = integrity.new(self.verify)
+                checker.update(data)
+                if checker.hexdigest() != digest:
+                    self.failed.append([name, 'checksum mismatch'])
+                    _abort(output)
+                    continue
+
+            try:
+                output.write(data)
+                if hasattr(output, 'close'):
+                    output.close()
+
+            except Exception as e:
+                self.failed.append([name, _sink_failure(e)])
+                _abort(output)
+
+        return declined
+
+    def _drain(self, limit):
+        """
+        Wait until at most 'limit' write tasks are pending, raising
+        the first error of the tasks waited for.
+        """
+        while len(self.pending) > limit:
+            self.failed.extend(self.pending.pop(0).result())
+
+    def _link_stored(self, entries):
+        """
+        Params:
+            entries (list): Entries [path, size, mtime, hash] of files.
+
+        Returns:
+            The indices of the entries that were linked to content
+            in the store, which the client doesn't need to send.
+        """
+        linked = list()
+        if not self.store:
+            return linked
+
+        for index, (path, size, mtime, digest) in enumerate(entries):
+            path = self._resolve(path)
+            self._makedirs(str(path.parent))
+            try:
+                found = self.store.link(digest, str(path))
+
+            except ValueError as e:
+                raise ProtocolError(str(e))
+
+            if found:
+                if mtime:
+                    os.utime(str(path), (mtime, mtime))
+
+                linked.append(index)
+                self.files += 1
+                if self.log:
+                    self.log('info', 'Linked file on path {} to stored ' \
+                            'content.'.format(path))
+
+        return linked
+
+    def _makedirs(self, folder):
+        if folder not in self.folders:
+            os.makedirs(folder, exist_ok = True)
+            self.folders.add(folder)
+
+    def _resume_offsets(self, entries):
+        """
+        Params:
+            entries (list): Entries [path, size, mtime] of the files.
+
+        Returns:
+            The offset that every file can be resumed from.
+        """
+        offsets = list()
+        for path, size, mtime in entries:
+            progress = _read_record(_record_path(self._resolve(path)))
+            offsets.append(_committed_offset(progress, size, mtime))
+
+        return offsets
+
+    def _check_manifest(self, entries):
+        """
+        Params:
+            entries (list): Manifest entries [path, size, mtime, hash].
+
+        Returns:
+            The indices of the entries that the client needs to send.
+        """
+        wanted = list()
+        for index, (path, size, mtime, digest) in enumerate(entries):
+            if not is_current(self._resolve(path), size, mtime, digest):
+                wanted.append(index)
+
+        return wanted
@@ -0,0 +1,162 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Package imports
+from .util import Item, Stream
+
+# Number of threads walking the folders of a tree in parallel.
+SCAN_WORKERS = 8
+
+
+def _file_item(path, name, stat):
+    item = Item()
+    item.path = path
+    item.name = name
+    item.type_ = "file"
+    item.size = stat.st_size
+    item.mtime = stat.st_mtime
+    item.suffix = os.path.splitext(name)[1]
+    return item
+
+
+def stream_item(data, path):
+    """
+    Create the item of content sent from memory, see Stream, which is
+    saved on 'path' under the default path of the server.
+    """
+    name = path.rstrip('/').rsplit('/', 1)[-1]
+    item = Item()
+    item.path = path
+    item.name = name
+    item.type_ = "file"
+    item.stream = Stream(data)
+    # Content of unknown size is sent in a data frame per chunk.
+    item.size = item.stream.size or 0
+    item.mtime = time.time()
+    item.suffix = os.path.splitext(name)[1]
+    return item
+
+
+def _scan_folder(folder, path):
+    """
+    List the entries of a single folder. The type of every entry comes
+    from the listing itself, so only files need a stat call.
+
+    Params:
+        folder (str): The folder to list.
+
+        path (str): The path of the folder as sent to the server.
+
+    Returns:
+        The items of the entries, and the (folder, path) of every
+        subfolder to walk next.
+    """
+    items = list()
+    folders = list()
+    try:
+        entries = list(os.scandir(folder))
+
+    except OSError:
+        return items, folders
+
+    for entry in entries:
+        child_path = path + '/' + entry.name
+        try:
+            if entry.is_dir():
+                item = Item()
+                item.path = child_path
+                item.type_ = "folder"
+                items.append(item)
+                # Linked folders are sent, but not walked into.
+                if not entry.is_symlink():
+                    folders.append((entry.path, child_path))
+
+            elif entry.is_file() and entry.name[0] != '.':
+                item = _file_item(child_path, entry.name, entry.stat())
+                item.source = entry.path
+                items.append(item)
+
+        except OSError:
+            # E.g. broken links, or entries removed while scanning.
+            continue
+
+    return items, folders
+
+
+def _walk(parent_path, workers):
+    """
+    Walk a folder, where every subfolder is listed on the thread pool as
+    soon as it is found. Items are generated as the folders are listed,
+    and a folder is always generated before its content.
+    """
+    root = Item()
+    root.path = parent_path.stem
+    root.type_ = "folder"
+    yield root
+
+    executor = ThreadPoolExecutor(max_workers = workers)
+    pending = {executor.submit(_scan_folder, str(parent_path), root.path)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for task in done:
+                items, folders = task.result()
+                for folder, path in folders:
+                    pending.add(executor.submit(_scan_folder, folder, path))
+
+                for item in items:
+                    yield item
+
+    finally:
+        # The walk is stopped early if the transfer fails.
+        for task in pending:
+            task.cancel()
+
+        executor.shutdown(wait = False)
+
+
+def iter_items(parent_path, workers = SCAN_WORKERS):
+    """
+    Generate the items to transfer for a single file or a folder,
+    as they are found. In case of folder, all folders and files
+    included in the parent folder are generated, excluding .dotfiles.
+
+    Params:
+        parent_path (Path): Absolute path to the file or folder.
+
+        workers (int): Number of threads walking the folders.
+
+    Returns:
+        An iterator over the items, or None if there is no
+        such file or folder.
+    """
+    if parent_path.is_file() and parent_path.name[0] != '.':
+        item = _file_item(parent_path.name, parent_path.name, parent_path.stat())
+        item.source = str(parent_path)
+        return iter([item])
+
+    elif parent_path.is_dir():
+        return _walk(parent_path, workers)
+
+    return None
+
+
+def collect_items(parent_path):
+    """
+    Collect the items to transfer for a single file or a folder.
+
+    Returns:
+        A list of items, or None if there is no such file or folder.
+    """
+    items = iter_items(pathlib.Path(parent_path))
+    return None if items is None else list(items)
@@ -9,22 +9,36 @@ MIT License.
 import sys
 import socket
 import pathlib
-import pickle
 import time
 import errno
 import random
-import ipify
-import requests
-import logging
 import os
-import datetime
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread, active_count
 
+# Package imports
+from .protocol import (FRAME, HEADER, DATA, END, ERROR, PING, PROBE, PACK,
+        BUFFER_SIZE,
+        MAX_FRAME_SIZE, ProtocolError, send_frame, pack_frame, recv_frame,
+        recv_header, recv_payload, encode_header, decode_header)
+from .receiver import Receiver
+from .store import STORE_NAME, BlobStore
+from .metrics import Metrics
+from .fanout import Relay
+from .pipeline import WRITE_BUFFERS, BufferPool, WriteBehind
+from .shaping import FairScheduler
+from .logger import get_logger
+from . import compress, external_ip, integrity, tuning
+
 class Server():
     """
     Methods:
         _update_log: Private method to update information to the log.
 
+        add_hook: Register a function that is called with every
+        connection and transfer, see Metrics.add_hook.
+
         add_path: Let's the user add it's own default path for where
         the receiving files will be saved. The home folder serves 
         as the standardized default path.
@@ -34,7 +48,11 @@ class Server():
 
         _get_external_ip: Private method to get the external ip
         of the computer that starts the server. Useful such that the user
-        doesn't have to specify the external ip.
+        doesn't have to specify the external ip. The ip is looked up in
+        the background and cached, such that startup never waits on it.
+
+        _found_external_ip: Private method called with the external ip
+        once it has been looked up.
 
         _get_internal_ip: Private method to get the internal ip of the computer.
 
@@ -42,12 +60,31 @@ class Server():
         The user calls this method the will either run on the main thread, or
         on a separate thread, depending on whether is_async is true.
 
-        _receive_file: Private method that handles the receiving of incoming
-        data streams.
+        _receive_file: Private method that accepts incoming connections
+        and queues them for the worker threads. Connections are rejected
+        when the queue is full.
+
+        _worker: Private method run by each worker thread, handling
+        queued connections one at a time.
+
+        _reject: Private method to turn away a connection with an error.
+
+        _handle_connection: Private method that handles the receiving of
+        the framed data stream from a single connection.
+
+        _receive_transfer: Private method that receives a single transfer
+        on a connection.
+
+        _answer_probe: Private method that answers the probes of a client.
     """
     def __init__(self, mode = 'internal', port = None,
             host = None, def_path = None,
-            is_async = False, use_log = False):
+            is_async = False, use_log = False, max_transfers = 4,
+            backlog = 10, queue_size = 16, max_frame_size = MAX_FRAME_SIZE,
+            buffer_size = BUFFER_SIZE, timeout = None, unpack_workers = None,
+            store = None, stats_port = None, stats_interval = None,
+            relay = False, socket_buffer = None, write_buffers = WRITE_BUFFERS,
+            rate_limit = None, reuse_port = False, sink = None):
         """
         Initiate connection with the server. By defualt,
         connection is internal, meaning only local
@@ -98,12 +135,147 @@ class Server():
             use_log (bool): Specify whether or not to use logging
             for the server.
             Defualt: False.
+
+            max_transfers (int): The maximum number of transfers handled
+            concurrently, each transfer is handled on its own worker thread.
+            Default: 4.
+
+            backlog (int): The number of connections the operating
+            system keeps waiting to be accepted.
+            Default: 10.
+
+            queue_size (int): The number of accepted connections that can
+            wait for a free worker. Connections arriving when the queue is
+            full are rejected with an error, the client may try again later.
+            Default: 16.
+
+            max_frame_size (int): The largest metadata frame accepted
+            from a client. Limits the memory used by each connection.
+            Default: 1 MiB.
+
+            buffer_size (int): Size of the buffers that each connection
+            receives file content into before it is written to disk.
+            The buffers are allocated once per connection and reused.
+            Default: 256 KiB.
+
+            timeout (float): Close connections that have been idle for
+            this many seconds, such that a stalled client doesn't occupy
+            a worker forever. Specify this as None will disable the timeout.
+            Default: None.
+
+            unpack_workers (int): Number of threads that write the small
+            files packed together by clients, shared by all connections.
+            Default: None (i.e. chosen from the number of cores).
+
+            store (str): Keep the content of received files in a content
+            addressed store in this folder, and link files with the same
+            content to the stored copy, i.e. with reflinks where the file
+            system supports it and otherwise copies. Clients enabling
+            dedup then never send content the server already holds.
+            Specify True to keep the store in a '.reloc-store' folder in
+            the default path. The store should be on the same file system
+            as the default path.
+            Default: None (i.e. no store).
+
+            stats_port (int): Serve the metrics of the server over http on
+            this port on localhost, as text or as json on /json. The
+            metrics are always available from 'self.metrics'.
+            Default: None (i.e. not served).
+
+            stats_interval (float): Print the metrics of the server every
+            this many seconds.
+            Default: None (i.e. never printed).
+
+            relay (bool): Forward transfers to the downstream servers that
+            a fan-out client asks for, as the transfers arrive, see
+            FanoutClient. The end of every transfer is acknowledged once
+            the downstream servers have finished it too. Only enable this
+            where every client may make the server connect to any host.
+            Default: False.
+
+            socket_buffer (int): Size of the send and receive buffers of
+            every connection, in bytes. Links with a large bandwidth-delay
+            product, e.g. fast links over long distances, need buffers of
+            at least twice that product to be kept full.
+            Default: None (i.e. left to the operating system, which grows
+            the buffers by itself on Linux).
+
+            write_buffers (int): Number of buffers of every connection. The
+            content of large files is written to disk on a thread of its
+            own, while the next buffers are received, such that receiving
+            and writing overlap. Every connection uses at most this many
+            buffers, i.e. 'write_buffers' times 'buffer_size' bytes.
+            Default: 8.
+
+            rate_limit (int): Limit the bytes per second that all
+            connections together write to disk. The limit is shared
+            fairly between the connections, weighted by the priority that
+            each client asks for, such that small transfers finish quickly
+            next to large ones, while a connection alone gets all of it.
+            Default: None (i.e. unlimited).
+
+            reuse_port (bool): Let many servers listen on the same port,
+            e.g. one per process, while the kernel spreads the incoming
+            connections between them. Linux only, see PreforkServer.
+            Default: False.
+
+            sink (callable): Called as sink(path, item) with the path and
+            metadata of every received file, before its content. Returns
+            None to write the file under the default path as usual, or an
+            object whose 'write' is called with every chunk of the content,
+            which is only valid during the call, and whose 'close' is
+            called once the file is complete and verified, or 'abort', if
+            it has one, when it isn't. Striped, resumed and delta files
+            are always written to disk. See MemorySink.
+            Default: None (i.e. every file is written to disk).
         """
         self.sock = socket.socket(
                 socket.AF_INET, socket.SOCK_STREAM)
         self.is_async = is_async
         self.use_log = use_log
         self.log = None
+        self.max_transfers = max_transfers
+        self.backlog = backlog
+        self.queue_size = queue_size
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+        self.write_buffers = write_buffers
+        self.timeout = timeout
+        self.relay = relay
+        self.sink = sink
+        self.unpackers = ThreadPoolExecutor(max_workers = unpack_workers)
+        self.metrics = Metrics()
+        self.stats = None
+        # The external ipv4 and ipv6 in external mode, once looked up.
+        self.external_ips = None
+
+        for name in ('max_transfers', 'backlog', 'queue_size',
+                'max_frame_size', 'buffer_size', 'write_buffers'):
+            value = getattr(self, name)
+            if not isinstance(value, int) or value < 1:
+                raise ValueError("{} specified on the wrong format, " \
+                        "should be a positive int.".format(name))
+
+        if socket_buffer is not None and (not isinstance(socket_buffer, int)
+                or socket_buffer < 1):
+            raise ValueError("socket_buffer specified on the wrong format, " \
+                    "should be a positive int.")
+
+        if rate_limit is not None and (not isinstance(rate_limit, (int, float))
+                or rate_limit <= 0):
+            raise ValueError("rate_limit specified on the wrong format, " \
+                    "should be a positive number of bytes per second.")
+
+        # Shares the write bandwidth between the connections, if limited.
+        self.scheduler = FairScheduler(rate_limit) if rate_limit else None
+
+        if not isinstance(self.timeout, (type(None), int, float)):
+            raise TypeError("Timeout specified on the wrong format, " \
+                    "should be an int or a float, i.e. 7 or 7.7")
+
+        if not isinstance(stats_interval, (type(None), int, float)):
+            raise TypeError("Stats interval specified on the wrong format, " \
+                    "should be an int or a float, i.e. 7 or 7.7")
 
         # If default_path isn't specified, use the home directory as
         # the default path.
@@ -121,6 +293,11 @@ class Server():
 
             self.def_path = pathlib.Path(def_path)
 
+        self.store = None
+        if store:
+            self.store = BlobStore(self.def_path / STORE_NAME
+                    if store is True else store)
+
         if self.use_log:
             self._update_log('info', 'Starting server.')
 
@@ -172,19 +349,38 @@ class Server():
 
         self.sock.setsockopt(socket.SOL_SOCKET,
                 socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # Accepted connections inherit the buffers of the listening socket.
+        if socket_buffer:
+            tuning.set_buffers(self.sock, socket_buffer)
+
         self.sock.bind((host, port))
-        self.sock.listen(10)
+        self.sock.listen(self.backlog)
 
         print("Server connected to host: {}".format(host))
         print("Server connected to port: {}".format(port))
         if mode.lower() == 'external':
-            ips = self._get_external_ip()
-            external_host = ips['ipv4']
-            print("External host: {}".format(external_host))
+            self._get_external_ip()
 
         if self.use_log:
             self._update_log('info', 'Server started on host {}, port {}.'.format(host, port))
 
+        if stats_port:
+            self.stats = self.metrics.serve('localhost', stats_port)
+            print("Serving metrics on port: {}".format(stats_port))
+
+        if stats_interval:
+            self.metrics.dump_every(stats_interval)
+
+    def add_hook(self, hook):
+        """
+        Register a function that is called as hook(event, data) with
+        every 'connection' and 'transfer' event of the server.
+        """
+        self.metrics.add_hook(hook)
+
     def _update_log(self, log_type, msg):
         """
         Handle updates to logs for the server.
@@ -193,41 +389,18 @@ class Server():
         correct files and folders has been transfered.
         Exceptions will be stored as well.
 
+        Records are only queued here, they are formatted and written
+        to a log file per day, i.e. logs/<date>.log, by a background
+        thread. Calling this from the receive loop is therefore cheap.
+
         Params:
             log_type (str): Specify the type of event that
             will be logged. Can be 'info' and 'exception' for now.
 
             msg (str): Message to be written to the log.
         """
-        folder = pathlib.Path('logs')
-        if not folder.exists():
-            os.makedirs(folder)
-
         if not self.log:
-            self.log = logging.getLogger(__name__)
-            self.log.setLevel(logging.INFO)
-            handler = logging.FileHandler(log_path)
-            formatter = logging.Formatter('%(asctime)s : %(levelname)s' \
-                    ': %(name)s : %(message)s')
-            handler.setFormatter(formatter)
-            self.log.addHandler(handler)
-
-        date_today = pathlib.Path(str(datetime.datetime.today().date()))
-        log_path = pathlib.Path(str(folder / date_today) + '.log')
-        if not log_path.exists():
-            # Create new handler
-            new_handler = logging.FileHandler(log_path, 'a')
-            new_formatter = logging.Formatter('%(asctime)s : %(levelname)s' \
-                    ': %(name)s : %(message)s')
-            new_handler.setFormatter(new_formatter)
-
-            # Get logger and remove all old handlers
-            logger = logging.getLogger()
-            for handler in logger.handlers[:]:
-                logger.removeHandler(handler)
-
-            # Add new handler
-            logger.addHandler(new_handler)
+            self.log = get_logger(__name__)
 
         if log_type == 'info':
             self.log.info(msg)
@@ -272,15 +445,24 @@ class Server():
     def _get_external_ip(self):
         """
         Get external ip of the server. Utilizing ipify
-        to retrieve both external ipv4 and ipv6.
+        to retrieve both external ipv4 and ipv6, at once and on a
+        background thread. The ips are cached on disk for an hour.
+
+        Returns:
+            The thread looking up the ips.
         """
-        ips = dict()
-        ips['ipv4'] = requests.get('https://api.ipify.org').text
-        ips['ipv6'] = requests.get('https://api6.ipify.org').text
+        return external_ip.lookup_async(self._found_external_ip)
+
+    def _found_external_ip(self, ips):
+        self.external_ips = ips
+        if not ips['ipv4'] and not ips['ipv6']:
+            print("Could not retrieve the external host.")
+            return
+
+        print("External host: {}".format(ips['ipv4'] or ips['ipv6']))
         if self.use_log:
             self._update_log('info', 'External ipv4 {} and ipv6 {} received'.format(
-                ips['ipv4'], ipv['ipv6']))
-        return ips
+                ips['ipv4'], ips['ipv6']))
 
     def _get_internal_ip(self):
         """
@@ -317,50 +499,253 @@ class Server():
     def _receive_file(self):
         """
         Start to continuously listening for incoming
-        data stream from the client. The data contains
-        list of objects, either representing a single file
+        connections from clients. Each connection carries
+        a framed stream of items, either representing a single file
         or a whole folder structure with multiple folders/files.
-        In case of receiving a folder, all items in the folder
-        will be saved.
+        Files are written to disk chunk by chunk as they arrive.
         """
         print("Saving files to path: {}".format(self.def_path))
+        self.connections = queue.Queue(maxsize = self.queue_size)
+        for _ in range(self.max_transfers):
+            Thread(target = self._worker, daemon = True).start()
+
         with self.sock:
             while True:
                 connection, adr = self.sock.accept()
-                with connection:
-                    print("Connected by client {} on port {}.".format(adr[0], adr[1]))
-                    if self.use_log:
-                        self._update_log('info', 'Connected by client {} on port {}.'.format(
-                            adr[0], adr[1]))
-
-                    byte_data = list()
-                    while True:
-                        partial = connection.recv(2**12)
-                        if not partial:
-                            break
-
-                        # Appending the partial data to list is a lot
-                        # faster than concatenate byte strings.
-                        byte_data.append(partial)
-                    
-                    if byte_data:
-                        data = pickle.loads(b''.join(byte_data))
-                        for item in data:
-                            path = self.def_path / item.path
-                            if item.type_ == "folder":
-                                if not path.exists():
-                                    os.makedirs(path)
-                                    if self.use_log:
-                                        self._update_log('info', 'Created folder on path {}.'.format(
-                                            path))
-
-                            elif item.type_ == "file":
-                                with open(path, 'wb') as f:
-                                    f.write(item.content)
-
-                                if self.use_log:
-                                    self._update_log('info', 'Saved file "{}" on path {}.'.format(
-                                        item.name, path))
+                self.metrics.add('connections')
+                try:
+                    self.connections.put_nowait((connection, adr))
+                    self.metrics.set('queue_depth', self.connections.qsize())
 
+                except queue.Full:
+                    self.metrics.add('rejected')
+                    self._reject(connection, adr, "Server is busy, " \
+                            "try again later.")
 
+    def _worker(self):
+        """
+        Handle queued connections, one at a time.
+        """
+        while True:
+            connection, adr = self.connections.get()
+            self.metrics.set('queue_depth', self.connections.qsize())
+            try:
+                self._handle_connection(connection, adr)
+
+            finally:
+                self.connections.task_done()
+
+    def _reject(self, connection, adr, reason):
+        """
+        Send an error frame to the client and close the connection.
+        """
+        with connection:
+            print("Rejected client {} on port {}: {}".format(adr[0], adr[1], reason))
+            if self.use_log:
+                self._update_log('info', 'Rejected client {} on port {}: {}'.format(
+                    adr[0], adr[1], reason))
+
+            try:
+                send_frame(connection, ERROR, reason.encode('utf-8'))
+
+            except OSError:
+                pass
+
+    def _handle_connection(self, connection, adr):
+        """
+        Receive the transfers from a connected client. A connection
+        carries any number of transfers, e.g. from a client keeping
+        its session alive, until the client closes it between two
+        transfers.
+
+        Params:
+            connection (socket): The accepted connection.
+
+            adr (tuple): The address of the client.
+        """
+        with connection:
+            connection.settimeout(self.timeout)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print("Connected by client {} on port {}.".format(adr[0], adr[1]))
+            if self.use_log:
+                self._update_log('info', 'Connected by client {} on port {}.'.format(
+                    adr[0], adr[1]))
+
+            self.metrics.change('active_connections', 1)
+            started = time.perf_counter()
+            received = 0
+            receiver = None
+            writer = None
+            relay = None
+            try:
+                frame = recv_frame(connection, self.max_frame_size)
+                if frame is None:
+                    return
+
+                if frame[0] != HEADER:
+                    raise ProtocolError("Expected header frame.")
+
+                options = decode_header(frame[1])
+                verify = integrity.negotiate(options.get('verify'))
+                codecs = compress.negotiate(options.get('codecs'))
+                # The client hashes files if this server or any server
+                # that it relays to verifies them.
+                hashed = verify
+                max_frame_size = self.max_frame_size
+                if self.relay and options.get('relay'):
+                    # The downstream servers are connected to first, such
+                    # that the answer suits the whole tree below.
+                    relay = Relay(options['relay'], options, self.timeout)
+                    codecs, hashed, max_frame_size = relay.negotiate(codecs,
+                            verify, max_frame_size)
+
+                send_frame(connection, HEADER, encode_header(
+                    max_transfers = self.max_transfers,
+                    max_frame_size = max_frame_size,
+                    store = self.store is not None,
+                    codecs = codecs,
+                    verify = hashed,
+                    probe = True))
+
+                # File content is received into buffers that are reused
+                # for the whole connection, and written behind.
+                writer = WriteBehind(BufferPool(self.write_buffers,
+                    self.buffer_size))
+                share = (self.scheduler.share(options.get('priority', 1))
+                        if self.scheduler else None)
+                while True:
+                    receiver = Receiver(self.def_path,
+                            log = self._update_log if self.use_log else None,
+                            executor = self.unpackers, store = self.store,
+                            verify = verify, sink = self.sink)
+                    if not self._receive_transfer(connection, writer, receiver,
+                            relay, share):
+                        break
+
+                    received += receiver.bytes
+
+            except (ProtocolError, OSError) as e:
+                print("Transfer from client {} failed: {}".format(adr[0], e))
+                if self.use_log:
+                    self._update_log('exception', 'Transfer from client {} ' \
+                            'failed.'.format(adr[0]))
+
+            # Any other error fails only this connection, such that the
+            # worker keeps handling the connections after it.
+            except Exception as e:
+                print("Transfer from client {} failed unexpectedly: " \
+                        "{!r}".format(adr[0], e))
+                if self.use_log:
+                    self._update_log('exception', 'Transfer from client {} ' \
+                            'failed unexpectedly.'.format(adr[0]))
+
+            finally:
+                if writer:
+                    writer.close()
+
+                if relay:
+                    relay.close()
+
+                if receiver:
+                    receiver.close()
+                    if not receiver.done:
+                        received += receiver.bytes
+
+                duration = time.perf_counter() - started
+                self.metrics.change('active_connections', -1)
+                if duration:
+                    self.metrics.observe('connection_bytes_per_second',
+                            received / duration)
+
+                self.metrics.emit('connection', address = adr[0],
+                        bytes = received, duration = duration)
+
+    def _receive_transfer(self, connection, writer, receiver, relay = None,
+            share = None):
+        """
+        Receive a single transfer, i.e. the frames up to and including
+        the end of transfer, which the receiver acknowledges. Content is
+        written behind by 'writer', and every other frame is handled once
+        the content before it is written. When relaying, every frame is
+        forwarded before it is handled. When the server limits its rate,
+        every write and pack waits for its turn in 'share'.
+
+        Returns:
+            False if the client closed the connection before the
+            transfer started, otherwise True.
+        """
+        # The transfer starts with its first frame, and the time spent
+        # receiving content is the time in data frames not spent waiting
+        # for the writer.
+        started = None
+        data_time = 0.0
+        writer.stall_time = 0.0
+        write = receiver.write
+        if share:
+            def write(chunk):
+                share.take(len(chunk))
+                receiver.write(chunk)
+
+        while not receiver.done:
+            header = recv_header(connection)
+            if header is None:
+                if started is None:
+                    return False
+
+                raise ProtocolError("Connection closed before " \
+                        "end of transfer.")
+
+            frame_type, length = header
+            if frame_type in (PING, PROBE):
+                self._answer_probe(connection, frame_type, length, writer)
+                continue
+
+            if started is None:
+                started = time.perf_counter()
+
+            if frame_type == DATA:
+                data_started = time.perf_counter()
+                if relay:
+                    relay.send(FRAME.pack(DATA, length))
+
+                writer.receive(connection, length, write,
+                        relay.send if relay else None)
+                data_time += time.perf_counter() - data_started
+
+            else:
+                payload = recv_payload(connection, length, self.max_frame_size)
+                if relay:
+                    relay.send(pack_frame(frame_type, payload))
+
+                writer.drain()
+                if share and frame_type == PACK:
+                    share.take(length)
+
+                reply = receiver.handle(frame_type, payload)
+                if reply and relay and reply[0] == END:
+                    reply = relay.finish(reply)
+
+                if reply:
+                    send_frame(connection, *reply)
+
+        self.metrics.record_transfer(receiver.files, receiver.bytes,
+                time.perf_counter() - started,
+                recv_seconds = data_time - writer.stall_time,
+                disk_seconds = receiver.disk_time,
+                decode_seconds = receiver.decode_time,
+                first_byte = receiver.first_byte)
+        return True
+
+    def _answer_probe(self, connection, frame_type, length, writer):
+        """
+        Answer a ping at once, and a burst once all of it has arrived,
+        see Client.ping. Probes are answered between transfers and
+        aren't counted as transfers.
+        """
+        if frame_type == PROBE:
+            writer.receive(connection, length, lambda chunk: None)
+
+        else:
+            recv_payload(connection, length, self.max_frame_size)
 
+        send_frame(connection, frame_type)
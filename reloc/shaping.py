@@ -0,0 +1,199 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import heapq
+import itertools
+import time
+from threading import Condition, Lock
+
+# Package imports
+from .protocol import CHUNK_SIZE
+
+# A bucket holds at most this many seconds of its rate, such that a
+# transfer that was idle can't send more than that at once.
+BURST_TIME = 0.05
+
+# Shaped content is sent in pieces of at most this many bytes.
+MAX_PIECE = 2**20
+
+# Priorities that clients can ask a server for, and the seconds of the
+# rate that a connection writes per turn, see FairScheduler.
+MAX_PRIORITY = 16
+TURN_TIME = 0.001
+MIN_TURN = 2**12
+
+
+class TokenBucket():
+    """
+    Limits the bytes per second of everything that takes from it. Tokens
+    are added at 'rate' per second, up to 'burst' tokens. Taking more
+    tokens than the bucket holds is allowed, but the taker sleeps until
+    the debt is paid, which makes concurrent takers wait in turn. A
+    bucket can be shared between threads and clients.
+
+    Methods:
+        take: Take tokens, sleeping while the bucket is in debt.
+    """
+    def __init__(self, rate, burst = None):
+        """
+        Params:
+            rate (int): The bytes per second.
+
+            burst (int): The most bytes sent at once after being idle.
+            Default: None (i.e. 50 ms of the rate, at least 64 KiB).
+        """
+        if not isinstance(rate, (int, float)) or rate <= 0:
+            raise ValueError("Rate specified on the wrong format, " \
+                    "should be a positive number of bytes per second.")
+
+        self.rate = rate
+        self.burst = burst or max(CHUNK_SIZE, int(rate * BURST_TIME))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = Lock()
+
+    def take(self, count):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ShapedSocket():
+    """
+    Socket-like object that sends through one or more token buckets, e.g.
+    the bucket of a client and the bucket of a single transfer. Content is
+    sent in pieces no larger than the smallest burst, such that the
+    buckets pace it evenly. Everything else is passed to the socket.
+
+    Methods:
+        sendall: Send data, pacing it.
+
+        sendfile: Send a range of a file, pacing it.
+    """
+    def __init__(self, sock, buckets):
+        self.sock = sock
+        self.buckets = buckets
+        self.piece = min([MAX_PIECE] + [bucket.burst for bucket in buckets])
+
+    def _take(self, count):
+        for bucket in self.buckets:
+            bucket.take(count)
+
+    def sendall(self, data):
+        with memoryview(data) as view:
+            for start in range(0, len(view), self.piece):
+                piece = view[start:start + self.piece]
+                self._take(len(piece))
+                self.sock.sendall(piece)
+
+    def sendfile(self, file, offset = 0, count = None):
+        sent = 0
+        while count is None or sent < count:
+            size = self.piece if count is None else min(self.piece, count - sent)
+            self._take(size)
+            done = self.sock.sendfile(file, offset + sent, size)
+            sent += done
+            if done < size:
+                break
+
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Share():
+    """
+    The share of a single connection in a FairScheduler.
+
+    Methods:
+        take: Wait for the turn of the connection to write.
+    """
+    def __init__(self, scheduler, weight):
+        self.scheduler = scheduler
+        self.weight = weight
+        # Virtual time at which the last write of the connection finishes.
+        self.finish = 0.0
+
+    def take(self, count):
+        self.scheduler._take(self, count)
+
+
+class FairScheduler():
+    """
+    Shares a rate of bytes per second between connections, weighted by
+    their priority. Every write waits for its turn, and turns are given
+    in the order of virtual finish times (start-time fair queuing), such
+    that a connection with twice the weight writes twice as many bytes
+    while both have writes waiting. A connection alone gets the whole
+    rate, and a small transfer that starts during a large one gets its
+    turn at once instead of after the writes queued by the large one.
+    Large writes are split into turns of about a millisecond of the
+    rate, which bounds the wait for a turn.
+
+    Methods:
+        share: Add a connection with a weight.
+
+        _take: Private method to wait for the turns of a write.
+
+        _turn: Private method to wait for a turn and the tokens of it.
+    """
+    def __init__(self, rate, burst = None):
+        self.bucket = TokenBucket(rate, burst)
+        self.condition = Condition()
+        # Waiting writes as (finish time, sequence number), the write being
+        # served, and the virtual time, i.e. the start time of that write.
+        self.waiting = list()
+        self.serving = False
+        self.virtual = 0.0
+        self.sequence = itertools.count()
+        self.turn_size = max(MIN_TURN, int(rate * TURN_TIME))
+
+    def share(self, weight = 1):
+        """
+        Returns:
+            A Share that every write of a connection takes from.
+        """
+        if not isinstance(weight, int):
+            weight = 1
+
+        return Share(self, max(1, min(MAX_PRIORITY, weight)))
+
+    def _take(self, share, count):
+        while count > 0:
+            size = min(count, self.turn_size)
+            self._turn(share, size)
+            count -= size
+
+    def _turn(self, share, count):
+        with self.condition:
+            start = max(self.virtual, share.finish)
+            share.finish = start + count / share.weight
+            turn = (share.finish, next(self.sequence))
+            heapq.heappush(self.waiting, turn)
+            while self.serving or self.waiting[0] != turn:
+                self.condition.wait()
+
+            heapq.heappop(self.waiting)
+            self.serving = True
+            self.virtual = start
+
+        try:
+            self.bucket.take(count)
+
+        finally:
+            with self.condition:
+                self.serving = False
+                self.condition.notify_all()
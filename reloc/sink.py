@@ -0,0 +1,89 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+from fnmatch import fnmatch
+from threading import Lock
+
+
+class MemoryFile():
+    """
+    A single file that a MemorySink receives.
+
+    Methods:
+        write: Add a chunk of the content.
+
+        close: Hand the complete content to the sink.
+
+        abort: Drop the content, e.g. when it failed verification.
+    """
+    def __init__(self, sink, path):
+        self.sink = sink
+        self.path = path
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.sink._add(self.path, self.data)
+        self.data = None
+
+    def abort(self):
+        self.data = None
+
+
+class MemorySink():
+    """
+    Keeps received files in memory instead of writing them to disk, e.g.
+    for content that is processed right away. Given as the 'sink' of a
+    server, and shared between its connections.
+
+    Methods:
+        pop: Remove and return the content of a received file.
+
+        _add: Private method to keep or hand on a complete file.
+    """
+    def __init__(self, callback = None, patterns = None):
+        """
+        Params:
+            callback (callable): Called as callback(path, data) with every
+            complete and verified file, in which case files aren't kept.
+            Default: None (i.e. files are kept in 'files').
+
+            patterns (list): Glob patterns of the paths to take, while
+            other files are written to disk as usual.
+            Default: None (i.e. every file).
+        """
+        self.callback = callback
+        self.patterns = patterns
+        self.files = dict()
+        self.lock = Lock()
+
+    def __call__(self, path, item):
+        if self.patterns and not any(fnmatch(path, pattern)
+                for pattern in self.patterns):
+            return None
+
+        return MemoryFile(self, path)
+
+    def _add(self, path, data):
+        if self.callback:
+            self.callback(path, data)
+            return
+
+        with self.lock:
+            self.files[path] = data
+
+    def pop(self, path):
+        """
+        Returns:
+            The content of the file as a bytearray, or None if it hasn't
+            been received.
+        """
+        with self.lock:
+            return self.files.pop(path, None)
@@ -0,0 +1,164 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import os
+import shutil
+import tempfile
+import threading
+
+# Name of the store folder when it is kept in the default path.
+STORE_NAME = '.reloc-store'
+
+# Request code of the ioctl that clones a file on e.g. btrfs and xfs.
+FICLONE = 0x40049409
+
+# Serializes detaching files from the store, since the ranges of a
+# striped file arrive over multiple connections at once.
+_detach_lock = threading.Lock()
+
+
+def _reflink(source, target):
+    """
+    Clone a file, where the clone shares the blocks of the source until
+    either is modified. Raises OSError where cloning isn't supported.
+    """
+    try:
+        import fcntl
+
+    except ImportError:
+        raise OSError("Cloning files is not supported.")
+
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _clone(source, target, mode = 0o644):
+    """
+    Make 'target' a copy of 'source', i.e. a reflink that takes no extra
+    space where supported, and otherwise a full copy. Either way the
+    copies never share an inode, such that writing to or touching one of
+    them never changes the other. The target is replaced atomically.
+    """
+    fd, temp = tempfile.mkstemp(dir = os.path.dirname(target),
+            prefix = '.{}.'.format(os.path.basename(target)),
+            suffix = '.reloc-link')
+    os.close(fd)
+    try:
+        try:
+            _reflink(source, temp)
+
+        except OSError:
+            shutil.copyfile(source, temp)
+
+        os.chmod(temp, mode)
+        os.replace(temp, target)
+
+    finally:
+        if os.path.lexists(temp):
+            os.remove(temp)
+
+
+class BlobStore():
+    """
+    Content addressed store of file contents, keyed by their hash.
+    Received files are added to the store, and later files with the same
+    content are linked to the stored copy instead of being sent again.
+
+    Files are linked with reflinks where the file system supports it,
+    and are otherwise copies, i.e. a store on e.g. ext4 saves sending
+    content again but not disk space. Stored content is read-only, and
+    never shares an inode with a received file.
+
+    Methods:
+        path_for: The path in the store of the content with a hash.
+
+        has: Check if the store holds the content with a hash.
+
+        add: Add the content of a received file to the store.
+
+        link: Link a path to stored content.
+
+        detach: Unlink a file that shares its inode with other paths,
+        e.g. a hardlink, before the file is written.
+
+        contains: Check if a path is inside the store.
+    """
+    def __init__(self, root):
+        """
+        Params:
+            root (str): The folder that the store is kept in, which
+            should be on the same file system as the default path.
+        """
+        self.root = os.path.abspath(str(root))
+        os.makedirs(self.root, exist_ok = True)
+
+    def path_for(self, digest):
+        """
+        Returns:
+            The path of the content with a hash, which is stored in
+            folders by the first two characters of the hash.
+        """
+        if not isinstance(digest, str) or len(digest) < 3 or not all(c in '0123456789abcdef' for c in digest):
+            raise ValueError("Invalid hash {}.".format(digest))
+
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def add(self, path, digest):
+        """
+        Add the content of the file on 'path', which must have been
+        checked to have the hash 'digest'.
+        """
+        blob = self.path_for(digest)
+        if os.path.exists(blob):
+            return
+
+        os.makedirs(os.path.dirname(blob), exist_ok = True)
+        try:
+            _clone(path, blob, mode = 0o444)
+
+        except OSError:
+            # E.g. a store on another file system, the file is
+            # still saved, just not deduplicated.
+            pass
+
+    def link(self, digest, path):
+        """
+        Returns:
+            True if 'path' was linked to the content with the hash,
+            False if the store doesn't hold it or it can't be linked.
+        """
+        blob = self.path_for(digest)
+        if not os.path.exists(blob):
+            return False
+
+        try:
+            _clone(blob, path)
+
+        except OSError:
+            return False
+
+        return True
+
+    def detach(self, path):
+        with _detach_lock:
+            try:
+                if os.stat(path).st_nlink > 1:
+                    os.remove(path)
+
+            except FileNotFoundError:
+                pass
+
+    def contains(self, path):
+        """
+        Check if a path is inside the store, which clients must never
+        be able to write to.
+        """
+        return (str(path) + os.sep).startswith(self.root + os.sep)
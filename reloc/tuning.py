@@ -0,0 +1,121 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import math
+import socket
+
+# Package imports
+from .protocol import CHUNK_SIZE, MAX_STREAMS
+
+# Number of round trips timed by a probe, the size of the first burst
+# sent to measure the bandwidth, and the shortest time that the last
+# burst should take, such that the round trip is a small part of it.
+PROBE_PINGS = 5
+PROBE_MIN = 2**18
+PROBE_MAX = 2**26
+PROBE_TIME = 0.05
+
+# Compressed content is sent in chunks holding about this many seconds
+# of the bandwidth, such that fast links get fewer, larger frames.
+CHUNK_TIME = 0.002
+MAX_CHUNK = 2**20
+
+# Largest socket buffer set by tuning, the kernel might cap it further.
+MAX_BUFFER = 2**26
+
+
+def autotune_limit(name = 'wmem'):
+    """
+    Returns:
+        The largest size that Linux grows the send ('wmem') or receive
+        ('rmem') buffer of a TCP socket to by itself, or None where it
+        isn't known. Setting the size of a buffer turns the growth off.
+    """
+    try:
+        with open('/proc/sys/net/ipv4/tcp_{}'.format(name)) as f:
+            return int(f.read().split()[2])
+
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def set_buffers(sock, size):
+    """
+    Set the send and receive buffers of a socket. Set them before the
+    socket connects or listens, such that the window scaling suits them.
+    """
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+        except OSError:
+            # The buffer sizes are only a hint.
+            pass
+
+
+def _power_of_two(value, low, high):
+    return max(low, min(high, 2**math.ceil(math.log2(max(value, 1)))))
+
+
+class Link():
+    """
+    Round trip time and bandwidth of the link to a server, measured by
+    Client.ping, and the settings that suit the link.
+
+    Methods:
+        socket_buffer: The socket buffer needed to keep the link full.
+
+        chunk_size: The size of the chunks to send compressed content in.
+
+        streams: The number of connections needed to keep the link full.
+
+        to_dict: The measurements as a dict.
+    """
+    def __init__(self, rtt, bandwidth):
+        # Shortest round trip in seconds, and the bandwidth of a
+        # short burst in bytes per second.
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+
+    @property
+    def bdp(self):
+        """
+        The bandwidth-delay product, i.e. the bytes in flight on a full link.
+        """
+        return self.rtt * self.bandwidth
+
+    def socket_buffer(self):
+        """
+        Returns:
+            Twice the bandwidth-delay product, or None if the kernel
+            grows the buffer that far by itself.
+        """
+        window = 2 * self.bdp
+        limit = autotune_limit('wmem')
+        if limit and window <= limit:
+            return None
+
+        return _power_of_two(window, 2**16, MAX_BUFFER)
+
+    def chunk_size(self):
+        return _power_of_two(self.bandwidth * CHUNK_TIME, CHUNK_SIZE, MAX_CHUNK)
+
+    def streams(self, capacity):
+        """
+        Returns:
+            The connections needed to keep the link full, when every
+            connection holds at most 'capacity' bytes in flight.
+        """
+        return max(1, min(MAX_STREAMS, math.ceil(2 * self.bdp / max(capacity, 1))))
+
+    def to_dict(self):
+        return {'rtt': self.rtt, 'bandwidth': self.bandwidth, 'bdp': self.bdp}
+
+    def __repr__(self):
+        return "Link(rtt = {:.2f} ms, bandwidth = {:.1f} MB/s)".format(
+                self.rtt * 1000, self.bandwidth / 2**20)
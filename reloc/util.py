@@ -5,6 +5,16 @@ Simple file transfer package between client and server.
 MIT License.
 """
 
+# Imports
+import hashlib
+import os
+import pathlib
+import stat
+
+# Files at least this large are hashed on the process pool when building
+# a manifest, smaller files are faster to hash than to hand over.
+HASH_THRESHOLD = 2**20
+
 class Item():
     """
     Information about a single file/folder.
@@ -13,11 +23,26 @@ class Item():
     def __init__(self):
         self.name = None
         self.path = None
-        self.content = None
+        self.source = None
         self.type_ = None
         self.size = 0
         self.mtime = 0
         self.suffix = None
+        # Block size when the content is sent as a delta against
+        # the copy the server already has, otherwise None.
+        self.delta = None
+        # Codec the content is compressed with, or None.
+        self.codec = None
+        # Number of connections the content is striped over, or None.
+        self.stripes = None
+        # Offset that the content continues from, when resuming
+        # an interrupted transfer of the file.
+        self.offset = 0
+        # Hash of the content, when known.
+        self.digest = None
+        # Stream that the content is read from instead of 'source',
+        # when sent from memory. Never sent to the server.
+        self.stream = None
 
     def __eq__(self, other):
         """
@@ -25,3 +50,227 @@ class Item():
         """
         if self.path == other.path:
             return True
+
+    def to_dict(self):
+        """
+        Metadata sent to the server in the item frame. The source,
+        i.e. where the client reads the content from, is never sent.
+        """
+        path = self.path
+        if not isinstance(path, str):
+            path = pathlib.PurePath(path).as_posix()
+
+        return {
+            'name': self.name,
+            'path': path,
+            'type_': self.type_,
+            'size': self.size,
+            'mtime': self.mtime,
+            'suffix': self.suffix,
+            'delta': self.delta,
+            'codec': self.codec,
+            'stripes': self.stripes,
+            'offset': self.offset,
+            'digest': self.digest,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create an item from the metadata received in an item frame.
+        """
+        item = cls()
+        for key in ('name', 'path', 'type_', 'size', 'mtime', 'suffix', 'delta',
+                'codec', 'stripes', 'offset', 'digest'):
+            setattr(item, key, data.get(key, getattr(item, key)))
+
+        return item
+
+
+class Stream():
+    """
+    Content sent from memory instead of from a path, i.e. bytes, a
+    memoryview, a readable binary file object or an iterator of chunks.
+
+    Methods:
+        regular_file: The file object, if it is a regular file that
+        can be sent with sendfile.
+
+        chunks: Generate the content as memoryviews.
+
+        replayable: Whether the content can be read again.
+    """
+    def __init__(self, data):
+        self.data = data
+        # Size of the content, None until read if it isn't known up
+        # front, and the position that a seekable file starts at.
+        self.size = None
+        self.start = None
+        self.used = False
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self.size = memoryview(data).nbytes
+
+        elif hasattr(data, 'read'):
+            if getattr(data, 'seekable', lambda: False)():
+                self.start = data.tell()
+                self.size = data.seek(0, os.SEEK_END) - self.start
+                data.seek(self.start)
+
+        else:
+            # Raises TypeError if the data can't be sent.
+            self.data = iter(data)
+
+    def regular_file(self):
+        if self.start is None:
+            return None
+
+        try:
+            if stat.S_ISREG(os.fstat(self.data.fileno()).st_mode):
+                return self.data
+
+        except (OSError, ValueError, AttributeError):
+            # E.g. io.BytesIO, which has no file descriptor.
+            pass
+
+        return None
+
+    def replayable(self):
+        """
+        Returns:
+            True if the content can be read (again), i.e. it's bytes-like,
+            can be rewound, or hasn't been read yet.
+        """
+        return (not self.used or self.start is not None
+                or isinstance(self.data, (bytes, bytearray, memoryview)))
+
+    def chunks(self, size):
+        """
+        Generate the content in chunks of at most 'size' bytes, except
+        bytes and memoryviews, which are generated whole. Every chunk
+        is only valid until the next is generated. Content that can't be
+        rewound, i.e. iterators and unseekable files, is only read once.
+        """
+        if self.start is not None:
+            self.data.seek(self.start)
+
+        elif not self.replayable():
+            raise OSError("Stream can't be read again, e.g. to retry it.")
+
+        self.used = True
+        if isinstance(self.data, (bytes, bytearray, memoryview)):
+            with memoryview(self.data) as view, view.cast('B') as chunk:
+                yield chunk
+
+            return
+
+        if not hasattr(self.data, 'read'):
+            for chunk in self.data:
+                if chunk:
+                    yield memoryview(chunk)
+
+            return
+
+        readinto = getattr(self.data, 'readinto', None)
+        if not readinto:
+            while True:
+                chunk = self.data.read(size)
+                if not chunk:
+                    return
+
+                yield memoryview(chunk)
+
+        buffer = memoryview(bytearray(size))
+        while True:
+            length = readinto(buffer)
+            if not length:
+                return
+
+            yield buffer[:length]
+
+
+class TransferResult():
+    """
+    Result of a single transfer, returned by the clients.
+    """
+    def __init__(self):
+        self.bytes_sent = 0
+        self.duration = 0.0
+        # Maps the path of every file to its status, i.e. 'sent',
+        # 'unchanged' when skipped by a sync, 'deduplicated' when the
+        # server already had the content, or 'failed: <reason>'.
+        self.files = dict()
+
+    @property
+    def ok(self):
+        return all(status in ('sent', 'unchanged', 'deduplicated')
+                for status in self.files.values())
+
+    def __repr__(self):
+        return "TransferResult(files = {}, bytes_sent = {}, duration = {:.3f})".format(
+                len(self.files), self.bytes_sent, self.duration)
+
+
+def hash_file(path):
+    """
+    Compute the hex digest of the content of a file.
+    """
+    digest = hashlib.blake2b()
+    with open(str(path), 'rb') as f:
+        while True:
+            chunk = f.read(2**20)
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def manifest_entry(item, checksum = False, digest = None):
+    """
+    Compact manifest entry [path, size, mtime, hash] for a file item,
+    used when syncing. The hash is None unless 'checksum' is specified.
+    """
+    if checksum and digest is None:
+        digest = hash_file(item.source)
+
+    return [item.to_dict()['path'], item.size, item.mtime, digest]
+
+
+def build_manifest(items, checksum = False, executor = None):
+    """
+    Build the manifest entries of file items. Large files are hashed
+    in parallel on 'executor', e.g. a process pool, when given.
+    """
+    digests = dict()
+    if checksum and executor:
+        large = [item for item in items if item.size >= HASH_THRESHOLD]
+        sources = [str(item.source) for item in large]
+        for item, digest in zip(large, executor.map(hash_file, sources)):
+            digests[id(item)] = digest
+
+    return [manifest_entry(item, checksum, digests.get(id(item)))
+            for item in items]
+
+
+def is_current(path, size, mtime, digest = None):
+    """
+    Check if the file on 'path' is the same as the one described by a
+    manifest entry. Files are compared by size and modification time,
+    or by content if a hash is given.
+    """
+    try:
+        stat = os.stat(str(path))
+
+    except OSError:
+        return False
+
+    if stat.st_size != size:
+        return False
+
+    if digest:
+        return hash_file(path) == digest
+
+    # Modification times are compared with a small tolerance since
+    # they are sent as floats.
+    return abs(stat.st_mtime - mtime) < 1e-3
@@ -0,0 +1,292 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+"""
+
+# Imports
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import time
+
+# Package imports
+from .scan import _file_item
+from .util import Item
+
+# Seconds without new changes before a burst of changes is sent, and
+# the longest that a change waits while the burst goes on.
+DEBOUNCE = 0.2
+MAX_DELAY = 2.0
+
+# Seconds between two scans of the tree, when inotify isn't available.
+POLL_INTERVAL = 1.0
+
+# Inotify event masks, see inotify(7).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+        | IN_MOVE_SELF | IN_ONLYDIR)
+
+# Every inotify event is [wd][mask][cookie][length of name][name].
+EVENT = struct.Struct('iIII')
+
+# Returned in place of the changed paths when every file has to be
+# checked, e.g. when the kernel dropped events.
+RESCAN = None
+
+
+class InotifyWatcher():
+    """
+    Watches a tree with inotify, i.e. the kernel reports every file that
+    is written or moved into the tree, so nothing is scanned while the
+    tree is idle. Linux only, see 'open_watcher'.
+
+    Methods:
+        changes: Wait for the next changes.
+
+        close: Stop watching.
+
+        _add_tree: Private method to watch a folder and all folders in it.
+    """
+    def __init__(self, root):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                use_errno = True)
+        # Raises AttributeError where inotify doesn't exist.
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        self.root = str(root)
+        # Maps every watch descriptor to the folder it watches.
+        self.folders = dict()
+        self._add_tree(self.root, set())
+
+    def _add_tree(self, folder, changed):
+        """
+        Watch a folder and its subfolders. Files already in a new folder
+        are added to 'changed', since they were written before the
+        folder was watched.
+        """
+        pending = [folder]
+        while pending:
+            folder = pending.pop()
+            wd = self._add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+            if wd < 0:
+                # E.g. removed again, or the limit of watches reached.
+                continue
+
+            self.folders[wd] = folder
+            try:
+                entries = list(os.scandir(folder))
+
+            except OSError:
+                continue
+
+            for entry in entries:
+                if entry.is_dir(follow_symlinks = False):
+                    changed.add(entry.path)
+                    pending.append(entry.path)
+
+                elif entry.is_file():
+                    changed.add(entry.path)
+
+    def changes(self, timeout):
+        """
+        Wait up to 'timeout' seconds for changes.
+
+        Returns:
+            The set of changed paths, empty if there were none,
+            or RESCAN if events were lost.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 2**16)
+
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length]
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return RESCAN
+
+                if mask & IN_IGNORED:
+                    self.folders.pop(wd, None)
+                    continue
+
+                folder = self.folders.get(wd)
+                if folder is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    continue
+
+                path = os.path.join(folder, os.fsdecode(name.rstrip(b'\0')))
+                changed.add(path)
+                if mask & IN_ISDIR:
+                    self._add_tree(path, changed)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollWatcher():
+    """
+    Watches a tree by scanning it every 'interval' seconds and comparing
+    the size and modification time of every file with the last scan.
+
+    Methods:
+        changes: Wait for the next changes.
+
+        close: Stop watching.
+
+        _scan: Private method to stat every file in the tree.
+    """
+    def __init__(self, root, interval = POLL_INTERVAL):
+        self.root = str(root)
+        self.interval = interval
+        self.next_scan = time.monotonic() + interval
+        self.state = self._scan()
+
+    def _scan(self):
+        state = dict()
+        pending = [self.root]
+        while pending:
+            folder = pending.pop()
+            try:
+                entries = list(os.scandir(folder))
+
+            except OSError:
+                continue
+
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks = False):
+                        state[entry.path] = None
+                        pending.append(entry.path)
+
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        state[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+                except OSError:
+                    continue
+
+        return state
+
+    def changes(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+        state = self._scan()
+        changed = {path for path, value in state.items()
+                if self.state.get(path, 0) != value}
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(root, interval = POLL_INTERVAL):
+    """
+    Watch a tree with inotify where available, otherwise by polling.
+    """
+    try:
+        return InotifyWatcher(root)
+
+    except (OSError, AttributeError):
+        return PollWatcher(root, interval)
+
+
+def collect(watcher, debounce = DEBOUNCE, max_delay = MAX_DELAY, timeout = 0.5):
+    """
+    Wait for changes and coalesce a burst of them, i.e. until no changes
+    have arrived for 'debounce' seconds, or for at most 'max_delay'
+    seconds after the first change.
+
+    Returns:
+        The set of changed paths, empty if nothing changed within
+        'timeout' seconds, or RESCAN.
+    """
+    changed = watcher.changes(timeout)
+    if not changed:
+        return changed
+
+    deadline = time.monotonic() + max_delay
+    while True:
+        wait = min(debounce, deadline - time.monotonic())
+        if wait <= 0:
+            return changed
+
+        more = watcher.changes(wait)
+        if more is RESCAN:
+            return RESCAN
+
+        if not more:
+            return changed
+
+        changed |= more
+
+
+def changed_items(parent_path, paths):
+    """
+    Create the items to send for changed paths in the tree of
+    'parent_path', laid out as 'iter_items' does. Paths that no longer
+    exist and .dotfiles are skipped, and folders are sent before the
+    files in them.
+    """
+    root = str(parent_path)
+    items = list()
+    for path in sorted(paths):
+        relative = os.path.relpath(path, root)
+        if relative.startswith(os.pardir):
+            continue
+
+        name = os.path.basename(path)
+        item_path = parent_path.stem + '/' + pathlib.PurePath(relative).as_posix()
+        try:
+            if os.path.isdir(path):
+                item = Item()
+                item.path = item_path
+                item.type_ = "folder"
+
+            elif os.path.isfile(path) and name[0] != '.':
+                item = _file_item(item_path, name, os.stat(path))
+                item.source = path
+
+            else:
+                continue
+
+        except OSError:
+            continue
+
+        items.append(item)
+
+    return items
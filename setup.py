@@ -7,7 +7,7 @@ EMAIL = "a.normelius@gmail.com"
 DESCRIPTION = "A simple file transfer service"
 URL = "https://github.com/normelius/reloc"
 PACKAGES = ['reloc']
-PYTHON_REQUIRES = ">=3.6"
+PYTHON_REQUIRES = ">=3.7"
 
 
 with open("README.md", "r") as fh:
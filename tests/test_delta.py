@@ -0,0 +1,146 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+
+Tests of the block signatures and delta matching, run with:
+
+    $ python -m unittest discover tests
+"""
+
+# Imports
+import pathlib
+import random
+import tempfile
+import unittest
+import zlib
+
+# Package imports
+from reloc import delta
+
+
+def _apply(basis, data, ops, block_size):
+    """
+    Reconstruct a file from the old copy and a delta, i.e. what the
+    server does with the data and copy frames.
+    """
+    parts = list()
+    for op in ops:
+        if op[0] == 'data':
+            parts.append(data[op[1]:op[2]])
+
+        else:
+            start = op[1] * block_size
+            parts.append(basis[start:start + op[2] * block_size])
+
+    return b''.join(parts)
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.folder.name)
+        self.random = random.Random(0)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def _bytes(self, size):
+        return self.random.getrandbits(8 * size).to_bytes(size, 'little')
+
+    def _delta(self, basis, data):
+        """
+        Returns:
+            The delta of 'data' against 'basis', and the number of bytes
+            that it copies from 'basis', after checking that the delta
+            reconstructs 'data' byte for byte.
+        """
+        (self.root / 'old').write_bytes(basis)
+        (self.root / 'new').write_bytes(data)
+        block_size, blocks = delta.decode_signature(
+                delta.signature(self.root / 'old', len(basis)))
+        ops = list(delta.delta(self.root / 'new', len(data), block_size,
+            blocks))
+
+        self.assertEqual(_apply(basis, data, ops, block_size), data)
+        copied = sum(op[2] * block_size for op in ops if op[0] == 'copy')
+        return ops, copied
+
+    def test_signature(self):
+        basis = self._bytes(3 * 4096 + 100)
+        block_size, blocks = delta.decode_signature(
+                delta.signature(self._write(basis), len(basis)))
+
+        # Only full blocks are signed.
+        self.assertEqual(block_size, 4096)
+        for index in range(3):
+            block = basis[index * 4096:(index + 1) * 4096]
+            self.assertIn((delta.strong_hash(block), index),
+                    blocks[zlib.adler32(block)])
+
+        self.assertEqual(sum(len(matches) for matches in blocks.values()), 3)
+
+    @unittest.skipUnless(delta._numpy(), "Requires numpy.")
+    def test_rolling_checksum(self):
+        data = self._bytes(3 * 4096)
+        weak = sorted({zlib.adler32(data[offset:offset + 4096])
+            for offset in (0, 1, 777, 4096, 2 * 4096)})
+        np = delta._numpy()
+        weak = np.array(weak, dtype = np.int64)
+        table = np.zeros(1 << delta.FILTER_BITS, dtype = bool)
+        table[delta._filter_key(weak >> 16, weak & 0xffff)] = True
+
+        found = delta._rolling_candidates(np, data, 0, 2 * 4096 + 1, 4096,
+                (weak, table))
+        expected = [offset for offset in range(2 * 4096 + 1)
+                if zlib.adler32(data[offset:offset + 4096]) in weak.tolist()]
+        self.assertEqual(found, expected)
+        self.assertTrue({0, 1, 777, 4096, 2 * 4096} <= set(found))
+
+    def test_edit_in_place(self):
+        basis = self._bytes(2**20)
+        data = bytearray(basis)
+        data[5000:5100] = self._bytes(100)
+        data[600000] ^= 0xff
+        ops, copied = self._delta(basis, bytes(data))
+
+        # Only the two edited blocks are sent.
+        self.assertEqual(copied, len(data) - 2 * 4096)
+
+    @unittest.skipUnless(delta._numpy(), "Requires numpy.")
+    def test_insertion_and_deletion(self):
+        basis = self._bytes(2**20)
+        inserted = basis[:10000] + self._bytes(123) + basis[10000:]
+        deleted = basis[:10000] + basis[10123:]
+        for data in (inserted, deleted):
+            ops, copied = self._delta(basis, data)
+
+            # The blocks after the change are found at their new offsets.
+            self.assertGreater(copied, len(data) - 3 * 4096)
+
+    def test_changed_final_block(self):
+        basis = self._bytes(2**20 + 1000)
+        for data in (basis[:-1] + b'x', basis + b'appended', basis[:-500]):
+            ops, copied = self._delta(basis, data)
+            self.assertEqual(ops[-1][0], 'data')
+            self.assertGreaterEqual(copied, 2**20 - 4096)
+
+    def test_empty_basis(self):
+        data = self._bytes(2**20)
+        ops, copied = self._delta(b'', data)
+        self.assertEqual(ops, [('data', 0, len(data))])
+        self.assertEqual(copied, 0)
+
+    def test_empty_file(self):
+        ops, copied = self._delta(self._bytes(2**20), b'')
+        self.assertEqual(ops, [])
+
+    def _write(self, data):
+        path = self.root / 'file'
+        path.write_bytes(data)
+        return path
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+
+Tests of retrying transfers, run with:
+
+    $ python -m unittest discover tests
+"""
+
+# Imports
+import contextlib
+import io
+import socket
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+# Package imports
+from reloc.client import Client
+from reloc.server import Server
+
+
+class FlakyFile(io.BytesIO):
+    """
+    Seekable file that fails to be read the first time.
+    """
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = 0
+
+    def readinto(self, buffer):
+        self.reads += 1
+        if self.reads == 1:
+            raise ConnectionResetError('read failed')
+
+        return super().readinto(buffer)
+
+
+class TestRetries(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        with socket.socket() as probe:
+            probe.bind(('localhost', 0))
+            self.port = probe.getsockname()[1]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = Server(port = self.port, def_path = self.folder.name)
+            # Servers run until the process exits.
+            Thread(target = server.receive, daemon = True).start()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_iterator_is_not_retried(self):
+        def chunks():
+            yield b'sent'
+            raise BrokenPipeError('source failed')
+
+        client = Client('localhost', self.port, retries = 3)
+        start = time.perf_counter()
+        with self.assertRaisesRegex(BrokenPipeError, 'source failed'):
+            with contextlib.redirect_stdout(io.StringIO()):
+                client.transmit(chunks(), remote_path = 'chunks.txt')
+
+        # Raised at once, without waiting to retry.
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_seekable_file_is_retried(self):
+        data = FlakyFile(b'retried' * 1000)
+        client = Client('localhost', self.port, retries = 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = client.transmit(data, remote_path = 'retried.txt')
+
+        self.assertTrue(result.ok)
+        with open('{}/retried.txt'.format(self.folder.name), 'rb') as f:
+            self.assertEqual(f.read(), b'retried' * 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Reloc
+@ 2020, Anton Normelius.
+Simple file transfer package between client and server.
+MIT License.
+
+Tests of the server sink, run with:
+
+    $ python -m unittest discover tests
+"""
+
+# Imports
+import contextlib
+import io
+import pathlib
+import socket
+import tempfile
+import unittest
+from threading import Thread
+
+# Package imports
+from reloc.client import Client
+from reloc.protocol import (ITEM, DATA, EOF, END, PACK, PACK_INDEX,
+        encode_json, decode_json)
+from reloc.receiver import Receiver
+from reloc.server import Server
+from reloc.sink import MemorySink
+
+
+class FailingSink(MemorySink):
+    """
+    Sink that raises for the paths starting with 'bad', either when asked
+    for the file, or when the file is written to.
+    """
+    def __init__(self, fail_on = 'call'):
+        super().__init__()
+        self.fail_on = fail_on
+
+    def __call__(self, path, item):
+        if path.startswith('bad') and self.fail_on == 'call':
+            raise RuntimeError('sink is broken')
+
+        output = super().__call__(path, item)
+        if path.startswith('bad') and self.fail_on == 'write':
+            def write(data):
+                raise RuntimeError('sink is broken')
+
+            output.write = write
+
+        return output
+
+
+def _send_file(receiver, path, data):
+    receiver.handle(ITEM, encode_json({'name': path, 'path': path,
+        'type_': 'file', 'size': len(data)}))
+    receiver.handle(DATA, data)
+    receiver.handle(EOF, b'')
+
+
+def _pack(files):
+    index = encode_json([[path, len(data), 0] for path, data in files])
+    return (PACK_INDEX.pack(len(index)) + index
+            + b''.join(data for _, data in files))
+
+
+class TestSinkFailures(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def _transfer(self, sink, send):
+        receiver = Receiver(self.root, sink = sink)
+        send(receiver)
+        _, summary = receiver.handle(END, b'')
+        receiver.close()
+        return dict(decode_json(summary)['failed'])
+
+    def test_failing_call_fails_the_file(self):
+        for fail_on in ('call', 'write'):
+            sink = FailingSink(fail_on)
+            failed = self._transfer(sink, lambda receiver: (
+                _send_file(receiver, 'bad.txt', b'lost'),
+                _send_file(receiver, 'good.txt', b'kept')))
+
+            self.assertEqual(list(failed), ['bad.txt'])
+            self.assertIn('RuntimeError: sink is broken', failed['bad.txt'])
+            self.assertEqual(bytes(sink.pop('good.txt')), b'kept')
+            self.assertIsNone(sink.pop('bad.txt'))
+            self.assertFalse((self.root / 'bad.txt').exists())
+
+    def test_failing_call_fails_packed_files(self):
+        for fail_on in ('call', 'write'):
+            sink = FailingSink(fail_on)
+            failed = self._transfer(sink, lambda receiver: receiver.handle(
+                PACK, _pack([('bad.txt', b'lost'), ('good.txt', b'kept')])))
+
+            self.assertEqual(list(failed), ['bad.txt'])
+            self.assertEqual(bytes(sink.pop('good.txt')), b'kept')
+
+    def test_server_keeps_serving(self):
+        with socket.socket() as probe:
+            probe.bind(('localhost', 0))
+            port = probe.getsockname()[1]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = Server(port = port, def_path = self.folder.name,
+                    max_transfers = 2, sink = FailingSink())
+            # Servers run until the process exits.
+            Thread(target = server.receive, daemon = True).start()
+            # More failing transfers than the server has workers.
+            for _ in range(3):
+                result = Client('localhost', port, timeout = 10).transmit(
+                        b'lost', remote_path = 'bad.txt')
+                self.assertFalse(result.ok)
+
+            result = Client('localhost', port, timeout = 10).transmit(
+                    b'kept', remote_path = 'good.txt')
+
+        self.assertTrue(result.ok)
+        self.assertEqual(bytes(server.sink.pop('good.txt')), b'kept')
+
+
+if __name__ == '__main__':
+    unittest.main()